@@ -0,0 +1,149 @@
+"""
+Benchmark examples_for_columns() against tables that are both wide and deep.
+
+    python benchmarks/bench_examples_for_columns.py
+    python benchmarks/bench_examples_for_columns.py --columns 10 100 600 --rows 100000
+"""
+
+from datasette_edit_schema.utils import examples_for_columns
+import argparse
+import json
+import sqlite3
+import tempfile
+import time
+import os
+
+
+def union_examples_for_columns(conn, table_name, columns):
+    # The previous implementation, for comparison: one CTE and one UNION
+    # branch per column over the first 1,000 rows
+    ctes = [f'rows as (select * from "{table_name}" limit 1000)']
+    unions = []
+    params = []
+    for i, column in enumerate(columns):
+        ctes.append(
+            f'col{i} as (select distinct "{column}" from rows '
+            f'where ("{column}" is not null and "{column}" != "") limit 5)'
+        )
+        unions.append(f'select ? as label, "{column}" as value from col{i}')
+        params.append(column)
+    ctes.append("strings as ({})".format("\nunion all\n".join(unions)))
+    ctes.append(
+        """
+    truncated_strings as (
+    select
+        label,
+        case
+        when length(value) > 30 then substr(value, 1, 30) || '...'
+        else value
+        end as value
+    from strings
+    where typeof(value) != 'blob'
+    )
+    """
+    )
+    sql = (
+        "with {ctes} ".format(ctes=",\n".join(ctes))
+        + "select label, json_group_array(value) as examples "
+        "from truncated_strings group by label"
+    )
+    return {
+        column: list(map(str, json.loads(examples)))
+        for column, examples in conn.execute(sql, params).fetchall()
+    }
+
+
+def create_database(path, num_columns, num_rows):
+    conn = sqlite3.connect(path)
+    # Mostly short text and integers with occasional large text and blob
+    # columns. Values repeat so columns need to read further for examples
+    columns = []
+    for i in range(num_columns):
+        kind = ["text", "integer"][i % 2]
+        if i % 25 == 23:
+            kind = "blob"
+        columns.append(("c{}".format(i), kind))
+    with conn:
+        conn.execute(
+            "create table wide ({})".format(
+                ", ".join("{} {}".format(name, kind) for name, kind in columns)
+            )
+        )
+
+        def value(row, i, kind):
+            if kind == "integer":
+                return row // 50
+            if kind == "blob":
+                return b"\x00" * 1_000
+            if i % 25 == 24:
+                return "Large text value {} ".format(row) * 50
+            return "Value {}".format(row // 10)
+
+        conn.executemany(
+            "insert into wide values ({})".format(", ".join("?" for _ in columns)),
+            (
+                [value(row, i, kind) for i, (_, kind) in enumerate(columns)]
+                for row in range(num_rows)
+            ),
+        )
+    return conn, [name for name, _ in columns]
+
+
+def time_fn(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--columns", type=int, nargs="+", default=[10, 100, 600])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print(
+        "{:>8}  {:>8}  {:>14}  {:>14}  {:>8}".format(
+            "columns", "rows", "streaming", "union", "speedup"
+        )
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for num_columns in args.columns:
+            for num_rows in args.rows:
+                path = os.path.join(
+                    tmpdir, "bench_{}_{}.db".format(num_columns, num_rows)
+                )
+                conn, columns = create_database(path, num_columns, num_rows)
+                streaming, _ = time_fn(
+                    lambda: examples_for_columns(conn, "wide", columns), args.repeat
+                )
+                try:
+                    union, _ = time_fn(
+                        lambda: union_examples_for_columns(conn, "wide", columns),
+                        args.repeat,
+                    )
+                except sqlite3.OperationalError as e:
+                    # e.g. too many terms in compound SELECT
+                    print(
+                        "{:>8}  {:>8}  {:>12.2f}ms  {:>14}  {:>8}".format(
+                            num_columns, num_rows, streaming * 1000, str(e)[:14], "-"
+                        )
+                    )
+                else:
+                    print(
+                        "{:>8}  {:>8}  {:>12.2f}ms  {:>12.2f}ms  {:>7.1f}x".format(
+                            num_columns,
+                            num_rows,
+                            streaming * 1000,
+                            union * 1000,
+                            union / streaming,
+                        )
+                    )
+                conn.close()
+
+
+if __name__ == "__main__":
+    main()
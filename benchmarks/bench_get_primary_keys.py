@@ -0,0 +1,111 @@
+"""
+Benchmark get_primary_keys() against databases with increasing numbers of tables.
+
+    python benchmarks/bench_get_primary_keys.py
+    python benchmarks/bench_get_primary_keys.py --tables 10 100 1000
+"""
+
+from datasette_edit_schema.utils import get_primary_keys
+import argparse
+import sqlite_utils
+import sqlite3
+import tempfile
+import time
+import os
+
+
+def per_table_primary_keys(conn):
+    # The previous implementation, for comparison: several PRAGMA
+    # queries for every table in the database
+    db = sqlite_utils.Database(conn)
+    primary_keys = []
+    for table in db.tables:
+        if "_fts_" in table.name:
+            continue
+        pks = table.pks
+        if pks == ["rowid"]:
+            continue
+        if len(pks) != 1:
+            continue
+        pk = pks[0]
+        pk_type = table.columns_dict[pk]
+        if pk_type in (str, int):
+            primary_keys.append((table.name, pk, pk_type))
+    return primary_keys
+
+
+def create_database(path, num_tables):
+    conn = sqlite3.connect(path)
+    with conn:
+        for i in range(num_tables):
+            # A mix of integer, text, compound and rowid primary keys
+            kind = i % 4
+            if kind == 0:
+                sql = "create table t{} (id integer primary key, name text, n int)"
+            elif kind == 1:
+                sql = "create table t{} (code text primary key, name text)"
+            elif kind == 2:
+                sql = "create table t{} (a int, b int, name text, primary key (a, b))"
+            else:
+                sql = "create table t{} (name text, description text)"
+            conn.execute(sql.format(i))
+    return conn
+
+
+def time_fn(fn, conn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(conn)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--tables", type=int, nargs="+", default=[10, 100, 1_000, 10_000]
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--compare-up-to",
+        type=int,
+        default=1_000,
+        help="Only time the per-table implementation up to this many tables",
+    )
+    args = parser.parse_args()
+    print(
+        "{:>8}  {:>14}  {:>14}  {:>8}".format(
+            "tables", "batched", "per-table", "speedup"
+        )
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for num_tables in args.tables:
+            path = os.path.join(tmpdir, "bench_{}.db".format(num_tables))
+            conn = create_database(path, num_tables)
+            batched, batched_result = time_fn(get_primary_keys, conn, args.repeat)
+            if num_tables > args.compare_up_to:
+                print(
+                    "{:>8}  {:>12.2f}ms  {:>14}  {:>8}".format(
+                        num_tables, batched * 1000, "-", "-"
+                    )
+                )
+            else:
+                per_table, per_table_result = time_fn(
+                    per_table_primary_keys, conn, args.repeat
+                )
+                assert batched_result == per_table_result
+                print(
+                    "{:>8}  {:>12.2f}ms  {:>12.2f}ms  {:>7.1f}x".format(
+                        num_tables,
+                        batched * 1000,
+                        per_table * 1000,
+                        per_table / batched,
+                    )
+                )
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
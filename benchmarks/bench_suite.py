@@ -0,0 +1,299 @@
+"""
+Time every edit-schema route and the expensive utils functions against a
+synthetic database (see generate.py), saving the results as JSON so runs
+can be compared with each other.
+
+    python benchmarks/bench_suite.py --output before.json
+    python benchmarks/bench_suite.py --output after.json --compare before.json
+    python benchmarks/bench_suite.py --preset medium --db /tmp/medium.db
+
+--db reuses an existing database if it has already been generated. The
+routes that change the database run against a fresh copy of it, so every
+run - and the run it is compared with - starts from the same data.
+"""
+
+from datasette.app import Datasette
+from datasette_edit_schema.jobs import get_job_manager
+from datasette_edit_schema.sketches import column_sketches
+from datasette_edit_schema.utils import (
+    analyze_columns,
+    examples_for_columns,
+    get_primary_keys,
+    get_table_columns,
+    potential_foreign_keys,
+    potential_primary_keys,
+    sample_rowids,
+)
+import argparse
+import asyncio
+import datetime
+import generate
+import json
+import os
+import platform
+import re
+import sqlite3
+import statistics
+import tempfile
+import time
+
+# Results this much slower than the comparison run are flagged, unless
+# the difference is too small to be more than noise
+REGRESSION_THRESHOLD = 1.25
+REGRESSION_MIN_MS = 5
+JOB_PATH_RE = re.compile(r"/-/edit-schema/-/jobs/(\d+)$")
+
+
+def is_regression(result, previous):
+    return (
+        result["median_ms"] > previous["median_ms"] * REGRESSION_THRESHOLD
+        and result["median_ms"] - previous["median_ms"] > REGRESSION_MIN_MS
+    )
+
+
+def summarize(durations):
+    return {
+        "runs": len(durations),
+        "min_ms": round(min(durations) * 1000, 3),
+        "median_ms": round(statistics.median(durations) * 1000, 3),
+        "max_ms": round(max(durations) * 1000, 3),
+    }
+
+
+def time_sync(fn, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return summarize(durations)
+
+
+async def time_async(fn, repeat):
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        await fn(i)
+        durations.append(time.perf_counter() - start)
+    return summarize(durations)
+
+
+def bench_utils(path, repeat):
+    conn = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    deep_columns = [
+        {"name": "category_id", "type": int, "is_pk": False},
+        {"name": "code", "type": str, "is_pk": False},
+        {"name": "name", "type": str, "is_pk": False},
+        {"name": "value", "type": float, "is_pk": False},
+    ]
+    wide_columns = [
+        row[0] for row in conn.execute("select name from pragma_table_info('wide')")
+    ]
+    primary_keys = [pair for pair in get_primary_keys(conn) if pair[0] != "deep"]
+    rowids = sample_rowids(conn, "deep")
+    fns = {
+        "get_table_columns": lambda: get_table_columns(conn),
+        "get_primary_keys": lambda: get_primary_keys(conn),
+        "examples_for_columns(wide)": lambda: examples_for_columns(
+            conn, "wide", wide_columns
+        ),
+        "examples_for_columns(deep)": lambda: examples_for_columns(
+            conn, "deep", [c["name"] for c in deep_columns]
+        ),
+        "sample_rowids(deep)": lambda: sample_rowids(conn, "deep"),
+        "column_sketches(deep)": lambda: column_sketches(
+            conn, "deep", ["category_id", "code", "name"]
+        ),
+        "potential_foreign_keys(deep, sample)": lambda: potential_foreign_keys(
+            conn, "deep", ["category_id", "code", "name"], primary_keys, rowids
+        ),
+        "potential_primary_keys(deep)": lambda: potential_primary_keys(
+            conn, "deep", ["category_id", "code", "name"]
+        ),
+        "analyze_columns(deep)": lambda: analyze_columns(
+            conn, "deep", deep_columns, primary_keys
+        ),
+    }
+    results = {}
+    for name, fn in fns.items():
+        results["utils:" + name] = time_sync(fn, repeat)
+        print_result("utils:" + name, results["utils:" + name])
+    conn.close()
+    return results
+
+
+async def bench_routes(path, repeat):
+    ds = Datasette([path])
+    await ds.invoke_startup()
+    database = ds.get_database(os.path.splitext(os.path.basename(path))[0]).name
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    response = await ds.client.get(
+        "/-/edit-schema/{}/categories".format(database), cookies=cookies
+    )
+    cookies["ds_csrftoken"] = response.cookies["ds_csrftoken"]
+
+    def get(path):
+        async def inner(i):
+            response = await ds.client.get(path, cookies=cookies)
+            # The index page redirects if there is only one database
+            assert response.status_code in (200, 302), (path, response.status_code)
+
+        return inner
+
+    def post(path, data):
+        async def inner(i):
+            response = await ds.client.post(
+                path,
+                data=dict(data(i), csrftoken=cookies["ds_csrftoken"]),
+                cookies=cookies,
+            )
+            assert response.status_code == 302, (path, response.status_code)
+            # Schema changes run as background jobs, and the request only
+            # waits for job_wait_ms - so wait for the job to finish too
+            match = JOB_PATH_RE.search(response.headers["location"])
+            if match:
+                manager = get_job_manager(ds)
+                job = manager.get(int(match.group(1)))
+                await manager.wait(job, None)
+                assert job.status == "finished", (path, job.status, job.error)
+
+        return inner
+
+    base = "/-/edit-schema/{}".format(database)
+    routes = {
+        "GET edit_schema_index": get("/-/edit-schema"),
+        "GET edit_schema_database": get(base),
+        "GET edit_schema_database?_stream=1": get(base + "?_stream=1"),
+        "GET edit_schema_database.json": get(base + ".json"),
+        "GET edit_schema_table(t0)": get(base + "/t0"),
+        "GET edit_schema_table(wide)": get(base + "/wide"),
+        "GET edit_schema_table(deep)": get(base + "/deep"),
+        "GET edit_schema_table.json(deep)?_extra=examples,suggestions": get(
+            base + "/deep.json?_extra=examples,suggestions"
+        ),
+        "POST edit_schema_table(deep) add_column": post(
+            base + "/deep",
+            lambda i: {"add_column": "1", "name": "bench_{}".format(i), "type": "TEXT"},
+        ),
+        "POST edit_schema_table(t0) update_columns": post(
+            base + "/t0",
+            # Rename the score column back and forth
+            lambda i: {
+                "action": "update_columns",
+                "confirm": "1",
+                "name.score": "renamed_score",
+                "name.renamed_score": "score",
+            },
+        ),
+        "POST edit_schema_table(deep) add_index": post(
+            base + "/deep",
+            lambda i: (
+                {"add_index": "1", "add_index_column": "name"}
+                if i % 2 == 0
+                else {"drop_index_idx_deep_name": "1"}
+            ),
+        ),
+        "POST edit_schema_create_table": post(
+            base + "/-/create",
+            lambda i: {
+                "table_name": "bench_created_{}_{}".format(i, time.time_ns()),
+                "primary_key_name": "id",
+                "primary_key_type": "INTEGER",
+                "column-name.0": "name",
+                "column-type.0": "TEXT",
+                "column-sort.0": "0",
+            },
+        ),
+    }
+    results = {}
+    for name, fn in routes.items():
+        results["route:" + name] = await time_async(fn, repeat)
+        print_result("route:" + name, results["route:" + name])
+    return results
+
+
+def fresh_copy(path, directory):
+    "Copies the database at path into directory, returns the new path"
+    copy_path = os.path.join(directory, os.path.basename(path))
+    source = sqlite3.connect(path)
+    copy = sqlite3.connect(copy_path)
+    try:
+        source.backup(copy)
+    finally:
+        source.close()
+        copy.close()
+    return copy_path
+
+
+def print_result(name, result, previous=None):
+    line = "{:<70} {:>12.2f}ms".format(name, result["median_ms"])
+    if previous:
+        ratio = result["median_ms"] / max(previous["median_ms"], 0.001)
+        line += "  {:>6.2f}x{}".format(
+            ratio, "  REGRESSION" if is_regression(result, previous) else ""
+        )
+    print(line)
+
+
+def compare(results, previous):
+    print()
+    print("Compared with {}:".format(previous["meta"]["created"]))
+    regressions = 0
+    for name, result in results.items():
+        before = previous["results"].get(name)
+        print_result(name, result, before)
+        if before and is_regression(result, before):
+            regressions += 1
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--preset", choices=sorted(generate.PRESETS), default="small")
+    parser.add_argument("--db", help="Database to use, generated if missing")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="JSON results from an earlier run")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = args.db or os.path.join(tmpdir, "bench.db")
+        shape = generate.PRESETS[args.preset]
+        if not os.path.exists(path):
+            print("Generating {} database at {}".format(args.preset, path))
+            generate.generate(path, **shape)
+        results = bench_utils(path, args.repeat)
+        routes_dir = os.path.join(tmpdir, "routes")
+        os.mkdir(routes_dir)
+        results.update(
+            asyncio.run(bench_routes(fresh_copy(path, routes_dir), args.repeat))
+        )
+    import datasette
+
+    output = {
+        "meta": {
+            "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "preset": args.preset,
+            "shape": shape,
+            "repeat": args.repeat,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "datasette": datasette.__version__,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(output, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            regressions = compare(results, json.load(fp))
+        if regressions:
+            raise SystemExit(
+                "{} result{} slower than {}x".format(
+                    regressions, "" if regressions == 1 else "s", REGRESSION_THRESHOLD
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
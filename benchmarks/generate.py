@@ -0,0 +1,193 @@
+"""
+Generate a synthetic database with the shapes that make this plugin slow:
+many tables, very wide tables, tables with millions of rows, and many views
+and indexes.
+
+    python benchmarks/generate.py bench.db
+    python benchmarks/generate.py bench.db --preset medium
+    python benchmarks/generate.py bench.db --tables 5000 --deep-rows 2000000
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+
+PRESETS = {
+    "small": {
+        "tables": 100,
+        "wide_columns": 200,
+        "wide_rows": 1_000,
+        "deep_rows": 100_000,
+        "views": 50,
+        "indexes": 100,
+    },
+    "medium": {
+        "tables": 1_000,
+        "wide_columns": 600,
+        "wide_rows": 10_000,
+        "deep_rows": 1_000_000,
+        "views": 500,
+        "indexes": 1_000,
+    },
+    "large": {
+        "tables": 10_000,
+        "wide_columns": 1_000,
+        "wide_rows": 50_000,
+        "deep_rows": 5_000_000,
+        "views": 2_000,
+        "indexes": 5_000,
+    },
+}
+
+# Rows inserted per executemany() call
+BATCH_SIZE = 10_000
+CATEGORIES = 100
+
+
+def batched(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate(path, tables, wide_columns, wide_rows, deep_rows, views, indexes, seed=0):
+    """
+    Creates these tables:
+
+    - categories: a small lookup table with an integer primary key
+    - t0 ... tN: many small tables, each with a foreign key candidate
+      pointing at categories and at the previous table
+    - wide: wide_columns columns of mixed types, including long text and
+      blobs, with wide_rows rows
+    - deep: deep_rows rows with an integer primary key, a foreign key
+      candidate, a unique code, a non-unique name and a float
+
+    Plus views over the small tables and indexes on their columns.
+    """
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = wal")
+    with conn:
+        conn.execute("create table categories (id integer primary key, name text)")
+        conn.executemany(
+            "insert into categories values (?, ?)",
+            [(i, "Category {}".format(i)) for i in range(1, CATEGORIES + 1)],
+        )
+        for i in range(tables):
+            conn.execute(
+                "create table t{} (id integer primary key, name text, code text, "
+                "category_id integer, previous_id integer, score real)".format(i)
+            )
+            conn.executemany(
+                "insert into t{} values (?, ?, ?, ?, ?, ?)".format(i),
+                [
+                    (
+                        j,
+                        "Name {}".format(rng.randint(1, 5)),
+                        "t{}-{}".format(i, j),
+                        rng.randint(1, CATEGORIES),
+                        j if i else None,
+                        rng.random(),
+                    )
+                    for j in range(1, 11)
+                ],
+            )
+        for i in range(views):
+            conn.execute(
+                "create view v{} as select t{}.name, categories.name as category "
+                "from t{} join categories on categories.id = t{}.category_id".format(
+                    i, i % max(tables, 1), i % max(tables, 1), i % max(tables, 1)
+                )
+            )
+        for i in range(min(indexes, tables * 3)):
+            table = i % tables
+            column = ["name", "code", "category_id"][(i // tables) % 3]
+            conn.execute(
+                "create index idx_t{}_{} on t{} ({})".format(
+                    table, column, table, column
+                )
+            )
+        # Wide table: a repeating pattern of column types
+        kinds = ["text", "integer", "real", "text", "integer"]
+        columns = []
+        for i in range(wide_columns):
+            kind = kinds[i % len(kinds)]
+            if i % 50 == 48:
+                kind = "blob"
+            elif i % 50 == 49:
+                kind = "long"
+            columns.append(kind)
+        conn.execute(
+            "create table wide (id integer primary key, {})".format(
+                ", ".join(
+                    "c{} {}".format(i, "text" if kind == "long" else kind)
+                    for i, kind in enumerate(columns)
+                )
+            )
+        )
+
+        def wide_value(row, kind):
+            if kind == "integer":
+                return row // 7
+            if kind == "real":
+                return row / 3
+            if kind == "blob":
+                return b"\x00" * 1_000
+            if kind == "long":
+                return "Long text {} ".format(row) * 100
+            return "Value {}".format(row // 3)
+
+        for batch in batched(
+            [row] + [wide_value(row, kind) for kind in columns]
+            for row in range(wide_rows)
+        ):
+            conn.executemany(
+                "insert into wide values ({})".format(
+                    ", ".join("?" for _ in range(wide_columns + 1))
+                ),
+                batch,
+            )
+        # Deep table
+        conn.execute(
+            "create table deep (id integer primary key, category_id integer, "
+            "code text, name text, value real)"
+        )
+        for batch in batched(
+            (
+                i,
+                rng.randint(1, CATEGORIES),
+                "code-{}".format(i),
+                "Name {}".format(rng.randint(1, 1_000)),
+                rng.random(),
+            )
+            for i in range(1, deep_rows + 1)
+        ):
+            conn.executemany("insert into deep values (?, ?, ?, ?, ?)", batch)
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="small")
+    for name in PRESETS["small"]:
+        parser.add_argument("--" + name.replace("_", "-"), type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    shape = dict(PRESETS[args.preset])
+    for name in shape:
+        if getattr(args, name) is not None:
+            shape[name] = getattr(args, name)
+    generate(args.path, seed=args.seed, **shape)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,74 @@
 from datasette import hookimpl
 from datasette.events import CreateTableEvent, AlterTableEvent, DropTableEvent
 from datasette.utils.asgi import Response, NotFound, Forbidden
-from datasette.utils import sqlite3, tilde_decode, tilde_encode
+from datasette.utils import (
+    path_with_replaced_args,
+    sqlite3,
+    tilde_decode,
+    tilde_encode,
+)
 from urllib.parse import quote_plus, unquote_plus
+import asyncio
+import bisect
+import json
 import sqlite_utils
-import textwrap
+import sys
+from .alter import (
+    apply_column_changes,
+    is_rowid_table,
+    plan_column_changes,
+    sqlite_version,
+    transform_table,
+)
+from .advisor import get_workload, recommend_indexes, record_workload
+from .batch import BatchError, apply_plan, plan_operations
+from .bulk import changed_foreign_keys, check_foreign_keys, set_foreign_keys
+from .catalog import get_catalog, get_examples_cache, get_sketch_cache
+from .indexes import (
+    IndexDefinitionError,
+    IndexTerm,
+    check_duplicates,
+    create_index_sql,
+    parse_terms,
+)
+from .jobs import JOB_WAIT_MS, JobCancelled, get_job_manager
+from .online import (
+    ONLINE_REBUILD_BATCH_SIZE,
+    ONLINE_REBUILD_MIN_ROWS,
+    OnlineRebuild,
+    rebuild_table_online,
+)
+from .execution import (
+    execute_isolated,
+    execute_read,
+    execute_write,
+    get_write_queue_stats,
+)
+from .reclaim import (
+    RECLAIM_CHECK_INTERVAL_SECONDS,
+    RECLAIM_STRATEGIES,
+    ReclaimScheduler,
+    freelist_stats,
+    parse_window,
+    reclaim_space,
+    vacuum,
+)
+from .timing import Timer, phase
+from .suggestions import (
+    PRECOMPUTE_INTERVAL_SECONDS,
+    PRECOMPUTE_TIME_LIMIT_MS,
+    SuggestionsWorker,
+    decode_suggestions,
+    get_stored_suggestions,
+    get_suggestions_worker,
+)
 from .utils import (
-    examples_for_columns,
-    get_primary_keys,
-    potential_foreign_keys,
-    potential_primary_keys,
+    FOREIGN_KEY_DETECTION_LIMIT,
+    Deadline,
+    analyze_columns,
+    get_foreign_keys,
+    limited_row_count,
+    missing_foreign_key_values,
 )
 
 try:
@@ -17,8 +76,147 @@ try:
 except ImportError:  # Pre Datasette 1.0a8
     events = None
 
-# Don't attempt to detect foreign keys on tables larger than this:
-FOREIGN_KEY_DETECTION_LIMIT = 10_000
+# Number of tables to show per page on the database page
+DATABASE_PAGE_SIZE = 100
+MAX_DATABASE_PAGE_SIZE = 1_000
+STREAMED_TABLES_MARKER = "<!-- edit-schema-tables -->"
+
+# Time budget for the example and suggestion queries run for one request,
+# can be changed using the analysis_time_limit_ms plugin setting
+ANALYSIS_TIME_LIMIT_MS = 2_000
+
+
+def plugin_setting(datasette, name, default):
+    config = datasette.plugin_config("datasette-edit-schema") or {}
+    return config.get(name, default)
+
+
+def index_advisor_enabled(datasette):
+    return bool(plugin_setting(datasette, "index_advisor", False))
+
+
+async def suggested_indexes(datasette, database, table):
+    """
+    Indexes recommended by the index advisor, see advisor.py. Cached until
+    the schema changes or a new statement is recorded for the database.
+    """
+    workload = get_workload(datasette)
+    # Read before the statements, so they are never older than the key
+    generation = workload.generation(database.name)
+    statements = workload.statements(database.name)
+    catalog = get_catalog(datasette)
+    return await execute_read(
+        database,
+        lambda conn: catalog.get(
+            conn,
+            database,
+            ("suggested_indexes", table, generation),
+            lambda conn: recommend_indexes(conn, table, statements),
+        ),
+    )
+
+
+async def use_online_rebuild(datasette, database, table):
+    "Should this table be copied in batches rather than in one transaction?"
+    min_rows = plugin_setting(
+        datasette, "online_rebuild_min_rows", ONLINE_REBUILD_MIN_ROWS
+    )
+    if min_rows is None:
+        return False
+
+    def check(conn):
+        return (
+            is_rowid_table(conn, table)
+            and limited_row_count(conn, table, min_rows) >= min_rows
+        )
+
+    return await execute_read(database, check)
+
+
+def reclaim_settings_error(datasette):
+    "Describes what is wrong with reclaim_strategy or reclaim_window, if anything"
+    strategy = plugin_setting(datasette, "reclaim_strategy", "vacuum")
+    if strategy not in RECLAIM_STRATEGIES:
+        return "Invalid reclaim_strategy {!r}, should be one of {}".format(
+            strategy, ", ".join(RECLAIM_STRATEGIES)
+        )
+    window = plugin_setting(datasette, "reclaim_window", None)
+    if window is not None:
+        try:
+            parse_window(window)
+        except (AttributeError, TypeError, ValueError):
+            return "Invalid reclaim_window {!r}, should be like '02:00-05:00'".format(
+                window
+            )
+    return None
+
+
+def reclaim_strategy(datasette):
+    """
+    How to reclaim the space left behind by a dropped table, see reclaim.py.
+    Falls back to "vacuum" if the settings are invalid.
+    """
+    if reclaim_settings_error(datasette):
+        return "vacuum"
+    return plugin_setting(datasette, "reclaim_strategy", "vacuum")
+
+
+def analysis_deadline(datasette):
+    return Deadline(
+        plugin_setting(datasette, "analysis_time_limit_ms", ANALYSIS_TIME_LIMIT_MS)
+    )
+
+
+@hookimpl
+def startup(datasette):
+    background = []
+    # Examples and suggestions can optionally be calculated in the background
+    if plugin_setting(datasette, "precompute_suggestions", False):
+        worker = SuggestionsWorker(
+            datasette,
+            interval=plugin_setting(
+                datasette, "precompute_interval_seconds", PRECOMPUTE_INTERVAL_SECONDS
+            ),
+            time_limit_ms=plugin_setting(
+                datasette, "precompute_time_limit_ms", PRECOMPUTE_TIME_LIMIT_MS
+            ),
+        )
+        datasette._edit_schema_suggestions_worker = worker
+        background.append(worker)
+    # Space left by dropped tables can be reclaimed later on
+    error = reclaim_settings_error(datasette)
+    if error:
+        print(
+            'datasette-edit-schema: {}, using "vacuum" instead'.format(error),
+            file=sys.stderr,
+        )
+    if reclaim_strategy(datasette) == "deferred":
+        scheduler = ReclaimScheduler(
+            datasette,
+            window=plugin_setting(datasette, "reclaim_window", None),
+            interval=plugin_setting(
+                datasette,
+                "reclaim_check_interval_seconds",
+                RECLAIM_CHECK_INTERVAL_SECONDS,
+            ),
+        )
+        datasette._edit_schema_reclaim_scheduler = scheduler
+        background.append(scheduler)
+    if not background:
+        return
+
+    async def inner():
+        for task in background:
+            asyncio.get_running_loop().create_task(task.run())
+
+    return inner
+
+
+@hookimpl
+def prepare_connection(conn, database, datasette):
+    # Recording the workload for the index advisor
+    if index_advisor_enabled(datasette):
+        record_workload(conn, database, get_workload(datasette))
 
 
 @hookimpl
@@ -75,6 +273,17 @@ async def can_alter_table(datasette, actor, database, table):
     return False
 
 
+async def can_see_job(datasette, actor, job):
+    "The actor who started the job, or anyone allowed to have started it"
+    if actor and job.actor and actor.get("id") == job.actor.get("id"):
+        return True
+    if job.table is None:
+        return await datasette.permission_allowed(
+            actor, "edit-schema", resource=job.database_name, default=False
+        )
+    return await can_alter_table(datasette, actor, job.database_name, job.table)
+
+
 async def can_rename_table(datasette, actor, database, table):
     if not await can_drop_table(datasette, actor, database, table):
         return False
@@ -118,9 +327,25 @@ def database_actions(datasette, actor, database):
 def register_routes():
     return [
         (r"^/-/edit-schema$", edit_schema_index),
+        (r"^/-/edit-schema/-/stats$", edit_schema_stats),
+        (r"^/-/edit-schema/-/jobs/(?P<job_id>\d+)\.json$", edit_schema_job_json),
+        (r"^/-/edit-schema/-/jobs/(?P<job_id>\d+)$", edit_schema_job),
+        (r"^/-/edit-schema/(?P<database>[^/]+)\.json$", edit_schema_database_json),
         (r"^/-/edit-schema/(?P<database>[^/]+)$", edit_schema_database),
         (r"^/-/edit-schema/(?P<database>[^/]+)/-/create$", edit_schema_create_table),
+        (
+            r"^/-/edit-schema/(?P<database>[^/]+)/-/foreign-keys$",
+            edit_schema_foreign_keys,
+        ),
+        (
+            r"^/-/edit-schema/(?P<database>[^/]+)/(?P<table>[^/]+)\.json$",
+            edit_schema_table_json,
+        ),
         (r"^/-/edit-schema/(?P<database>[^/]+)/(?P<table>[^/]+)$", edit_schema_table),
+        (
+            r"^/-/edit-schema/(?P<database>[^/]+)/(?P<table>[^/]+)/-/batch$",
+            edit_schema_table_batch,
+        ),
     ]
 
 
@@ -139,6 +364,27 @@ TYPE_NAMES = {
 }
 
 
+def describe_column_plan(plan):
+    "Human readable list of the steps in a ColumnPlan"
+    steps = ["Delete column {}".format(column) for column in sorted(plan.drop)]
+    steps.extend(
+        "Rename column {} to {}".format(old, new) for old, new in plan.rename.items()
+    )
+    steps.extend(
+        "Change type of column {} from {} to {}".format(
+            column, TYPE_NAMES[TYPES[old_type]], TYPE_NAMES[TYPES[new_type]]
+        )
+        for column, (old_type, new_type) in plan.types.items()
+    )
+    if plan.column_order is not None:
+        steps.append(
+            "Change the column order to {}".format(
+                ", ".join(plan.rename.get(c, c) for c in plan.column_order)
+            )
+        )
+    return steps
+
+
 def get_databases(datasette):
     return [
         db
@@ -147,6 +393,53 @@ def get_databases(datasette):
     ]
 
 
+class StreamingResponse(Response):
+    """
+    A Response with a body sent as chunks from an async iterator of strings.
+    Cookies are not sent, so pages streamed with it should not show messages.
+    """
+
+    def __init__(self, chunks, status=200, headers=None):
+        super().__init__(
+            None,
+            status=status,
+            headers=headers,
+            content_type="text/html; charset=utf-8",
+        )
+        self.chunks = chunks
+
+    async def asgi_send(self, send):
+        headers = dict(self.headers)
+        headers["content-type"] = self.content_type
+        raw_headers = [
+            [key.encode("utf-8"), value.encode("utf-8")]
+            for key, value in headers.items()
+        ]
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status,
+                "headers": raw_headers,
+            }
+        )
+        async for chunk in self.chunks:
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": chunk.encode("utf-8"),
+                    "more_body": True,
+                }
+            )
+        await send({"type": "http.response.body", "body": b""})
+
+
+def get_database_or_404(datasette, database_name):
+    try:
+        return [db for db in get_databases(datasette) if db.name == database_name][0]
+    except IndexError:
+        raise NotFound("Database not found")
+
+
 async def check_permissions(datasette, request, database):
     if not await datasette.permission_allowed(
         request.actor, "edit-schema", resource=database, default=False
@@ -154,7 +447,7 @@ async def check_permissions(datasette, request, database):
         raise Forbidden("Permission denied for edit-schema")
 
 
-async def edit_schema_index(datasette, request):
+async def get_allowed_databases(datasette, request):
     database_names = [db.name for db in get_databases(datasette)]
     # Check permissions for each one
     allowed_databases = [
@@ -166,6 +459,11 @@ async def edit_schema_index(datasette, request):
     ]
     if not allowed_databases:
         raise Forbidden("Permission denied for edit-schema")
+    return allowed_databases
+
+
+async def edit_schema_index(datasette, request):
+    allowed_databases = await get_allowed_databases(datasette, request)
 
     if len(allowed_databases) == 1:
         return Response.redirect(
@@ -183,46 +481,508 @@ async def edit_schema_index(datasette, request):
     )
 
 
+async def edit_schema_stats(datasette, request):
+    allowed_databases = await get_allowed_databases(datasette, request)
+    scheduler = getattr(datasette, "_edit_schema_reclaim_scheduler", None)
+    freelist = {}
+    for name in allowed_databases:
+        freelist[name] = await execute_read(datasette.databases[name], freelist_stats)
+        freelist[name]["reclaim_pending"] = bool(
+            scheduler and name in scheduler.pending
+        )
+    return Response.json(
+        {
+            "write_queue": get_write_queue_stats(datasette).to_dict(allowed_databases),
+            "examples_cache": get_examples_cache(datasette).to_dict(allowed_databases),
+            "sketch_cache": get_sketch_cache(datasette).to_dict(allowed_databases),
+            "freelist": freelist,
+            "workload": get_workload(datasette).to_dict(allowed_databases),
+            "jobs": [
+                job.to_dict()
+                for job in get_job_manager(datasette).jobs.values()
+                if job.database_name in allowed_databases
+            ],
+        }
+    )
+
+
+async def get_job_or_404(datasette, request):
+    job = get_job_manager(datasette).get(int(request.url_vars["job_id"]))
+    if job is None:
+        raise NotFound("Job not found")
+    if not await can_see_job(datasette, request.actor, job):
+        raise Forbidden("Permission denied for this job")
+    return job
+
+
+async def edit_schema_job_json(datasette, request):
+    job = await get_job_or_404(datasette, request)
+    return Response.json(dict(job.to_dict(), redirect=job.redirect))
+
+
+async def edit_schema_job(datasette, request):
+    job = await get_job_or_404(datasette, request)
+    if request.method == "POST":
+        formdata = await request.post_vars()
+        if formdata.get("cancel") and not job.done:
+            job.cancel()
+            datasette.add_message(
+                request, "Cancelling {}".format(job.description.lower())
+            )
+        return Response.redirect(job_path(job))
+    return Response.html(
+        await datasette.render_template(
+            "edit_schema_job.html",
+            {
+                "job": job,
+                "database": get_database_or_404(datasette, job.database_name),
+                "message_classes": {
+                    datasette.INFO: "info",
+                    datasette.WARNING: "warning",
+                    datasette.ERROR: "error",
+                },
+            },
+            request=request,
+        )
+    )
+
+
+async def list_table_names(database, request):
+    "Returns (table_names, size) for the database page, respecting ?table="
+    just_these_tables = set(request.args.getlist("table"))
+    hidden_tables = set(await database.hidden_table_names())
+    table_names = sorted(
+        table_name
+        for table_name in await database.table_names()
+        if table_name not in hidden_tables
+        and (not just_these_tables or table_name in just_these_tables)
+    )
+    try:
+        size = int(request.args.get("_size") or DATABASE_PAGE_SIZE)
+    except ValueError:
+        size = DATABASE_PAGE_SIZE
+    size = max(1, min(size, MAX_DATABASE_PAGE_SIZE))
+    return table_names, size
+
+
+def paginate_table_names(request, table_names, size):
+    "Returns (page, next) - cursor based, ?_next= is the last table seen"
+    next_ = request.args.get("_next")
+    if next_:
+        table_names = table_names[bisect.bisect_right(table_names, next_) :]
+    if len(table_names) > size:
+        return table_names[:size], table_names[size - 1]
+    return table_names, None
+
+
 async def edit_schema_database(request, datasette):
-    databases = get_databases(datasette)
     database_name = request.url_vars["database"]
     await check_permissions(datasette, request, database_name)
-    just_these_tables = set(request.args.getlist("table"))
-    try:
-        database = [db for db in databases if db.name == database_name][0]
-    except IndexError:
-        raise NotFound("Database not found")
-    tables = []
-    hidden_tables = set(await database.hidden_table_names())
-    for table_name in await database.table_names():
-        if just_these_tables and table_name not in just_these_tables:
-            continue
-        if table_name in hidden_tables:
-            continue
+    database = get_database_or_404(datasette, database_name)
+    table_names, size = await list_table_names(database, request)
+    catalog = get_catalog(datasette)
+
+    async def tables_for(names):
+        # Columns for a batch of tables, fetched in a single query
+        table_columns = await execute_read(
+            database, lambda conn: catalog.table_columns(conn, database, names)
+        )
+        return [
+            {"name": name, "columns": table_columns.get(name) or []} for name in names
+        ]
 
-        def get_columns(conn):
-            return [
-                {"name": column, "type": dtype}
-                for column, dtype in sqlite_utils.Database(conn)[
-                    table_name
-                ].columns_dict.items()
-            ]
+    context = {
+        "database": database,
+        "tilde_encode": tilde_encode,
+    }
+
+    if request.args.get("_stream"):
+        # Render the page around the list of tables up front, then send the
+        # tables themselves in batches of size
+        head, tail = (
+            await datasette.render_template(
+                "edit_schema_database.html",
+                dict(context, streaming=True),
+                request=request,
+            )
+        ).split(STREAMED_TABLES_MARKER)
+
+        async def chunks():
+            yield head
+            for i in range(0, len(table_names), size):
+                yield await datasette.render_template(
+                    "_edit_schema_database_tables.html",
+                    dict(context, tables=await tables_for(table_names[i : i + size])),
+                    request=request,
+                )
+            yield tail
 
-        columns = await database.execute_write_fn(get_columns, block=True)
-        tables.append({"name": table_name, "columns": columns})
+        return StreamingResponse(chunks())
+
+    table_names, next_ = paginate_table_names(request, table_names, size)
+    next_url = None
+    if next_:
+        next_url = path_with_replaced_args(request, {"_next": next_})
     return Response.html(
         await datasette.render_template(
             "edit_schema_database.html",
+            dict(context, tables=await tables_for(table_names), next_url=next_url),
+            request=request,
+        )
+    )
+
+
+def table_info_json(table_info):
+    return {
+        "columns": [
+            {
+                "name": column["name"],
+                "type": TYPES[column["type"]],
+                "is_pk": column["is_pk"],
+            }
+            for column in table_info.columns
+        ],
+        "primary_keys": table_info.pks,
+        "foreign_keys": [
+            {
+                "column": fk.column,
+                "other_table": fk.other_table,
+                "other_column": fk.other_column,
+            }
+            for fk in table_info.foreign_keys
+        ],
+        "indexes": [
+            {
+                "name": index.name,
+                "columns": index.columns,
+                "unique": bool(index.unique),
+                "partial": bool(index.partial),
+                "sql": table_info.index_sql.get(index.name),
+            }
+            for index in table_info.indexes
+        ],
+        "schema": table_info.full_schema,
+    }
+
+
+def get_extras(request):
+    "?_extra=a&_extra=b or ?_extra=a,b"
+    extras = set()
+    for value in request.args.getlist("_extra"):
+        extras.update(extra.strip() for extra in value.split(",") if extra.strip())
+    return extras
+
+
+async def edit_schema_database_json(request, datasette):
+    database_name = request.url_vars["database"]
+    await check_permissions(datasette, request, database_name)
+    database = get_database_or_404(datasette, database_name)
+    table_names, size = await list_table_names(database, request)
+    table_names, next_ = paginate_table_names(request, table_names, size)
+    catalog = get_catalog(datasette)
+    table_infos = await execute_read(
+        database,
+        lambda conn: [catalog.table(conn, database, name) for name in table_names],
+    )
+    return Response.json(
+        {
+            "database": database_name,
+            "tables": [
+                dict({"name": name}, **table_info_json(table_info))
+                for name, table_info in zip(table_names, table_infos)
+            ],
+            "next": next_,
+            "next_url": (
+                datasette.absolute_url(
+                    request, path_with_replaced_args(request, {"_next": next_})
+                )
+                if next_
+                else None
+            ),
+        }
+    )
+
+
+def foreign_keys_from_form(formdata):
+    """
+    {table: [(column, other_table, other_column)]} from the fields of the
+    database foreign keys form, named fk.{table}.{column} using tilde
+    encoding. Every table with a field on the form is included, even if
+    all of its foreign keys have been removed.
+    """
+    foreign_keys = {}
+    for key, value in formdata.items():
+        if not key.startswith("fk."):
+            continue
+        table, column = [tilde_decode(part) for part in key[3:].split(".")]
+        fks = foreign_keys.setdefault(table, [])
+        if value.strip():
+            other_table, other_column = [tilde_decode(s) for s in value.split(".")]
+            fks.append((column, other_table, other_column))
+    return foreign_keys
+
+
+def foreign_keys_from_json(data):
+    "The same as foreign_keys_from_form(), for the JSON API"
+    foreign_keys = data.get("foreign_keys") if isinstance(data, dict) else None
+    if not isinstance(foreign_keys, dict):
+        raise ValueError("foreign_keys must be an object")
+    try:
+        return {
+            table: [(fk["column"], fk["other_table"], fk["other_column"]) for fk in fks]
+            for table, fks in foreign_keys.items()
+        }
+    except (KeyError, TypeError):
+        raise ValueError(
+            "Each foreign key needs a column, other_table and other_column"
+        )
+
+
+async def edit_schema_foreign_keys(request, datasette):
+    database_name = request.url_vars["database"]
+    await check_permissions(datasette, request, database_name)
+    database = get_database_or_404(datasette, database_name)
+    is_json = request.headers.get("content-type", "").startswith("application/json")
+
+    if request.method == "POST":
+        if is_json:
+            try:
+                data = json.loads(await request.post_body())
+                foreign_keys = foreign_keys_from_json(data)
+            except ValueError as e:
+                return Response.json({"ok": False, "errors": [str(e)]}, status=400)
+        else:
+            data = {}
+            foreign_keys = foreign_keys_from_form(await request.post_vars())
+
+        def check(conn):
+            errors = check_foreign_keys(conn, foreign_keys)
+            if errors:
+                return errors, None
+            return [], list(changed_foreign_keys(conn, foreign_keys))
+
+        errors, changed = await execute_read(database, check)
+        if errors:
+            if is_json:
+                return Response.json({"ok": False, "errors": errors}, status=400)
+            for error in errors:
+                datasette.add_message(request, error, datasette.ERROR)
+            return Response.redirect(request.path)
+        if not changed or data.get("dry_run"):
+            if is_json:
+                return Response.json({"ok": True, "tables": changed})
+            datasette.add_message(
+                request, "No changes to foreign keys", datasette.WARNING
+            )
+            return Response.redirect(request.path)
+
+        async def work(job):
+            before_schemas = {
+                table: await get_table_schema(datasette, database, table)
+                for table in changed
+            }
+            violations = await execute_write(
+                datasette,
+                database,
+                job.wrap(lambda conn: set_foreign_keys(conn, foreign_keys, job=job)),
+            )
+            for table, before_schema in before_schemas.items():
+                await datasette.track_event(
+                    AlterTableEvent(
+                        actor=request.actor,
+                        database=database.name,
+                        table=table,
+                        before_schema=before_schema,
+                        after_schema=await get_table_schema(datasette, database, table),
+                    )
+                )
+            job.add_message(
+                "Foreign keys updated for {} table{}: {}".format(
+                    len(changed), "" if len(changed) == 1 else "s", ", ".join(changed)
+                ),
+                datasette.INFO,
+            )
+            for (table, column, other_table, other_column), missing in sorted(
+                violations.items()
+            ):
+                job.add_message(
+                    "{:,} row{} in {}.{} ha{} no matching value in {}.{}".format(
+                        missing,
+                        "" if missing == 1 else "s",
+                        table,
+                        column,
+                        "s" if missing == 1 else "ve",
+                        other_table,
+                        other_column,
+                    ),
+                    datasette.WARNING,
+                )
+
+        redirect = request.path
+        if not is_json:
+            return await run_job(
+                request,
+                datasette,
+                database,
+                None,
+                "Updating foreign keys",
+                work,
+                redirect=redirect,
+                track=False,
+            )
+        job = start_job(
+            request,
+            datasette,
+            database,
+            None,
+            "Updating foreign keys",
+            work,
+            redirect,
+            track=False,
+        )
+        await wait_for_job(datasette, job)
+        return Response.json(
+            {
+                "ok": job.status in ("running", "finished"),
+                "tables": changed,
+                "job": job.to_dict(),
+                "job_url": datasette.absolute_url(
+                    request, datasette.urls.path(job_path(job) + ".json")
+                ),
+            }
+        )
+
+    table_names, size = await list_table_names(database, request)
+    table_names, next_ = paginate_table_names(request, table_names, size)
+    catalog = get_catalog(datasette)
+    table_columns, existing_fks, primary_keys = await execute_read(
+        database,
+        lambda conn: (
+            catalog.table_columns(conn, database, table_names),
+            get_foreign_keys(conn, table_names),
+            catalog.primary_keys(conn, database),
+        ),
+    )
+    tables = []
+    for table in table_names:
+        fks = existing_fks.get(table, {})
+        columns = []
+        for column in table_columns.get(table) or []:
+            fk = fks.get(column["name"])
+            options = [
+                {
+                    "name": "{}.{}".format(other_table, other_column),
+                    "value": "{}.{}".format(
+                        tilde_encode(other_table), tilde_encode(other_column)
+                    ),
+                    "selected": fk == (other_table, other_column),
+                }
+                for other_table, other_column, pk_type in primary_keys
+                if other_table != table
+                and (pk_type is column["type"] or fk == (other_table, other_column))
+            ]
+            if fk and not any(option["selected"] for option in options):
+                # e.g. a foreign key to a column that is not a primary key,
+                # which would otherwise be removed when the form is submitted
+                options.insert(
+                    0,
+                    {
+                        "name": "{}.{} (current)".format(*fk),
+                        "value": "{}.{}".format(
+                            tilde_encode(fk[0]), tilde_encode(fk[1])
+                        ),
+                        "selected": True,
+                    },
+                )
+            columns.append(
+                {
+                    "name": column["name"],
+                    "field": "fk.{}.{}".format(
+                        tilde_encode(table), tilde_encode(column["name"])
+                    ),
+                    "options": options,
+                }
+            )
+        tables.append({"name": table, "columns": columns})
+    return Response.html(
+        await datasette.render_template(
+            "edit_schema_foreign_keys.html",
             {
                 "database": database,
                 "tables": tables,
                 "tilde_encode": tilde_encode,
+                "next_url": (
+                    path_with_replaced_args(request, {"_next": next_})
+                    if next_
+                    else None
+                ),
             },
             request=request,
         )
     )
 
 
+async def edit_schema_table_json(request, datasette):
+    timer = Timer()
+    with timer.phase("permissions"):
+        database, table = await get_table_or_404(datasette, request)
+    extras = get_extras(request)
+    catalog = get_catalog(datasette)
+    with timer.phase("introspection"):
+        table_info, primary_keys = await execute_read(
+            database,
+            lambda conn: (
+                catalog.table(conn, database, table),
+                catalog.primary_keys(conn, database),
+            ),
+        )
+    data = dict(
+        {"database": database.name, "table": table}, **table_info_json(table_info)
+    )
+    # More expensive sections are only calculated if requested
+    if "examples" in extras or "suggestions" in extras:
+        results = await table_analysis(
+            datasette,
+            database,
+            table,
+            table_info,
+            primary_keys,
+            include_suggestions="suggestions" in extras,
+            timer=timer,
+        )
+    if "indexes" in extras:
+        with timer.phase("index_advisor"):
+            data["suggested_indexes"] = await suggested_indexes(
+                datasette, database, table
+            )
+    if "examples" in extras:
+        data["examples"] = results["examples"]
+        data["examples_complete"] = results["examples_complete"]
+    if "suggestions" in extras:
+        potential_fks = results["potential_fks"]
+        analysis = results["analysis"]
+        data["suggestions"] = {
+            "foreign_keys": {
+                column: [
+                    {"other_table": other_table, "other_column": other_column}
+                    for other_table, other_column in suggestions
+                ]
+                for column, suggestions in potential_fks.items()
+                if suggestions
+            },
+            "primary_keys": results["potential_pks"],
+            "analyzed": analysis is not None,
+            "complete": analysis is None or analysis["complete"],
+            "computing": results["computing"],
+            "sample": (
+                {key: analysis[key] for key in analysis if key != "complete"}
+                if analysis and analysis["sample_size"] is not None
+                else None
+            ),
+        }
+    return Response.json(data, headers={"Server-Timing": timer.server_timing()})
+
+
 async def edit_schema_create_table(request, datasette):
     database_name = request.url_vars["database"]
     if not await can_create_table(datasette, request.actor, database_name):
@@ -272,7 +1032,7 @@ async def edit_schema_create_table(request, datasette):
             except Exception as e:
                 return None, str(e)
 
-        schema, error = await db.execute_write_fn(create_the_table, block=True)
+        schema, error = await execute_write(datasette, db, create_the_table)
 
         if error:
             datasette.add_message(request, str(error), datasette.ERROR)
@@ -307,33 +1067,123 @@ async def edit_schema_create_table(request, datasette):
     )
 
 
-async def edit_schema_table(request, datasette):
+async def get_table_schema(datasette, database, table):
+    "The table's CREATE TABLE statement, or None if it does not exist"
+    catalog = get_catalog(datasette)
+
+    def get_schema(conn):
+        table_info = catalog.table(conn, database, table)
+        if table_info is None:
+            return None
+        return table_info.schema
+
+    return await execute_read(database, get_schema)
+
+
+def job_path(job):
+    return "/-/edit-schema/-/jobs/{}".format(job.id)
+
+
+def show_job_messages(request, datasette, job):
+    "Shows a finished job's messages on the next page the user sees"
+    if job.status == "cancelled":
+        datasette.add_message(
+            request, "{} was cancelled".format(job.description), datasette.WARNING
+        )
+    elif job.status == "failed":
+        datasette.add_message(request, job.error, datasette.ERROR)
+    for message, type in job.messages:
+        datasette.add_message(request, message, type)
+
+
+def start_job(
+    request, datasette, database, table, description, work, redirect, track=True
+):
+    """
+    Starts running work(job) as a background job and returns the Job.
+
+    If track is True an alter-table event is tracked if the job changes
+    the table's schema.
+    """
+
+    async def tracked_work(job):
+        before_schema = await get_table_schema(datasette, database, table)
+        await work(job)
+        if not track:
+            return
+        after_schema = await get_table_schema(datasette, database, table)
+        if after_schema is not None and after_schema != before_schema:
+            await datasette.track_event(
+                AlterTableEvent(
+                    actor=request.actor,
+                    database=database.name,
+                    table=table,
+                    before_schema=before_schema,
+                    after_schema=after_schema,
+                )
+            )
+
+    job = get_job_manager(datasette).start(
+        database.name, table, description, tracked_work, actor=request.actor
+    )
+    job.redirect = redirect
+    return job
+
+
+async def wait_for_job(datasette, job):
+    "Waits up to job_wait_ms for the job, returns True if it has finished"
+    wait_ms = plugin_setting(datasette, "job_wait_ms", JOB_WAIT_MS)
+    return await get_job_manager(datasette).wait(job, wait_ms / 1000)
+
+
+async def run_job(
+    request, datasette, database, table, description, work, redirect, track=True
+):
+    """
+    Runs work(job) as a background job, see start_job(). If it finishes
+    within job_wait_ms the user is sent to redirect as usual, otherwise to
+    the job's page.
+    """
+    job = start_job(
+        request, datasette, database, table, description, work, redirect, track
+    )
+    if await wait_for_job(datasette, job):
+        show_job_messages(request, datasette, job)
+        return Response.redirect(redirect)
+    datasette.add_message(
+        request, "{} is running in the background".format(description)
+    )
+    return Response.redirect(job_path(job))
+
+
+async def get_table_or_404(datasette, request):
+    "Returns (database, table) after checking alter-table permission"
     table = tilde_decode(request.url_vars["table"])
-    databases = get_databases(datasette)
     database_name = request.url_vars["database"]
 
     if not await can_alter_table(datasette, request.actor, database_name, table):
         raise Forbidden("Permission denied for alter-table")
 
-    try:
-        database = [db for db in databases if db.name == database_name][0]
-    except IndexError:
-        raise NotFound("Database not found")
+    database = get_database_or_404(datasette, database_name)
     if not await database.table_exists(table):
         raise NotFound("Table not found")
+    return database, table
 
-    if request.method == "POST":
 
-        def get_schema(conn):
-            table_obj = sqlite_utils.Database(conn)[table]
-            if not table_obj.exists():
-                return None
-            return table_obj.schema
+async def edit_schema_table(request, datasette):
+    # ?_debug=1 lists the SQL statements that ran at the bottom of the page
+    timer = Timer(trace=request.args.get("_debug") == "1")
+    with timer.phase("permissions"):
+        database, table = await get_table_or_404(datasette, request)
+    database_name = database.name
+
+    catalog = get_catalog(datasette)
 
-        before_schema = await database.execute_fn(get_schema)
+    if request.method == "POST":
+        before_schema = await get_table_schema(datasette, database, table)
 
         async def track_analytics():
-            after_schema = await database.execute_fn(get_schema)
+            after_schema = await get_table_schema(datasette, database, table)
             # Don't track drop tables, which happen when after_schema is None
             if after_schema is not None and after_schema != before_schema:
                 await datasette.track_event(
@@ -353,15 +1203,10 @@ async def edit_schema_table(request, datasette):
             drop = set()
             order_pairs = []
 
-            def get_columns(conn):
-                return [
-                    {"name": column, "type": dtype}
-                    for column, dtype in sqlite_utils.Database(conn)[
-                        table
-                    ].columns_dict.items()
-                ]
-
-            existing_columns = await database.execute_fn(get_columns)
+            table_info = await execute_read(
+                database, lambda conn: catalog.table(conn, database, table)
+            )
+            existing_columns = table_info.columns
 
             for column_details in existing_columns:
                 column = column_details["name"]
@@ -377,53 +1222,122 @@ async def edit_schema_table(request, datasette):
                 order_pairs.append((column, formdata.get("sort.{}".format(column), 0)))
 
             order_pairs.sort(key=lambda p: int(p[1]))
+            column_order = [p[0] for p in order_pairs]
 
-            def transform_the_table(conn):
-                # Run this in a transaction:
-                with conn:
-                    # We have to read all the views first, because we need to drop and recreate them
-                    db = sqlite_utils.Database(conn)
-                    views = {
-                        v.name: v.schema for v in db.views if table.lower() in v.schema
-                    }
-                    for view in views.keys():
-                        db[view].drop()
-                    db[table].transform(
-                        types=types,
-                        rename=rename,
-                        drop=drop,
-                        column_order=[p[0] for p in order_pairs],
+            plan = plan_column_changes(
+                table,
+                table_info,
+                rename,
+                drop,
+                types,
+                column_order,
+                await execute_read(database, sqlite_version),
+            )
+            if plan.is_empty:
+                datasette.add_message(request, "No changes to save", datasette.INFO)
+                return Response.redirect(request.path)
+
+            if not formdata.get("confirm"):
+                # Show the plan, and whether it needs a rebuild, first
+                return Response.html(
+                    await datasette.render_template(
+                        "edit_schema_confirm_columns.html",
+                        {
+                            "database": database,
+                            "table": table,
+                            "steps": describe_column_plan(plan),
+                            "rebuild_reasons": plan.rebuild_reasons,
+                            "action_url": request.path,
+                            "form_fields": [
+                                (key, value)
+                                for key, value in formdata.items()
+                                if key not in ("csrftoken", "confirm")
+                            ],
+                        },
+                        request=request,
                     )
-                    # Now recreate the views
-                    for schema in views.values():
-                        db.execute(schema)
+                )
 
-            await database.execute_write_fn(transform_the_table, block=True)
+            async def update_columns(job):
+                # Renames and drops are made in place where possible, anything
+                # else copies the table - in batches, if the table is large
+                if not plan.in_place and await use_online_rebuild(
+                    datasette, database, table
+                ):
+                    await rebuild_table_online(
+                        datasette,
+                        database,
+                        OnlineRebuild(
+                            table,
+                            types=types,
+                            rename=rename,
+                            drop=drop,
+                            column_order=column_order,
+                            batch_size=plugin_setting(
+                                datasette,
+                                "online_rebuild_batch_size",
+                                ONLINE_REBUILD_BATCH_SIZE,
+                            ),
+                        ),
+                        job,
+                    )
+                else:
+                    await execute_write(
+                        datasette,
+                        database,
+                        job.wrap(
+                            lambda conn: apply_column_changes(
+                                conn,
+                                table,
+                                table_info,
+                                types,
+                                rename,
+                                drop,
+                                column_order,
+                                job=job,
+                            )
+                        ),
+                    )
+                job.add_message("Changes to table have been saved", datasette.INFO)
 
-            datasette.add_message(request, "Changes to table have been saved")
-            await track_analytics()
-            return Response.redirect(request.path)
+            return await run_job(
+                request,
+                datasette,
+                database,
+                table,
+                "Changing columns",
+                update_columns,
+                redirect=request.path,
+            )
 
+        # These run as jobs, which track their own events
         if formdata.get("action") == "update_foreign_keys":
-            response = await update_foreign_keys(
+            return await update_foreign_keys(
                 request, datasette, database, table, formdata
             )
         elif formdata.get("action") == "update_primary_key":
-            response = await update_primary_key(
+            return await update_primary_key(
                 request, datasette, database, table, formdata
             )
         elif "drop_table" in formdata:
-            response = await drop_table(request, datasette, database, table)
-        elif "add_column" in formdata:
+            return await drop_table(request, datasette, database, table)
+        elif "add_index" in formdata or "add_index_columns" in formdata:
+            if formdata.get("add_index_columns"):
+                # A suggested index, tilde encoded and comma separated
+                columns = [
+                    tilde_decode(column)
+                    for column in formdata["add_index_columns"].split(",")
+                ]
+            else:
+                columns = [formdata.get("add_index_column") or ""]
+            return await add_index(
+                request, datasette, database, table, formdata, columns
+            )
+
+        if "add_column" in formdata:
             response = await add_column(request, datasette, database, table, formdata)
         elif "rename_table" in formdata:
             response = await rename_table(request, datasette, database, table, formdata)
-        elif "add_index" in formdata:
-            column = formdata.get("add_index_column") or ""
-            unique = formdata.get("add_index_unique")
-            response = await add_index(
-                request, datasette, database, table, column, unique
-            )
         elif any(key.startswith("drop_index_") for key in formdata.keys()):
             response = await drop_index(request, datasette, database, table, formdata)
         else:
@@ -431,38 +1345,35 @@ async def edit_schema_table(request, datasette):
         await track_analytics()
         return response
 
-    def get_columns_and_schema_and_fks_and_pks_and_indexes(conn):
-        db = sqlite_utils.Database(conn)
-        t = db[table]
-        pks = set(t.pks)
-        columns = [
-            {"name": column, "type": dtype, "is_pk": column in pks}
-            for column, dtype in t.columns_dict.items()
-        ]
-        # Include the index declarations in the schema as well
-        schema = db.execute(
-            textwrap.dedent(
-                """
-        select group_concat(sql, ';
-        ') from sqlite_master where tbl_name = ?
-        order by type desc
-        """
+    # One introspection snapshot, shared by everything below
+    with timer.phase("introspection"):
+        table_info, primary_keys = await execute_read(
+            database,
+            timer.traced(
+                lambda conn: (
+                    catalog.table(conn, database, table),
+                    catalog.primary_keys(conn, database),
+                )
             ),
-            [table],
-        ).fetchone()[0]
-        return columns, schema, t.foreign_keys, t.pks, t.indexes
-
-    columns, schema, foreign_keys, pks, indexes = await database.execute_fn(
-        get_columns_and_schema_and_fks_and_pks_and_indexes
-    )
+        )
+    columns = table_info.columns
+    schema = table_info.full_schema
+    foreign_keys = table_info.foreign_keys
+    pks = table_info.pks
+    indexes = table_info.indexes
     foreign_keys_by_column = {}
     for fk in foreign_keys:
         foreign_keys_by_column.setdefault(fk.column, []).append(fk)
 
-    # Load example data for the columns - truncated first five non-blank values
-    column_examples = await database.execute_fn(
-        lambda conn: examples_for_columns(conn, table)
+    # Example data for the columns - truncated first five non-blank values -
+    # and suggested foreign keys and primary keys
+    results = await table_analysis(
+        datasette, database, table, table_info, primary_keys, timer=timer
     )
+    column_examples = results["examples"]
+    potential_fks = results["potential_fks"]
+    potential_pks = results["potential_pks"]
+    analysis = results["analysis"]
 
     columns_display = [
         {
@@ -475,9 +1386,7 @@ async def edit_schema_table(request, datasette):
 
     # To detect potential foreign keys we need (table, column) for the
     # primary keys on every other table
-    other_primary_keys = [
-        pair for pair in await database.execute_fn(get_primary_keys) if pair[0] != table
-    ]
+    other_primary_keys = [pair for pair in primary_keys if pair[0] != table]
     integer_primary_keys = [
         (pair[0], pair[1]) for pair in other_primary_keys if pair[2] is int
     ]
@@ -501,39 +1410,8 @@ async def edit_schema_table(request, datasette):
         for column in columns
     ]
 
-    # Anything not a float or an existing PK could be the next PK, but
-    # for smaller tables we cut those down to just unique columns
-    potential_pks = [
-        c["name"] for c in columns if c["type"] is not float and not c["is_pk"]
-    ]
-    potential_fks = []
-    # Only scan for potential foreign keys if there are less than 10,000
-    # rows - since execute_fn() does not yet support time limits
-    limited_count = (
-        await database.execute(
-            'select count(*) from (select 1 from "{}" limit {})'.format(
-                table, FOREIGN_KEY_DETECTION_LIMIT
-            )
-        )
-    ).single_value()
-    if limited_count and limited_count < FOREIGN_KEY_DETECTION_LIMIT:
-        potential_fks = await database.execute_fn(
-            lambda conn: potential_foreign_keys(
-                conn,
-                table,
-                [c["name"] for c in columns if not c["is_pk"]],
-                other_primary_keys,
-            )
-        )
-        for info in all_columns_to_manage_foreign_keys:
-            info["suggestions"] = potential_fks.get(info["name"], [])
-        # Now do potential primary keys against non-float columns
-        non_float_columns = [
-            c["name"] for c in columns if c["type"] is not float and not c["is_pk"]
-        ]
-        potential_pks = await database.execute_fn(
-            lambda conn: potential_primary_keys(conn, table, non_float_columns)
-        )
+    for info in all_columns_to_manage_foreign_keys:
+        info["suggestions"] = potential_fks.get(info["name"], [])
 
     # Add 'options' to those
     for info in all_columns_to_manage_foreign_keys:
@@ -598,8 +1476,21 @@ async def edit_schema_table(request, datasette):
     # Only allow index creation on non-primary-key columns
     non_primary_key_columns = [c for c in columns if not c["is_pk"]]
 
-    return Response.html(
-        await datasette.render_template(
+    index_suggestions = None
+    if index_advisor_enabled(datasette):
+        with timer.phase("index_advisor"):
+            index_suggestions = await suggested_indexes(datasette, database, table)
+
+    with timer.phase("permissions"):
+        table_can_drop = await can_drop_table(
+            datasette, request.actor, database_name, table
+        )
+        table_can_rename = await can_rename_table(
+            datasette, request.actor, database_name, table
+        )
+
+    with timer.phase("rendering"):
+        html = await datasette.render_template(
             "edit_schema_table.html",
             {
                 "database": database,
@@ -613,16 +1504,266 @@ async def edit_schema_table(request, datasette):
                 "foreign_keys": foreign_keys,
                 "all_columns_to_manage_foreign_keys": all_columns_to_manage_foreign_keys,
                 "potential_pks": potential_pks,
+                "suggestions_sample_size": (analysis or {}).get("sample_size"),
+                "analysis_time_limit_ms": results["time_limit_ms"],
+                "suggestions_computing": results["computing"],
                 "is_rowid_table": bool(pks == ["rowid"]),
                 "current_pk": pks[0] if len(pks) == 1 else None,
                 "existing_indexes": existing_indexes,
+                "index_sql": table_info.index_sql,
                 "non_primary_key_columns": non_primary_key_columns,
-                "can_drop_table": await can_drop_table(
-                    datasette, request.actor, database_name, table
+                "index_suggestions": index_suggestions,
+                "can_drop_table": table_can_drop,
+                "can_rename_table": table_can_rename,
+                "tilde_encode": tilde_encode,
+                "debug_statements": timer.statements,
+                "debug_phases": [
+                    {"name": name, "duration_ms": round(seconds * 1000, 3)}
+                    for name, seconds in timer.phases.items()
+                ],
+            },
+            request=request,
+        )
+    return Response.html(html, headers={"Server-Timing": timer.server_timing()})
+
+
+def operations_from_form(formdata, table_info):
+    """
+    Converts the batch form into a list of operations for plan_operations().
+    Everything refers to columns by their existing names except for new
+    columns and new indexes, which come after the renames.
+    """
+    operations = [
+        {"op": "drop_index", "name": key[len("drop_index.") :]}
+        for key in formdata.keys()
+        if key.startswith("drop_index.")
+    ]
+    existing = [column["name"] for column in table_info.columns]
+    dropped = [
+        column for column in existing if formdata.get("delete.{}".format(column))
+    ]
+    kept = [column for column in existing if column not in dropped]
+    types = {column["name"]: TYPES[column["type"]] for column in table_info.columns}
+    for column in kept:
+        new_type = formdata.get("type.{}".format(column))
+        if new_type and new_type != types[column]:
+            operations.append({"op": "type", "column": column, "type": new_type})
+    existing_fks = {
+        fk.column: (fk.other_table, fk.other_column) for fk in table_info.foreign_keys
+    }
+    for column in kept:
+        value = formdata.get("fk.{}".format(column))
+        if value is None:
+            continue
+        if value.strip():
+            other_table, other_column = [tilde_decode(s) for s in value.split(".")]
+            if existing_fks.get(column) != (other_table, other_column):
+                operations.append(
+                    {
+                        "op": "set_foreign_key",
+                        "column": column,
+                        "other_table": other_table,
+                        "other_column": other_column,
+                    }
+                )
+        elif column in existing_fks:
+            operations.append({"op": "drop_foreign_key", "column": column})
+    primary_key = formdata.get("primary_key")
+    if primary_key and primary_key != "rowid" and [primary_key] != table_info.pks:
+        operations.append({"op": "primary_key", "columns": [primary_key]})
+    operations.extend({"op": "drop", "column": column} for column in dropped)
+    order = sorted(
+        kept, key=lambda column: int(formdata.get("sort.{}".format(column)) or 0)
+    )
+    if order != kept:
+        operations.append({"op": "reorder", "columns": order})
+    renames = {}
+    for column in kept:
+        new_name = formdata.get("name.{}".format(column))
+        if new_name and new_name != column:
+            renames[column] = new_name
+    if renames:
+        operations.append({"op": "rename", "columns": renames})
+    for key in sorted(formdata.keys()):
+        if key.startswith("add_column_name.") and formdata[key].strip():
+            i = key[len("add_column_name.") :]
+            operations.append(
+                {
+                    "op": "add_column",
+                    "name": formdata[key].strip(),
+                    "type": formdata.get("add_column_type.{}".format(i)) or "TEXT",
+                }
+            )
+    index_columns = [
+        column.strip()
+        for column in (formdata.get("add_index_columns") or "").split(",")
+        if column.strip()
+    ]
+    if index_columns:
+        operations.append(
+            {
+                "op": "add_index",
+                "columns": index_columns,
+                "unique": bool(formdata.get("add_index_unique")),
+            }
+        )
+    return operations
+
+
+async def edit_schema_table_batch(request, datasette):
+    database, table = await get_table_or_404(datasette, request)
+    catalog = get_catalog(datasette)
+    batch_path = "/-/edit-schema/{}/{}/-/batch".format(
+        quote_plus(database.name), tilde_encode(table)
+    )
+    table_info, primary_keys = await execute_read(
+        database,
+        lambda conn: (
+            catalog.table(conn, database, table),
+            catalog.primary_keys(conn, database),
+        ),
+    )
+    is_json = request.headers.get("content-type", "").startswith("application/json")
+
+    if request.method == "POST":
+        if is_json:
+            try:
+                data = json.loads(await request.post_body())
+            except ValueError:
+                return Response.json(
+                    {"ok": False, "errors": ["Invalid JSON"]}, status=400
+                )
+            if not isinstance(data, dict):
+                return Response.json(
+                    {"ok": False, "errors": ["JSON must be an object"]}, status=400
+                )
+            operations = data.get("operations")
+        else:
+            formdata = await request.post_vars()
+            operations = operations_from_form(formdata, table_info)
+
+        def plan(conn):
+            return plan_operations(
+                conn, table, catalog.table(conn, database, table), operations
+            )
+
+        try:
+            batch_plan = await execute_read(database, plan)
+        except BatchError as e:
+            if is_json:
+                return Response.json({"ok": False, "errors": [str(e)]}, status=400)
+            datasette.add_message(request, str(e), datasette.ERROR)
+            return Response.redirect(batch_path)
+
+        if batch_plan.is_empty:
+            if is_json:
+                return Response.json({"ok": True, "plan": batch_plan.to_dict()})
+            datasette.add_message(request, "No changes to save", datasette.INFO)
+            return Response.redirect(batch_path)
+
+        if is_json and data.get("dry_run"):
+            return Response.json({"ok": True, "plan": batch_plan.to_dict()})
+        if not is_json and not formdata.get("confirm"):
+            return Response.html(
+                await datasette.render_template(
+                    "edit_schema_confirm_columns.html",
+                    {
+                        "database": database,
+                        "table": table,
+                        "steps": batch_plan.steps,
+                        "rebuild_reasons": batch_plan.rebuild_reasons,
+                        "action_url": datasette.urls.path(batch_path),
+                        "form_fields": [
+                            (key, value)
+                            for key, value in formdata.items()
+                            if key not in ("csrftoken", "confirm")
+                        ],
+                    },
+                    request=request,
+                )
+            )
+
+        async def work(job):
+            # Planned again in case the table changed since it was previewed
+            await execute_write(
+                datasette,
+                database,
+                job.wrap(lambda conn: apply_plan(conn, plan(conn), job=job)),
+            )
+            job.add_message("Changes to table have been saved", datasette.INFO)
+
+        redirect = "/-/edit-schema/{}/{}".format(
+            quote_plus(database.name), tilde_encode(table)
+        )
+        if not is_json:
+            return await run_job(
+                request,
+                datasette,
+                database,
+                table,
+                "Applying changes",
+                work,
+                redirect=redirect,
+            )
+        job = start_job(
+            request, datasette, database, table, "Applying changes", work, redirect
+        )
+        await wait_for_job(datasette, job)
+        return Response.json(
+            {
+                "ok": job.status in ("running", "finished"),
+                "plan": batch_plan.to_dict(),
+                "job": job.to_dict(),
+                "job_url": datasette.absolute_url(
+                    request, datasette.urls.path(job_path(job) + ".json")
                 ),
-                "can_rename_table": await can_rename_table(
-                    datasette, request.actor, database_name, table
+            }
+        )
+
+    fks = {fk.column: fk for fk in table_info.foreign_keys}
+    columns = []
+    for column in table_info.columns:
+        fk = fks.get(column["name"])
+        columns.append(
+            {
+                "name": column["name"],
+                "type": TYPES[column["type"]],
+                "foreign_key": (
+                    "{}.{}".format(
+                        tilde_encode(fk.other_table), tilde_encode(fk.other_column)
+                    )
+                    if fk
+                    else ""
                 ),
+            }
+        )
+    return Response.html(
+        await datasette.render_template(
+            "edit_schema_batch.html",
+            {
+                "database": database,
+                "table": table,
+                "columns": columns,
+                "types": [
+                    {"name": TYPE_NAMES[value], "value": value}
+                    for value in TYPES.values()
+                ],
+                "foreign_key_options": [
+                    {
+                        "name": "{}.{}".format(other_table, other_column),
+                        "value": "{}.{}".format(
+                            tilde_encode(other_table), tilde_encode(other_column)
+                        ),
+                    }
+                    for other_table, other_column, _ in primary_keys
+                    if other_table != table
+                ],
+                "current_pk": table_info.pks[0] if len(table_info.pks) == 1 else None,
+                "existing_indexes": [
+                    index
+                    for index in table_info.indexes
+                    if not index.name.startswith("sqlite_autoindex_")
+                ],
                 "tilde_encode": tilde_encode,
             },
             request=request,
@@ -630,32 +1771,151 @@ async def edit_schema_table(request, datasette):
     )
 
 
+async def table_analysis(
+    datasette,
+    database,
+    table,
+    table_info,
+    primary_keys,
+    include_suggestions=True,
+    timer=None,
+):
+    """
+    Example values and suggested keys for a table, as a dictionary with
+    examples, examples_complete, potential_fks, potential_pks, analysis,
+    computing and time_limit_ms keys.
+
+    If suggestions are being precomputed in the background the stored
+    results are returned, with computing set to True if they are missing or
+    out of date. Otherwise they are calculated now, within the time limit.
+
+    The time spent on each step is recorded against timer, if provided.
+    """
+    worker = get_suggestions_worker(datasette)
+    if worker is not None:
+        # Check for changes now, in case this table has been modified
+        worker.wake()
+        with phase(timer, "stored_suggestions"):
+            stored = await get_stored_suggestions(datasette, database.name, table)
+        fresh = (
+            stored is not None
+            and not stored["stale"]
+            and stored["schema"] == table_info.schema
+        )
+        if fresh:
+            examples, potential_fks, potential_pks, analysis = decode_suggestions(
+                stored
+            )
+            complete = analysis is None or analysis["complete"]
+            return {
+                "examples": examples,
+                "examples_complete": complete,
+                "potential_fks": potential_fks,
+                "potential_pks": potential_pks,
+                "analysis": analysis,
+                "computing": False,
+                "time_limit_ms": None if complete else worker.time_limit_ms,
+            }
+        # Any column could be the primary key until they have been checked
+        return {
+            "examples": decode_suggestions(stored)[0] if stored else {},
+            "examples_complete": False,
+            "potential_fks": {},
+            "potential_pks": [
+                c["name"]
+                for c in table_info.columns
+                if c["type"] is not float and not c["is_pk"]
+            ],
+            "analysis": None,
+            "computing": True,
+            "time_limit_ms": None,
+        }
+    deadline = analysis_deadline(datasette)
+    examples_cache = get_examples_cache(datasette)
+    sketch_cache = get_sketch_cache(datasette)
+    traced = timer.traced if timer else (lambda fn: fn)
+    with phase(timer, "examples"):
+        examples = await execute_read(
+            database,
+            traced(
+                lambda conn: examples_cache.examples(
+                    conn,
+                    database,
+                    table,
+                    [c["name"] for c in table_info.columns],
+                    deadline,
+                )
+            ),
+        )
+    examples_complete = not deadline.expired
+    potential_fks, potential_pks, analysis = {}, [], None
+    if include_suggestions:
+        potential_fks, potential_pks, analysis = await execute_read(
+            database,
+            traced(
+                lambda conn: analyze_columns(
+                    conn,
+                    table,
+                    table_info.columns,
+                    [pair for pair in primary_keys if pair[0] != table],
+                    deadline,
+                    timer,
+                    pk_sketch=lambda conn, other_table, column: sketch_cache.sketch(
+                        conn, database, other_table, column
+                    ),
+                )
+            ),
+        )
+    return {
+        "examples": examples,
+        "examples_complete": examples_complete,
+        "potential_fks": potential_fks,
+        "potential_pks": potential_pks,
+        "analysis": analysis,
+        "computing": False,
+        "time_limit_ms": deadline.ms if deadline.expired else None,
+    }
+
+
 async def drop_table(request, datasette, database, table):
     if not await can_drop_table(datasette, request.actor, database.name, table):
         raise Forbidden("Permission denied for drop-table")
 
+    strategy = reclaim_strategy(datasette)
+
     def do_drop_table(conn):
         db = sqlite_utils.Database(conn)
         db[table].disable_fts()
         db[table].drop()
-        db.vacuum()
+        if strategy == "vacuum":
+            vacuum(conn)
 
-    if hasattr(database, "execute_isolated_fn"):
-        await database.execute_isolated_fn(do_drop_table)
-        # For the tests
-        datasette._datasette_edit_schema_used_execute_isolated_fn = True
-    else:
-        await database.execute_write_fn(do_drop_table)
-
-    datasette.add_message(request, "Table has been deleted")
-    await datasette.track_event(
-        DropTableEvent(
-            actor=request.actor,
-            database=database.name,
-            table=table,
+    async def work(job):
+        if strategy == "vacuum":
+            await execute_isolated(datasette, database, job.wrap(do_drop_table))
+        else:
+            await execute_write(datasette, database, job.wrap(do_drop_table))
+        job.add_message("Table has been deleted", datasette.INFO)
+        await datasette.track_event(
+            DropTableEvent(
+                actor=request.actor,
+                database=database.name,
+                table=table,
+            )
         )
+        if strategy != "vacuum":
+            await reclaim_space(datasette, database, strategy, job)
+
+    return await run_job(
+        request,
+        datasette,
+        database,
+        table,
+        "Deleting table",
+        work,
+        redirect="/-/edit-schema/" + database.name,
+        track=False,
     )
-    return Response.redirect("/-/edit-schema/" + database.name)
 
 
 async def add_column(request, datasette, database, table, formdata):
@@ -680,9 +1940,7 @@ async def add_column(request, datasette, database, table, formdata):
 
     error = None
     try:
-        await datasette.databases[database.name].execute_write_fn(
-            do_add_column, block=True
-        )
+        await execute_write(datasette, database, do_add_column)
     except sqlite3.OperationalError as e:
         if "duplicate column name" in str(e):
             error = "A column called '{}' already exists".format(name)
@@ -727,19 +1985,18 @@ async def rename_table(request, datasette, database, table, formdata):
         return redirect
 
     try:
-        before_schema = await database.execute_fn(
-            lambda conn: sqlite_utils.Database(conn)[table].schema
-        )
-        await database.execute_write(
-            """
-            ALTER TABLE [{}] RENAME TO [{}];
-        """.format(
-                table, new_name
+        before_schema = await execute_read(
+            database, lambda conn: sqlite_utils.Database(conn)[table].schema
+        )
+        await execute_write(
+            datasette,
+            database,
+            lambda conn: conn.execute(
+                "ALTER TABLE [{}] RENAME TO [{}]".format(table, new_name)
             ),
-            block=True,
         )
-        after_schema = await database.execute_fn(
-            lambda conn: sqlite_utils.Database(conn)[new_name].schema
+        after_schema = await execute_read(
+            database, lambda conn: sqlite_utils.Database(conn)[new_name].schema
         )
         datasette.add_message(
             request, "Table renamed to '{}'".format(new_name), datasette.INFO
@@ -765,6 +2022,7 @@ async def rename_table(request, datasette, database, table, formdata):
 
 
 async def update_foreign_keys(request, datasette, database, table, formdata):
+    catalog = get_catalog(datasette)
     new_fks = {
         key[3:]: value
         for key, value in formdata.items()
@@ -772,9 +2030,11 @@ async def update_foreign_keys(request, datasette, database, table, formdata):
     }
     existing_fks = {
         fk.column: fk.other_table + "." + fk.other_column
-        for fk in await database.execute_fn(
-            lambda conn: sqlite_utils.Database(conn)[table].foreign_keys
-        )
+        for fk in (
+            await execute_read(
+                database, lambda conn: catalog.table(conn, database, table)
+            )
+        ).foreign_keys
     }
     if new_fks == existing_fks:
         datasette.add_message(request, "No changes to foreign keys", datasette.WARNING)
@@ -793,24 +2053,65 @@ async def update_foreign_keys(request, datasette, database, table, formdata):
         )
 
     # Update foreign keys
-    def run(conn):
-        db = sqlite_utils.Database(conn)
-        with conn:
-            db[table].transform(foreign_keys=fks)
-
-    await database.execute_write_fn(run, block=True)
-    summary = ", ".join("{} → {}.{}".format(*fk) for fk in fks)
-    if summary:
-        message = "Foreign keys updated{}".format(
-            " to {}".format(summary) if summary else ""
+    async def work(job):
+        await execute_write(
+            datasette,
+            database,
+            job.wrap(
+                lambda conn: transform_table(conn, table, job=job, foreign_keys=fks)
+            ),
         )
-    else:
-        message = "Foreign keys removed"
-    datasette.add_message(
+        # Suggestions for large tables are based on a sample, so check every
+        # row for newly added foreign keys
+        warnings = []
+        row_count = await execute_read(
+            database,
+            job.wrap(lambda conn: limited_row_count(conn, table), interrupt=False),
+        )
+        if row_count >= FOREIGN_KEY_DETECTION_LIMIT:
+            for column, other_table, other_column in fks:
+                if existing_fks.get(column) == new_fks[column]:
+                    continue
+                missing = await execute_read(
+                    database,
+                    job.wrap(
+                        lambda conn: missing_foreign_key_values(
+                            conn, table, column, other_table, other_column
+                        ),
+                        interrupt=False,
+                    ),
+                )
+                if missing:
+                    warnings.append(
+                        "{:,} row{} in {} ha{} no matching value in {}.{}".format(
+                            missing,
+                            "" if missing == 1 else "s",
+                            column,
+                            "s" if missing == 1 else "ve",
+                            other_table,
+                            other_column,
+                        )
+                    )
+        summary = ", ".join("{} → {}.{}".format(*fk) for fk in fks)
+        if summary:
+            message = "Foreign keys updated{}".format(
+                " to {}".format(summary) if summary else ""
+            )
+        else:
+            message = "Foreign keys removed"
+        job.add_message(message, datasette.INFO)
+        for warning in warnings:
+            job.add_message(warning, datasette.WARNING)
+
+    return await run_job(
         request,
-        message,
+        datasette,
+        database,
+        table,
+        "Updating foreign keys",
+        work,
+        redirect=request.path,
     )
-    return Response.redirect(request.path)
 
 
 async def update_primary_key(request, datasette, database, table, formdata):
@@ -819,55 +2120,124 @@ async def update_primary_key(request, datasette, database, table, formdata):
         datasette.add_message(request, "Primary key is required", datasette.ERROR)
         return Response.redirect(request.path)
 
-    def run(conn):
-        db = sqlite_utils.Database(conn)
-        with conn:
-            if primary_key not in db[table].columns_dict:
-                return "Column '{}' does not exist".format(primary_key)
-            # Make sure it's unique
-            sql = 'select count(*) - count(distinct("{}")) from "{}"'.format(
-                primary_key, table
-            )
-            should_be_zero = db.execute(sql).fetchone()[0]
-            if should_be_zero:
-                return "Column '{}' is not unique".format(primary_key)
-            db[table].transform(pk=primary_key)
-            return None
+    catalog = get_catalog(datasette)
 
-    error = await database.execute_write_fn(run, block=True)
-    if error:
-        datasette.add_message(request, error, datasette.ERROR)
-    else:
-        datasette.add_message(
-            request,
-            "Primary key for '{}' is now '{}'".format(
-                table,
-                formdata["primary_key"],
-            ),
+    def check(conn):
+        if primary_key not in catalog.table(conn, database, table).columns_dict:
+            return "Column '{}' does not exist".format(primary_key)
+        # Make sure it's unique
+        sql = 'select count(*) - count(distinct("{}")) from "{}"'.format(
+            primary_key, table
         )
-    return Response.redirect(request.path)
+        should_be_zero = conn.execute(sql).fetchone()[0]
+        if should_be_zero:
+            return "Column '{}' is not unique".format(primary_key)
+        return None
+
+    async def work(job):
+        # Checks run against a read connection, only the transform needs to write
+        error = await execute_read(database, job.wrap(check, interrupt=False))
+        if not error:
+            try:
+                await execute_write(
+                    datasette,
+                    database,
+                    job.wrap(
+                        lambda conn: transform_table(
+                            conn, table, job=job, pk=primary_key
+                        )
+                    ),
+                )
+            except sqlite3.IntegrityError as e:
+                # Rows were changed between the check and the transform
+                error = str(e)
+        if error:
+            job.add_message(error, datasette.ERROR)
+        else:
+            job.add_message(
+                "Primary key for '{}' is now '{}'".format(table, primary_key),
+                datasette.INFO,
+            )
 
+    return await run_job(
+        request,
+        datasette,
+        database,
+        table,
+        "Changing the primary key",
+        work,
+        redirect=request.path,
+    )
 
-async def add_index(request, datasette, database, table, column, unique):
-    if not column:
-        datasette.add_message(request, "Column name is required", datasette.ERROR)
+
+async def add_index(request, datasette, database, table, formdata, columns):
+    """
+    Adds an index on the columns, or on the columns and expressions in the
+    add_index_terms field if it was filled in, see indexes.py. Anything
+    SQLite would reject is reported before the job starts.
+    """
+    unique = bool(formdata.get("add_index_unique"))
+    where = (formdata.get("add_index_where") or "").strip()
+    terms_text = (formdata.get("add_index_terms") or "").strip()
+
+    def validate(conn):
+        if terms_text:
+            table_columns = [
+                row[1]
+                for row in conn.execute(
+                    "select * from pragma_table_info(?)", [table]
+                ).fetchall()
+            ]
+            terms = parse_terms(terms_text, table_columns)
+        else:
+            if not all(columns):
+                raise IndexDefinitionError("Column name is required")
+            terms = [IndexTerm(column) for column in columns]
+        return terms, create_index_sql(conn, table, terms, unique=unique, where=where)
+
+    try:
+        terms, sql = await execute_read(database, validate)
+    except IndexDefinitionError as e:
+        datasette.add_message(request, str(e), datasette.ERROR)
         return Response.redirect(request.path)
 
     def run(conn):
-        db = sqlite_utils.Database(conn)
         with conn:
-            db[table].create_index([column], find_unique_name=True, unique=unique)
+            conn.execute(sql)
 
-    try:
-        await database.execute_write_fn(run, block=True)
-        message = "Index added on "
-        if unique:
-            message = "Unique index added on "
-        message += column
-        datasette.add_message(request, message)
-    except Exception as e:
-        datasette.add_message(request, str(e), datasette.ERROR)
-    return Response.redirect(request.path)
+    async def work(job):
+        try:
+            if unique:
+                # A full scan, so it happens here rather than in validate()
+                await execute_read(
+                    database,
+                    job.wrap(
+                        lambda conn: check_duplicates(conn, table, terms, where),
+                        interrupt=False,
+                    ),
+                )
+            await execute_write(datasette, database, job.wrap(run))
+            message = "Index added on "
+            if unique:
+                message = "Unique index added on "
+            message += ", ".join(str(term) for term in terms)
+            if where:
+                message += " where {}".format(where)
+            job.add_message(message, datasette.INFO)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            job.add_message(str(e), datasette.ERROR)
+
+    return await run_job(
+        request,
+        datasette,
+        database,
+        table,
+        "Adding an index",
+        work,
+        redirect=request.path,
+    )
 
 
 async def drop_index(request, datasette, database, table, formdata):
@@ -884,7 +2254,7 @@ async def drop_index(request, datasette, database, table, formdata):
                 conn.execute("DROP INDEX [{}]".format(to_drop))
 
         try:
-            await database.execute_write_fn(run, block=True)
+            await execute_write(datasette, database, run)
             datasette.add_message(request, "Index dropped: {}".format(to_drop))
         except Exception as e:
             datasette.add_message(request, str(e), datasette.ERROR)
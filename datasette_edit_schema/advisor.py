@@ -0,0 +1,295 @@
+"""
+Suggesting indexes based on the queries Datasette actually runs.
+
+With the index_advisor plugin setting turned on, every connection Datasette
+opens gets a trace callback, see record_workload(). The SELECT statements
+run against each database - table pages, facets, filters, sort orders,
+canned queries and arbitrary SQL - are counted by Workload, with their
+literal values replaced by ? placeholders so that no data is kept.
+Statements run by this plugin are skipped, see not_recorded().
+
+recommend_indexes() replays the database's schema into an empty in-memory
+database, runs EXPLAIN QUERY PLAN for each statement that uses the table,
+then adds each candidate index in turn to see how many full table scans it
+would remove. Candidates are the table's columns that appear in those
+statements, on their own and in pairs.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from datasette.utils import sqlite3
+import re
+import threading
+from .dependencies import identifiers
+
+# Distinct statements to remember for each database
+WORKLOAD_MAX_STATEMENTS = 1_000
+# Candidate indexes to try for each table
+MAX_CANDIDATES = 100
+# Statements using more columns than this only get single column candidates
+MAX_PAIR_COLUMNS = 6
+MAX_RECOMMENDATIONS = 5
+EXAMPLES_PER_RECOMMENDATION = 3
+HYPOTHETICAL_INDEX = "_edit_schema_advisor"
+
+NORMALIZE_RE = re.compile(
+    r"""
+    (?P<literal>[xX]'[0-9A-Fa-f]*'|'(?:[^']|'')*')
+    |(?P<keep>"(?:[^"]|"")*"|\[[^\]]*\]|`(?:[^`]|``)*`|[A-Za-z_][A-Za-z0-9_$]*)
+    |(?P<comment>--[^\n]*|/\*.*?(?:\*/|$))
+    |(?P<number>0[xX][0-9A-Fa-f]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    |(?P<parameter>[:@$][A-Za-z0-9_]+|\?\d*)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+# Set while this plugin's own statements are running, see not_recorded()
+_local = threading.local()
+
+
+def normalize_sql(sql):
+    """
+    sql with every literal and parameter replaced by ?, comments removed
+    and whitespace collapsed, so statements that only differ in their
+    values are counted together
+    """
+
+    def replace(match):
+        if match.group("keep") is not None:
+            return match.group(0)
+        if match.group("comment") is not None:
+            return " "
+        return "?"
+
+    return " ".join(NORMALIZE_RE.sub(replace, sql).split())
+
+
+def is_workload_sql(sql):
+    "SELECT statements against the database, not its schema"
+    lower = sql.lstrip().lower()
+    if not (lower.startswith("select") or lower.startswith("with")):
+        return False
+    return not any(
+        word in lower for word in ("sqlite_master", "sqlite_schema", "pragma_")
+    )
+
+
+class Workload:
+    def __init__(self, max_statements=WORKLOAD_MAX_STATEMENTS):
+        self.max_statements = max_statements
+        self._lock = threading.Lock()
+        # {database_name: OrderedDict of normalized sql -> count}, least
+        # recently run first
+        self._databases = {}
+        # {database_name: number of times a new statement has been added}
+        self._generations = {}
+
+    def record(self, database_name, sql):
+        if not is_workload_sql(sql):
+            return
+        sql = normalize_sql(sql)
+        with self._lock:
+            statements = self._databases.setdefault(database_name, OrderedDict())
+            if sql in statements:
+                statements[sql] += 1
+                statements.move_to_end(sql)
+                return
+            statements[sql] = 1
+            while len(statements) > self.max_statements:
+                statements.popitem(last=False)
+            self._generations[database_name] = (
+                self._generations.get(database_name, 0) + 1
+            )
+
+    def generation(self, database_name):
+        """
+        Changes whenever a statement the database has not seen before is
+        recorded. Counts of statements already seen are not included.
+        """
+        with self._lock:
+            return self._generations.get(database_name, 0)
+
+    def statements(self, database_name):
+        "[(normalized sql, count)] for the database"
+        with self._lock:
+            return list(self._databases.get(database_name, {}).items())
+
+    def to_dict(self, database_names=None):
+        with self._lock:
+            return {
+                name: {
+                    "statements": len(statements),
+                    "executions": sum(statements.values()),
+                }
+                for name, statements in self._databases.items()
+                if database_names is None or name in database_names
+            }
+
+    def clear(self):
+        with self._lock:
+            self._databases.clear()
+            self._generations.clear()
+
+
+def get_workload(datasette):
+    workload = getattr(datasette, "_edit_schema_workload", None)
+    if workload is None:
+        workload = Workload()
+        datasette._edit_schema_workload = workload
+    return workload
+
+
+@contextmanager
+def not_recorded():
+    "Statements run on this thread inside the block are not recorded"
+    _local.paused = getattr(_local, "paused", 0) + 1
+    try:
+        yield
+    finally:
+        _local.paused -= 1
+
+
+def record_workload(conn, database_name, workload):
+    "Records the SELECT statements run on conn in workload"
+
+    def callback(sql):
+        if not getattr(_local, "paused", 0):
+            workload.record(database_name, sql)
+
+    conn.set_trace_callback(callback)
+
+
+def hypothetical_database(conn):
+    """
+    An in-memory database with the same tables, indexes, views and
+    statistics as conn but none of the rows, to try out new indexes in
+    """
+    scratch = sqlite3.connect(":memory:")
+    rows = conn.execute(
+        "select type, sql from sqlite_master where sql is not null "
+        "and type in ('table', 'index', 'view') and name not like 'sqlite_%' "
+        "order by case type when 'table' then 0 when 'index' then 1 else 2 end, "
+        "rowid"
+    ).fetchall()
+    for _, sql in rows:
+        try:
+            scratch.execute(sql)
+        except sqlite3.Error:
+            # e.g. the shadow tables of a virtual table, which were created
+            # along with it, or a virtual table module that is not loaded
+            pass
+    has_stats = conn.execute(
+        "select 1 from sqlite_master where name = 'sqlite_stat1'"
+    ).fetchone()
+    if has_stats:
+        # Creates sqlite_stat1, then replaces the statistics for the empty
+        # tables with the real ones
+        scratch.execute("ANALYZE")
+        scratch.execute("DELETE FROM sqlite_stat1")
+        scratch.executemany(
+            "insert into sqlite_stat1 values (?, ?, ?)",
+            conn.execute("select tbl, idx, stat from sqlite_stat1").fetchall(),
+        )
+        # Reloads the statistics
+        scratch.execute("ANALYZE sqlite_master")
+        scratch.commit()
+    return scratch
+
+
+def scan_count(conn, sql):
+    "Number of SCAN steps in the normalized statement's query plan"
+    # Every ? is bound to null, the query plan does not depend on the values
+    parameters = sum(
+        1
+        for match in NORMALIZE_RE.finditer(sql)
+        if match.group("parameter") is not None
+    )
+    rows = conn.execute("EXPLAIN QUERY PLAN " + sql, [None] * parameters).fetchall()
+    return sum(
+        1
+        for row in rows
+        if row[3].startswith("SCAN ") and row[3] != "SCAN CONSTANT ROW"
+    )
+
+
+def recommend_indexes(conn, table, statements):
+    """
+    Ranks candidate indexes on table by the number of full scans they would
+    remove from statements, a list of (normalized sql, count), weighted by how
+    often each statement ran. Returns a list of
+    {"columns", "scans_removed", "statements", "examples"}
+    """
+    scratch = hypothetical_database(conn)
+    try:
+        columns = [
+            row[1]
+            for row in scratch.execute(
+                "select * from pragma_table_info(?)", [table]
+            ).fetchall()
+        ]
+        if not columns:
+            return []
+        by_lower = {column.lower(): column for column in columns}
+        # [(sql, count, scans)] for statements that scan something
+        scanning = []
+        # {columns: number of statements it was a candidate for}
+        candidates = {}
+        for sql, count in statements:
+            idents = identifiers(sql)
+            if table.lower() not in idents:
+                continue
+            try:
+                scans = scan_count(scratch, sql)
+            except sqlite3.Error:
+                # e.g. a custom SQL function from a plugin
+                continue
+            if not scans:
+                continue
+            scanning.append((sql, count, scans))
+            used = [by_lower[ident] for ident in sorted(idents) if ident in by_lower]
+            keys = [(column,) for column in used]
+            if len(used) <= MAX_PAIR_COLUMNS:
+                keys.extend((a, b) for a in used for b in used if a != b)
+            for key in keys:
+                candidates[key] = candidates.get(key, 0) + 1
+        results = {}
+        for key in sorted(candidates, key=lambda key: (-candidates[key], key))[
+            :MAX_CANDIDATES
+        ]:
+            scratch.execute(
+                'CREATE INDEX "{}" ON "{}" ({})'.format(
+                    HYPOTHETICAL_INDEX,
+                    table,
+                    ", ".join('"{}"'.format(column) for column in key),
+                )
+            )
+            try:
+                removed = 0
+                helped = []
+                for sql, count, scans in scanning:
+                    after = scan_count(scratch, sql)
+                    if after < scans:
+                        removed += (scans - after) * count
+                        helped.append(sql)
+            finally:
+                scratch.execute('DROP INDEX "{}"'.format(HYPOTHETICAL_INDEX))
+            if removed:
+                results[key] = {
+                    "columns": list(key),
+                    "scans_removed": removed,
+                    "statements": len(helped),
+                    "examples": helped[:EXAMPLES_PER_RECOMMENDATION],
+                }
+    finally:
+        scratch.close()
+    # A pair is only worth it if it does better than its first column alone
+    recommendations = [
+        result
+        for key, result in results.items()
+        if len(key) == 1
+        or result["scans_removed"] > results.get(key[:1], {}).get("scans_removed", 0)
+    ]
+    recommendations.sort(
+        key=lambda r: (-r["scans_removed"], len(r["columns"]), r["columns"])
+    )
+    return recommendations[:MAX_RECOMMENDATIONS]
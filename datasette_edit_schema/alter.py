@@ -0,0 +1,268 @@
+"""
+Applying column changes from the edit table form.
+
+SQLite can rename (3.25+) and drop (3.35+) columns in place, without
+copying the table. Anything else - changing a column's type or the order
+of the columns - needs sqlite-utils' transform(), which copies every row
+into a new table.
+"""
+
+from contextlib import contextmanager
+from datasette.utils import sqlite3
+import sqlite_utils
+from .dependencies import dependent_objects, drop_dependents, recreate_dependents
+
+RENAME_COLUMN_VERSION = (3, 25, 0)
+DROP_COLUMN_VERSION = (3, 35, 0)
+# Rows copied between progress updates by transform_table()
+TRANSFORM_BATCH_SIZE = 10_000
+
+
+def sqlite_version(conn):
+    return tuple(
+        int(part)
+        for part in conn.execute("select sqlite_version()").fetchone()[0].split(".")
+    )
+
+
+class ColumnPlan:
+    "The changes to make to a table's columns, and how to make them"
+
+    def __init__(self, table, rename, drop, types, column_order):
+        self.table = table
+        # {old_name: new_name}
+        self.rename = rename
+        self.drop = drop
+        # {column: (old_type, new_type)} for columns whose type changes
+        self.types = types
+        # The new column order, or None if it has not changed
+        self.column_order = column_order
+        # Why the table has to be copied, empty if it can be altered in place
+        self.rebuild_reasons = []
+
+    @property
+    def in_place(self):
+        return not self.rebuild_reasons
+
+    @property
+    def is_empty(self):
+        "True if the submitted form did not change anything"
+        return not (self.rename or self.drop or self.types or self.column_order)
+
+    def alter_statements(self):
+        statements = [
+            'ALTER TABLE "{}" DROP COLUMN "{}"'.format(self.table, column)
+            for column in sorted(self.drop)
+        ]
+        statements.extend(
+            'ALTER TABLE "{}" RENAME COLUMN "{}" TO "{}"'.format(self.table, old, new)
+            for old, new in self.rename.items()
+        )
+        return statements
+
+
+def plan_column_changes(table, table_info, rename, drop, types, column_order, version):
+    """
+    Compares the submitted changes with table_info and works out whether
+    they can be made using ALTER TABLE with this version of SQLite.
+
+    types maps every column to its (possibly unchanged) Python type and
+    column_order lists every column in the submitted order.
+    """
+    existing_types = {column["name"]: column["type"] for column in table_info.columns}
+    existing_order = [column["name"] for column in table_info.columns]
+    rename = {old: new for old, new in rename.items() if old not in drop}
+    changed_types = {
+        column: (existing_types[column], new_type)
+        for column, new_type in types.items()
+        if column not in drop and new_type != existing_types[column]
+    }
+    new_order = [column for column in column_order if column not in drop]
+    kept_order = [column for column in existing_order if column not in drop]
+    plan = ColumnPlan(
+        table,
+        rename,
+        set(drop),
+        changed_types,
+        new_order if new_order != kept_order else None,
+    )
+    if changed_types:
+        plan.rebuild_reasons.append("column types have changed")
+    if plan.column_order is not None:
+        plan.rebuild_reasons.append("columns have been reordered")
+    if rename and version < RENAME_COLUMN_VERSION:
+        plan.rebuild_reasons.append("SQLite is too old to rename columns")
+    if set(rename.values()) & set(existing_order):
+        # e.g. swapping two column names
+        plan.rebuild_reasons.append("columns are being renamed to existing names")
+    if drop:
+        if version < DROP_COLUMN_VERSION:
+            plan.rebuild_reasons.append("SQLite is too old to drop columns")
+        indexed = {column for index in table_info.indexes for column in index.columns}
+        foreign_keys = {fk.column for fk in table_info.foreign_keys}
+        if drop & (set(table_info.pks) | indexed | foreign_keys):
+            plan.rebuild_reasons.append(
+                "dropped columns are part of the primary key, an index or a "
+                "foreign key"
+            )
+    return plan
+
+
+def alter_in_place(conn, plan):
+    """
+    Runs the plan's ALTER TABLE statements in a single transaction. Returns
+    False, having rolled back, if SQLite refuses - for example because a
+    view or trigger uses a dropped column.
+    """
+    conn.execute("SAVEPOINT edit_schema_alter")
+    try:
+        for sql in plan.alter_statements():
+            conn.execute(sql)
+    except sqlite3.OperationalError:
+        conn.execute("ROLLBACK TO edit_schema_alter")
+        conn.execute("RELEASE edit_schema_alter")
+        return False
+    conn.execute("RELEASE edit_schema_alter")
+    return True
+
+
+def is_rowid_table(conn, table):
+    try:
+        conn.execute('select rowid from "{}" limit 0'.format(table))
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+@contextmanager
+def transaction(conn):
+    "An explicit transaction, so CREATE and DROP statements are part of it too"
+    conn.execute("begin immediate")
+    try:
+        yield
+    except BaseException:
+        # SQLite has already rolled back if a statement was interrupted
+        if conn.in_transaction:
+            conn.execute("rollback")
+        raise
+    conn.execute("commit")
+
+
+def copy_table(
+    conn,
+    table,
+    job=None,
+    batch_size=TRANSFORM_BATCH_SIZE,
+    with_dependents=True,
+    **kwargs,
+):
+    """
+    Runs the statements for sqlite-utils' table.transform(**kwargs) inside
+    the caller's transaction, except that:
+
+    - rows are copied into the new table in batches so the job (if any)
+      can report how many have been copied so far
+    - views and triggers that depend on the table are dropped and
+      recreated, see dependencies.py. Pass with_dependents=False if the
+      caller has already dropped them
+    """
+    db = sqlite_utils.Database(conn)
+    # [create new table, copy rows, drop old table, rename, *indexes]
+    sqls = db[table].transform_sql(**kwargs)
+    copy_sql = sqls[1].rstrip(";")
+    if job is not None and job.rows_total is None:
+        job.rows_total = conn.execute(
+            'select count(*) from "{}"'.format(table)
+        ).fetchone()[0]
+    dependents = dependent_objects(conn, table) if with_dependents else []
+    drop_dependents(conn, dependents)
+    conn.execute(sqls[0])
+    if is_rowid_table(conn, table):
+        copied_up_to = conn.execute(
+            'select min(rowid) - 1 from "{}"'.format(table)
+        ).fetchone()[0]
+        while copied_up_to is not None:
+            # The last rowid in this batch, None for the final batch
+            row = conn.execute(
+                'select rowid from "{}" where rowid > ? '
+                "order by rowid limit 1 offset ?".format(table),
+                [copied_up_to, batch_size - 1],
+            ).fetchone()
+            up_to = row[0] if row else None
+            cursor = conn.execute(
+                copy_sql
+                + " WHERE rowid > ?"
+                + ("" if up_to is None else " AND rowid <= ?"),
+                [copied_up_to] + ([] if up_to is None else [up_to]),
+            )
+            if job is not None:
+                job.rows_processed += cursor.rowcount
+                job.check_cancelled()
+            copied_up_to = up_to
+    else:
+        cursor = conn.execute(copy_sql)
+        if job is not None:
+            job.rows_processed += cursor.rowcount
+    for sql in sqls[2:]:
+        conn.execute(sql)
+    recreate_dependents(conn, dependents)
+
+
+@contextmanager
+def foreign_keys_off(conn):
+    """
+    Turns off foreign key enforcement inside the block, which must be
+    outside of a transaction. Yields whether it was on to begin with.
+    """
+    foreign_keys_were_on = conn.execute("PRAGMA foreign_keys").fetchone()[0]
+    try:
+        if foreign_keys_were_on:
+            conn.execute("PRAGMA foreign_keys=0;")
+        yield bool(foreign_keys_were_on)
+    finally:
+        if foreign_keys_were_on:
+            conn.execute("PRAGMA foreign_keys=1;")
+
+
+def transform_table(conn, table, job=None, batch_size=TRANSFORM_BATCH_SIZE, **kwargs):
+    """
+    The same as sqlite-utils' table.transform(**kwargs), using copy_table()
+    in a single transaction
+    """
+    with foreign_keys_off(conn) as foreign_keys_were_on:
+        with transaction(conn):
+            copy_table(conn, table, job=job, batch_size=batch_size, **kwargs)
+            # Run the foreign_key_check before we commit
+            if foreign_keys_were_on:
+                conn.execute("PRAGMA foreign_key_check;")
+
+
+def rebuild_table(conn, table, types, rename, drop, column_order, job=None):
+    "Copies the table into a new one with the changes made"
+    transform_table(
+        conn,
+        table,
+        job=job,
+        types=types,
+        rename=rename,
+        drop=drop,
+        column_order=column_order,
+    )
+
+
+def apply_column_changes(
+    conn, table, table_info, types, rename, drop, column_order, job=None
+):
+    """
+    Makes the changes in place if possible, otherwise rebuilds the table.
+    Returns the ColumnPlan, with rebuild_reasons explaining any rebuild.
+    """
+    plan = plan_column_changes(
+        table, table_info, rename, drop, types, column_order, sqlite_version(conn)
+    )
+    if plan.in_place:
+        if alter_in_place(conn, plan):
+            return plan
+        plan.rebuild_reasons.append("SQLite could not alter the table in place")
+    rebuild_table(conn, table, types, rename, drop, column_order, job=job)
+    return plan
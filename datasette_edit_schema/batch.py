@@ -0,0 +1,416 @@
+"""
+Several changes to one table - renaming, retyping, dropping, reordering and
+adding columns, setting foreign keys and the primary key, adding and
+dropping indexes - merged into one plan and applied in one transaction,
+copying the table at most once.
+
+Operations are applied in order and refer to columns by the name they have
+at that point, so a column renamed by one operation is referred to by its
+new name in the operations after it:
+
+    [
+        {"op": "rename", "column": "name", "to": "title"},
+        {"op": "rename", "columns": {"a": "b", "b": "a"}},
+        {"op": "type", "column": "size", "type": "INTEGER"},
+        {"op": "drop", "column": "notes"},
+        {"op": "reorder", "columns": ["id", "size", "title"]},
+        {"op": "add_column", "name": "created", "type": "TEXT"},
+        {"op": "set_foreign_key", "column": "owner_id",
+         "other_table": "owners", "other_column": "id"},
+        {"op": "drop_foreign_key", "column": "category_id"},
+        {"op": "primary_key", "columns": ["id"]},
+        {"op": "add_index", "columns": ["title"], "unique": false},
+        {"op": "drop_index", "name": "idx_items_notes"},
+    ]
+"""
+
+from datasette.utils import sqlite3
+import sqlite_utils
+from .alter import (
+    DROP_COLUMN_VERSION,
+    RENAME_COLUMN_VERSION,
+    copy_table,
+    foreign_keys_off,
+    sqlite_version,
+    transaction,
+)
+
+COLUMN_TYPES = {"TEXT": str, "INTEGER": int, "REAL": float, "BLOB": bytes}
+TYPE_NAMES = {value: key for key, value in COLUMN_TYPES.items()}
+
+
+class BatchError(Exception):
+    "An operation that cannot be applied to the table"
+
+
+class BatchPlan:
+    def __init__(self, table, table_info, version):
+        self.table = table
+        self.table_info = table_info
+        self.version = version
+        # In the current order, {"original": name or None if added, ...}
+        self.columns = [
+            {"original": c["name"], "name": c["name"], "type": c["type"]}
+            for c in table_info.columns
+        ]
+        self.dropped = []
+        # Current names, or None if unchanged
+        self.pk = None
+        # {current column: (other_table, other_column)}, None if unchanged
+        self.foreign_keys = None
+        self.drop_indexes = []
+        # [[current column names], unique]
+        self.add_indexes = []
+        # Human readable description of each operation
+        self.steps = []
+        # Why the table has to be copied, empty if it does not
+        self.rebuild_reasons = []
+
+    @property
+    def is_empty(self):
+        return not self.steps
+
+    def column(self, name):
+        for column in self.columns:
+            if column["name"] == name:
+                return column
+        raise BatchError("Column '{}' does not exist".format(name))
+
+    def apply(self, conn, operation):
+        op = operation.get("op")
+        method = getattr(self, "op_{}".format(op), None)
+        if method is None:
+            raise BatchError("Unknown operation: {}".format(op))
+        try:
+            method(conn, **{k: v for k, v in operation.items() if k != "op"})
+        except TypeError:
+            raise BatchError("Invalid arguments for {} operation".format(op))
+
+    def op_rename(self, conn, column=None, to=None, columns=None):
+        "Renames one column, or several at once with columns={old: new}"
+        renames = columns if columns is not None else {column: to}
+        if not isinstance(renames, dict):
+            raise BatchError("columns must map old names to new names")
+        for old, new in renames.items():
+            self.column(old)
+            if not new:
+                raise BatchError("New name for '{}' is required".format(old))
+        names = [renames.get(c["name"], c["name"]) for c in self.columns]
+        for new in set(renames.values()):
+            if names.count(new) > 1:
+                raise BatchError("A column called '{}' already exists".format(new))
+        for c in self.columns:
+            c["name"] = renames.get(c["name"], c["name"])
+        if self.pk is not None:
+            self.pk = [renames.get(name, name) for name in self.pk]
+        if self.foreign_keys is not None:
+            self.foreign_keys = {
+                renames.get(name, name): other
+                for name, other in self.foreign_keys.items()
+            }
+        for index in self.add_indexes:
+            index[0] = [renames.get(name, name) for name in index[0]]
+        self.steps.extend(
+            "Rename column {} to {}".format(old, new)
+            for old, new in renames.items()
+            if old != new
+        )
+
+    def op_type(self, conn, column, type):
+        if type not in COLUMN_TYPES:
+            raise BatchError("Invalid type: {}".format(type))
+        self.column(column)["type"] = COLUMN_TYPES[type]
+        self.steps.append("Change type of column {} to {}".format(column, type))
+
+    def op_drop(self, conn, column):
+        col = self.column(column)
+        if column in self.current_pk():
+            raise BatchError(
+                "Column '{}' is part of the primary key and cannot be deleted".format(
+                    column
+                )
+            )
+        self.columns.remove(col)
+        if col["original"] is not None:
+            self.dropped.append(col["original"])
+        if self.foreign_keys is not None:
+            self.foreign_keys.pop(column, None)
+        for index in self.add_indexes:
+            if column in index[0]:
+                raise BatchError(
+                    "Column '{}' is used by a new index and cannot be deleted".format(
+                        column
+                    )
+                )
+        self.steps.append("Delete column {}".format(column))
+
+    def op_reorder(self, conn, columns):
+        if sorted(columns) != sorted(c["name"] for c in self.columns):
+            raise BatchError("Column order must list every column once")
+        self.columns.sort(key=lambda c: columns.index(c["name"]))
+        self.steps.append("Change the column order to {}".format(", ".join(columns)))
+
+    def op_add_column(self, conn, name, type):
+        if not name:
+            raise BatchError("Column name is required")
+        if type not in COLUMN_TYPES:
+            raise BatchError("Invalid type: {}".format(type))
+        if any(c["name"] == name for c in self.columns):
+            raise BatchError("A column called '{}' already exists".format(name))
+        if any(c["name"] == name for c in self.table_info.columns):
+            # New columns are added before anything is renamed or deleted
+            raise BatchError(
+                "Column '{}' is being renamed or deleted, add a new column with "
+                "that name in a separate change".format(name)
+            )
+        self.columns.append(
+            {"original": None, "name": name, "type": COLUMN_TYPES[type]}
+        )
+        self.steps.append("Add {} column {}".format(type, name))
+
+    def current_foreign_keys(self):
+        if self.foreign_keys is not None:
+            return self.foreign_keys
+        names = {c["original"]: c["name"] for c in self.columns if c["original"]}
+        return {
+            names[fk.column]: (fk.other_table, fk.other_column)
+            for fk in self.table_info.foreign_keys
+            if fk.column in names
+        }
+
+    def op_set_foreign_key(self, conn, column, other_table, other_column):
+        self.column(column)
+        db = sqlite_utils.Database(conn)
+        if not db[other_table].exists():
+            raise BatchError("Table '{}' does not exist".format(other_table))
+        if other_column not in db[other_table].columns_dict:
+            raise BatchError(
+                "Column '{}' does not exist in '{}'".format(other_column, other_table)
+            )
+        self.foreign_keys = dict(self.current_foreign_keys())
+        self.foreign_keys[column] = (other_table, other_column)
+        self.steps.append(
+            "Set foreign key {} → {}.{}".format(column, other_table, other_column)
+        )
+
+    def op_drop_foreign_key(self, conn, column):
+        self.column(column)
+        self.foreign_keys = dict(self.current_foreign_keys())
+        if self.foreign_keys.pop(column, None) is None:
+            raise BatchError("Column '{}' has no foreign key".format(column))
+        self.steps.append("Remove foreign key from {}".format(column))
+
+    def current_pk(self):
+        if self.pk is not None:
+            return self.pk
+        names = {c["original"]: c["name"] for c in self.columns if c["original"]}
+        return [names[pk] for pk in self.table_info.pks if pk in names]
+
+    def op_primary_key(self, conn, columns):
+        if not columns:
+            raise BatchError("Primary key is required")
+        for column in columns:
+            self.column(column)
+        self.pk = list(columns)
+        self.steps.append("Set the primary key to {}".format(", ".join(columns)))
+
+    def op_add_index(self, conn, columns, unique=False):
+        if not columns:
+            raise BatchError("Columns are required for a new index")
+        for column in columns:
+            self.column(column)
+        self.add_indexes.append([list(columns), bool(unique)])
+        self.steps.append(
+            "Add {}index on {}".format("unique " if unique else "", ", ".join(columns))
+        )
+
+    def op_drop_index(self, conn, name):
+        if name not in {index.name for index in self.table_info.indexes}:
+            raise BatchError("Index '{}' does not exist".format(name))
+        if name in self.drop_indexes:
+            raise BatchError("Index '{}' is already being dropped".format(name))
+        self.drop_indexes.append(name)
+        self.steps.append("Drop index {}".format(name))
+
+    # Working out what has to happen
+
+    @property
+    def renames(self):
+        "{original: new name} for existing columns that have been renamed"
+        return {
+            c["original"]: c["name"]
+            for c in self.columns
+            if c["original"] is not None and c["original"] != c["name"]
+        }
+
+    @property
+    def renames_in_place(self):
+        return self.version >= RENAME_COLUMN_VERSION
+
+    @property
+    def added(self):
+        return [c for c in self.columns if c["original"] is None]
+
+    def finish(self):
+        "Works out whether the table needs to be copied, and why"
+        existing = {c["name"]: c["type"] for c in self.table_info.columns}
+        reasons = []
+        if any(
+            c["original"] is not None and c["type"] != existing[c["original"]]
+            for c in self.columns
+        ):
+            reasons.append("column types have changed")
+        kept = [c["name"] for c in self.table_info.columns]
+        kept = [name for name in kept if name not in self.dropped]
+        natural_order = kept + [c["name"] for c in self.added]
+        if [c["original"] or c["name"] for c in self.columns] != natural_order:
+            reasons.append("columns have been reordered")
+        if self.renames and not self.renames_in_place:
+            reasons.append("SQLite is too old to rename columns")
+        renames = self.renames
+        if self.pk is not None:
+            existing_pk = [
+                renames.get(pk, pk) for pk in self.table_info.pks if pk != "rowid"
+            ]
+            if self.pk != existing_pk:
+                reasons.append("the primary key has changed")
+        if self.foreign_keys is not None:
+            existing_fks = {
+                renames.get(fk.column, fk.column): (fk.other_table, fk.other_column)
+                for fk in self.table_info.foreign_keys
+                if fk.column not in self.dropped
+            }
+            if self.foreign_keys != existing_fks:
+                reasons.append("foreign keys have changed")
+        if self.dropped:
+            if self.version < DROP_COLUMN_VERSION:
+                reasons.append("SQLite is too old to drop columns")
+            indexed = {
+                column
+                for index in self.table_info.indexes
+                if index.name not in self.drop_indexes
+                for column in index.columns
+            }
+            fk_columns = {fk.column for fk in self.table_info.foreign_keys}
+            if set(self.dropped) & (set(self.table_info.pks) | indexed | fk_columns):
+                reasons.append(
+                    "dropped columns are part of the primary key, an index or a "
+                    "foreign key"
+                )
+        self.rebuild_reasons = reasons
+        if reasons:
+            for index in self.table_info.indexes:
+                if index.name in self.drop_indexes or index.origin == "pk":
+                    continue
+                for column in index.columns:
+                    if column in self.dropped:
+                        raise BatchError(
+                            "Index '{}' uses column '{}', drop the index "
+                            "before deleting the column".format(index.name, column)
+                        )
+                    if column in renames and not self.renames_in_place:
+                        raise BatchError(
+                            "Index '{}' uses column '{}', drop the index "
+                            "before renaming the column".format(index.name, column)
+                        )
+
+    def to_dict(self):
+        return {
+            "steps": self.steps,
+            "rebuild": bool(self.rebuild_reasons),
+            "rebuild_reasons": self.rebuild_reasons,
+        }
+
+
+def plan_operations(conn, table, table_info, operations):
+    "Returns a BatchPlan for the operations, or raises BatchError"
+    if not isinstance(operations, list):
+        raise BatchError("operations must be a list")
+    plan = BatchPlan(table, table_info, sqlite_version(conn))
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise BatchError("Each operation must be an object")
+        plan.apply(conn, operation)
+    plan.finish()
+    return plan
+
+
+def _rename_in_place(conn, table, renames):
+    # Go via temporary names if one column is taking another's name
+    if set(renames.values()) & set(renames):
+        temporary = {
+            old: "_edit_schema_rename_{}".format(i) for i, old in enumerate(renames)
+        }
+        _rename_in_place(conn, table, temporary)
+        renames = {temporary[old]: new for old, new in renames.items()}
+    for old, new in renames.items():
+        conn.execute(
+            'ALTER TABLE "{}" RENAME COLUMN "{}" TO "{}"'.format(table, old, new)
+        )
+
+
+def _drop_in_place(conn, table, columns):
+    "Returns False, leaving the table unchanged, if SQLite refuses"
+    conn.execute("SAVEPOINT edit_schema_batch_drop")
+    try:
+        for column in columns:
+            conn.execute('ALTER TABLE "{}" DROP COLUMN "{}"'.format(table, column))
+    except sqlite3.OperationalError:
+        conn.execute("ROLLBACK TO edit_schema_batch_drop")
+        conn.execute("RELEASE edit_schema_batch_drop")
+        return False
+    conn.execute("RELEASE edit_schema_batch_drop")
+    return True
+
+
+def apply_plan(conn, plan, job=None):
+    "Makes every change in the plan in a single transaction"
+    table = plan.table
+    db = sqlite_utils.Database(conn)
+    with foreign_keys_off(conn) as foreign_keys_were_on:
+        with transaction(conn):
+            for name in plan.drop_indexes:
+                conn.execute('DROP INDEX "{}"'.format(name))
+            for column in plan.added:
+                conn.execute(
+                    'ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(
+                        table, column["name"], TYPE_NAMES[column["type"]]
+                    )
+                )
+            renames = plan.renames
+            if renames and plan.renames_in_place:
+                _rename_in_place(conn, table, renames)
+                renames = {}
+            rebuild = bool(plan.rebuild_reasons)
+            if plan.dropped and not rebuild:
+                rebuild = not _drop_in_place(conn, table, plan.dropped)
+            if rebuild:
+                # Existing columns are known by their original names if they
+                # have not been renamed yet, added ones by their new names
+
+                def key(column):
+                    if column["original"] is None or not renames:
+                        return column["name"]
+                    return column["original"]
+
+                kwargs = {
+                    "types": {key(c): c["type"] for c in plan.columns},
+                    "rename": renames,
+                    "drop": set(plan.dropped),
+                    "column_order": [key(c) for c in plan.columns],
+                }
+                if plan.pk is not None:
+                    kwargs["pk"] = plan.pk[0] if len(plan.pk) == 1 else plan.pk
+                if plan.foreign_keys is not None:
+                    kwargs["foreign_keys"] = [
+                        (column, other_table, other_column)
+                        for column, (
+                            other_table,
+                            other_column,
+                        ) in plan.foreign_keys.items()
+                    ]
+                copy_table(conn, table, job=job, **kwargs)
+            for columns, unique in plan.add_indexes:
+                db[table].create_index(columns, unique=unique, find_unique_name=True)
+            if foreign_keys_were_on:
+                conn.execute("PRAGMA foreign_key_check;")
@@ -0,0 +1,127 @@
+"""
+Setting the foreign keys of many tables at once.
+
+Each table whose foreign keys change is copied exactly once, all in a
+single transaction with foreign key enforcement turned off. The views and
+triggers that depend on any of those tables are dropped before the first
+copy and recreated after the last, and PRAGMA foreign_key_check runs once
+at the end.
+"""
+
+import sqlite_utils
+from .alter import copy_table, foreign_keys_off, transaction
+from .dependencies import SchemaGraph, drop_dependents, recreate_dependents
+from .utils import get_foreign_keys
+
+
+def check_foreign_keys(conn, foreign_keys):
+    """
+    Returns a list of errors for foreign_keys, which maps each table to its
+    complete new list of (column, other_table, other_column)
+    """
+    db = sqlite_utils.Database(conn)
+    errors = []
+    for table, fks in foreign_keys.items():
+        if not db[table].exists():
+            errors.append("Table '{}' does not exist".format(table))
+            continue
+        columns = db[table].columns_dict
+        seen = set()
+        for column, other_table, other_column in fks:
+            if column not in columns:
+                errors.append(
+                    "Column '{}' does not exist in '{}'".format(column, table)
+                )
+            elif column in seen:
+                errors.append(
+                    "Column '{}' in '{}' has more than one foreign key".format(
+                        column, table
+                    )
+                )
+            elif not db[other_table].exists():
+                errors.append("Table '{}' does not exist".format(other_table))
+            elif other_column not in db[other_table].columns_dict:
+                errors.append(
+                    "Column '{}' does not exist in '{}'".format(
+                        other_column, other_table
+                    )
+                )
+            seen.add(column)
+    return errors
+
+
+def changed_foreign_keys(conn, foreign_keys):
+    "The subset of foreign_keys for tables whose foreign keys would change"
+    existing = get_foreign_keys(conn, list(foreign_keys))
+    return {
+        table: fks
+        for table, fks in foreign_keys.items()
+        if {
+            column: (other_table, other_column)
+            for column, other_table, other_column in fks
+        }
+        != existing.get(table, {})
+    }
+
+
+def foreign_key_violations(conn, tables):
+    """
+    Runs PRAGMA foreign_key_check once for the whole database, returns
+    {(table, column, other_table, other_column): number of rows} for rows
+    in tables with no matching value in the other table
+    """
+    tables = set(tables)
+    fk_columns = {}
+    violations = {}
+    for table, _, other_table, fk_id in conn.execute(
+        "PRAGMA foreign_key_check"
+    ).fetchall():
+        if table not in tables:
+            continue
+        if table not in fk_columns:
+            fk_columns[table] = {
+                row[0]: (row[3], row[4])
+                for row in conn.execute(
+                    'select id, seq, "table", "from", "to" '
+                    "from pragma_foreign_key_list(?) where seq = 0",
+                    [table],
+                ).fetchall()
+            }
+        column, other_column = fk_columns[table][fk_id]
+        if other_column is None:
+            other_column = sqlite_utils.Database(conn)[other_table].pks[0]
+        key = (table, column, other_table, other_column)
+        violations[key] = violations.get(key, 0) + 1
+    return violations
+
+
+def set_foreign_keys(conn, foreign_keys, job=None):
+    """
+    Gives each table in foreign_keys exactly the foreign keys listed for it,
+    copying only the tables whose foreign keys change. Returns the
+    foreign_key_violations() for those tables.
+    """
+    changed = changed_foreign_keys(conn, foreign_keys)
+    if not changed:
+        return {}
+    with foreign_keys_off(conn):
+        with transaction(conn):
+            if job is not None:
+                job.rows_total = sum(
+                    conn.execute('select count(*) from "{}"'.format(table)).fetchone()[
+                        0
+                    ]
+                    for table in changed
+                )
+            dependents = SchemaGraph(conn).dependents(*changed)
+            drop_dependents(conn, dependents)
+            for table, fks in changed.items():
+                copy_table(
+                    conn,
+                    table,
+                    job=job,
+                    with_dependents=False,
+                    foreign_keys=list(fks),
+                )
+            recreate_dependents(conn, dependents)
+            return foreign_key_violations(conn, changed)
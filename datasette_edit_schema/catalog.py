@@ -0,0 +1,292 @@
+from collections import OrderedDict
+from datasette.utils import sqlite3
+import itertools
+import sqlite_utils
+import textwrap
+import threading
+from .indexes import index_definitions
+from .sketches import primary_key_sketch
+from .utils import examples_for_columns, get_primary_keys, get_table_columns
+
+# Maximum number of cached introspection results to keep for each database
+CATALOG_CACHE_SIZE = 1_000
+# Maximum number of tables to keep example values for, across all databases
+EXAMPLES_CACHE_SIZE = 1_000
+# Maximum number of primary key sketches to keep, across all databases
+SKETCH_CACHE_SIZE = 1_000
+CONNECTION_TOKEN_FUNCTION = "_edit_schema_connection_token"
+_connection_tokens = itertools.count(1)
+
+
+class TableInfo:
+    "Introspection snapshot for a single table"
+
+    def __init__(
+        self, columns, pks, foreign_keys, indexes, schema, full_schema, index_sql=None
+    ):
+        # [{"name": ..., "type": ..., "is_pk": ...}]
+        self.columns = columns
+        self.pks = pks
+        self.foreign_keys = foreign_keys
+        self.indexes = indexes
+        # The CREATE TABLE statement
+        self.schema = schema
+        # CREATE TABLE plus any CREATE INDEX statements
+        self.full_schema = full_schema
+        # {index_name: CREATE INDEX sql}, for indexes that were not created
+        # automatically by a PRIMARY KEY or UNIQUE constraint
+        self.index_sql = index_sql or {}
+
+    @property
+    def columns_dict(self):
+        return {column["name"]: column["type"] for column in self.columns}
+
+
+def introspect_table(conn, table):
+    db = sqlite_utils.Database(conn)
+    t = db[table]
+    if not t.exists():
+        return None
+    pks = t.pks
+    columns = [
+        {"name": column, "type": dtype, "is_pk": column in pks}
+        for column, dtype in t.columns_dict.items()
+    ]
+    # Include the index declarations in the schema as well
+    full_schema = db.execute(
+        textwrap.dedent(
+            """
+    select group_concat(sql, ';
+    ') from sqlite_master where tbl_name = ?
+    order by type desc
+    """
+        ),
+        [table],
+    ).fetchone()[0]
+    return TableInfo(
+        columns=columns,
+        pks=pks,
+        foreign_keys=t.foreign_keys,
+        indexes=t.indexes,
+        schema=t.schema,
+        full_schema=full_schema,
+        index_sql=index_definitions(conn, table),
+    )
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA schema_version").fetchone()[0]
+
+
+class SchemaCatalog:
+    """
+    Per-database LRU cache of introspection results, discarded whenever the
+    database's PRAGMA schema_version changes.
+
+    Methods take a connection and should be called from inside execute_fn()
+    """
+
+    def __init__(self, max_size=CATALOG_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # {database_key: (schema_version, OrderedDict of key -> value)}
+        self._databases = {}
+
+    def get(self, conn, database, key, fn):
+        database_key = (database.name, database.path)
+        version = schema_version(conn)
+        with self._lock:
+            cached = self._databases.get(database_key)
+            if cached is not None and cached[0] == version and key in cached[1]:
+                cached[1].move_to_end(key)
+                return cached[1][key]
+        value = fn(conn)
+        with self._lock:
+            cached = self._databases.get(database_key)
+            if cached is None or cached[0] != version:
+                cached = (version, OrderedDict())
+                self._databases[database_key] = cached
+            entries = cached[1]
+            entries[key] = value
+            entries.move_to_end(key)
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+        return value
+
+    def table(self, conn, database, table):
+        return self.get(
+            conn, database, ("table", table), lambda conn: introspect_table(conn, table)
+        )
+
+    def table_columns(self, conn, database, table_names=None):
+        if table_names is None:
+            return self.get(conn, database, ("table_columns",), get_table_columns)
+        table_names = tuple(table_names)
+        return self.get(
+            conn,
+            database,
+            ("table_columns", table_names),
+            lambda conn: get_table_columns(conn, table_names),
+        )
+
+    def primary_keys(self, conn, database):
+        return self.get(conn, database, ("primary_keys",), get_primary_keys)
+
+    def clear(self):
+        with self._lock:
+            self._databases.clear()
+
+
+def data_version(conn):
+    return conn.execute("PRAGMA data_version").fetchone()[0]
+
+
+def connection_token(conn):
+    """
+    A number identifying conn that is never reused, unlike id(conn). It is
+    kept in a SQL function registered on the connection the first time.
+    """
+    try:
+        return conn.execute("select {}()".format(CONNECTION_TOKEN_FUNCTION)).fetchone()[
+            0
+        ]
+    except sqlite3.OperationalError:
+        token = next(_connection_tokens)
+        conn.create_function(CONNECTION_TOKEN_FUNCTION, 0, lambda: token)
+        return token
+
+
+class VersionedCache:
+    """
+    LRU cache of results that depend on a table's rows, not just its schema.
+
+    PRAGMA data_version only changes when a different connection commits, so
+    it can only be compared with an earlier value from the same connection.
+    Each entry remembers the data_version of every connection that has
+    calculated it, and is only used by those connections while both that
+    and the schema_version are unchanged.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # {key: (schema_version, {connection_token(conn): data_version},
+        # value)}, where key starts with the database name
+        self._entries = OrderedDict()
+        # {database_name: {"hits": ..., "misses": ...}}
+        self._counts = {}
+
+    def _count(self, database_name, outcome):
+        counts = self._counts.setdefault(database_name, {"hits": 0, "misses": 0})
+        counts[outcome] += 1
+
+    def get(self, conn, key, fn, store=None):
+        """
+        fn(conn), cached under key. store(value) returns False for results
+        that should not be cached, such as ones cut short by a deadline.
+        """
+        token = connection_token(conn)
+        versions = (schema_version(conn), data_version(conn))
+        with self._lock:
+            entry = self._entries.get(key)
+            if (
+                entry is not None
+                and entry[0] == versions[0]
+                and entry[1].get(token) == versions[1]
+            ):
+                self._entries.move_to_end(key)
+                self._count(key[0], "hits")
+                return entry[2]
+            self._count(key[0], "misses")
+        value = fn(conn)
+        if store is not None and not store(value):
+            return value
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == versions[0] and entry[2] == value:
+                # Same result, so valid for this connection too
+                entry[1][token] = versions[1]
+            else:
+                self._entries[key] = (versions[0], {token: versions[1]}, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def to_dict(self, database_names=None):
+        with self._lock:
+            entries = {}
+            for key in self._entries:
+                entries[key[0]] = entries.get(key[0], 0) + 1
+            return {
+                "max_size": self.max_size,
+                "databases": {
+                    name: dict(counts, entries=entries.get(name, 0))
+                    for name, counts in self._counts.items()
+                    if database_names is None or name in database_names
+                },
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class ExamplesCache(VersionedCache):
+    "examples_for_columns() results for each (database, table)"
+
+    def __init__(self, max_size=EXAMPLES_CACHE_SIZE):
+        super().__init__(max_size)
+
+    def examples(self, conn, database, table, columns, deadline=None):
+        "examples_for_columns(), cached unless the deadline cut it short"
+        return self.get(
+            conn,
+            (database.name, database.path, table, tuple(columns)),
+            lambda conn: examples_for_columns(conn, table, columns, deadline),
+            store=lambda examples: deadline is None or not deadline.expired,
+        )
+
+
+class SketchCache(VersionedCache):
+    """
+    ColumnSketches of the primary keys that foreign key suggestions are
+    checked against. Each one takes a full scan of its table, and the same
+    primary keys are needed for every table in the database.
+    """
+
+    def __init__(self, max_size=SKETCH_CACHE_SIZE):
+        super().__init__(max_size)
+
+    def sketch(self, conn, database, table, column):
+        return self.get(
+            conn,
+            (database.name, database.path, table, column),
+            lambda conn: primary_key_sketch(conn, table, column),
+        )
+
+
+def get_examples_cache(datasette):
+    cache = getattr(datasette, "_edit_schema_examples_cache", None)
+    if cache is None:
+        config = datasette.plugin_config("datasette-edit-schema") or {}
+        cache = ExamplesCache(config.get("examples_cache_size", EXAMPLES_CACHE_SIZE))
+        datasette._edit_schema_examples_cache = cache
+    return cache
+
+
+def get_sketch_cache(datasette):
+    cache = getattr(datasette, "_edit_schema_sketch_cache", None)
+    if cache is None:
+        cache = SketchCache()
+        datasette._edit_schema_sketch_cache = cache
+    return cache
+
+
+def get_catalog(datasette):
+    # One catalog per Datasette instance
+    catalog = getattr(datasette, "_edit_schema_catalog", None)
+    if catalog is None:
+        catalog = SchemaCatalog()
+        datasette._edit_schema_catalog = catalog
+    return catalog
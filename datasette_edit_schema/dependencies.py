@@ -0,0 +1,157 @@
+"""
+Which views and triggers depend on which tables.
+
+Copying a table into a new one - see transform_table() - drops the old
+table, taking any triggers on it with it, and SQLite refuses to rename the
+new table into place while a view or trigger refers to a table that does
+not exist. So every view and trigger that depends on the table, directly
+or through other views, is dropped first and recreated afterwards.
+
+A view's dependencies come from SQLite itself: selecting from the view
+with an authorizer callback reports every table it reads from, directly or
+through other views, along with the views involved. Triggers - and views
+SQLite cannot compile - fall back to tokenizing their SQL and looking for
+identifiers that match the name of a table or view, skipping string
+literals and comments.
+"""
+
+from dataclasses import dataclass, field
+import re
+from datasette.utils import sqlite3
+
+# Bare identifiers, "quoted", [bracketed] and `backticked` identifiers,
+# plus the string literals and comments that should be skipped
+TOKEN_RE = re.compile(
+    r"""
+    (?P<skip>'(?:[^']|'')*'|--[^\n]*|/\*.*?(?:\*/|$))
+    |"(?P<double>(?:[^"]|"")*)"
+    |\[(?P<bracket>[^\]]*)\]
+    |`(?P<backtick>(?:[^`]|``)*)`
+    |(?P<bare>[A-Za-z_][A-Za-z0-9_$]*)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+def identifiers(sql):
+    "Every identifier in the SQL, lowercased"
+    found = set()
+    for match in TOKEN_RE.finditer(sql):
+        if match.group("skip") is not None:
+            continue
+        if match.group("double") is not None:
+            found.add(match.group("double").replace('""', '"').lower())
+        elif match.group("bracket") is not None:
+            found.add(match.group("bracket").lower())
+        elif match.group("backtick") is not None:
+            found.add(match.group("backtick").replace("``", "`").lower())
+        else:
+            found.add(match.group("bare").lower())
+    return found
+
+
+def view_dependencies(conn, view):
+    "Lowercased names of the tables and views the view reads from"
+    found = set()
+
+    def authorizer(action, table, column, database, source):
+        if action == sqlite3.SQLITE_READ:
+            found.add(table.lower())
+            # The innermost view that did the reading
+            if source:
+                found.add(source.lower())
+        return sqlite3.SQLITE_OK
+
+    conn.set_authorizer(authorizer)
+    try:
+        conn.execute('select * from "{}" limit 0'.format(view)).fetchall()
+    finally:
+        conn.set_authorizer(None)
+    found.discard(view.lower())
+    return found
+
+
+@dataclass
+class SchemaObject:
+    type: str
+    name: str
+    # The table or view a trigger is attached to, the name itself otherwise
+    tbl_name: str
+    sql: str
+    # Lowercased names of the tables and views this depends on - for views
+    # this includes everything they depend on through other views
+    depends_on: set = field(default_factory=set)
+
+
+class SchemaGraph:
+    def __init__(self, conn):
+        self.objects = {}
+        for type, name, tbl_name, sql in conn.execute(
+            "select type, name, tbl_name, sql from sqlite_master "
+            "where type in ('table', 'view', 'trigger') and sql is not null"
+        ).fetchall():
+            self.objects[(type, name.lower())] = SchemaObject(type, name, tbl_name, sql)
+        relations = {name for type, name in self.objects if type in ("table", "view")}
+        for (type, name), obj in self.objects.items():
+            if type == "view":
+                try:
+                    obj.depends_on = view_dependencies(conn, obj.name) & relations
+                except sqlite3.Error:
+                    obj.depends_on = (identifiers(obj.sql) & relations) - {name}
+            elif type == "trigger":
+                obj.depends_on = (identifiers(obj.sql) & relations) | {
+                    obj.tbl_name.lower()
+                }
+
+    def dependents(self, *tables):
+        """
+        Views and triggers that depend on any of the tables, directly or
+        through other views, in the order they should be created - a view
+        always comes after the views it depends on, and triggers come last
+        """
+        wanted = set()
+        pending = [table.lower() for table in tables]
+        while pending:
+            name = pending.pop()
+            for (type, other), obj in self.objects.items():
+                if type == "table" or (type, other) in wanted:
+                    continue
+                if name in obj.depends_on:
+                    wanted.add((type, other))
+                    if type == "view":
+                        pending.append(other)
+        ordered = []
+        done = set()
+
+        def visit(key):
+            if key in done:
+                return
+            done.add(key)
+            for dependency in sorted(self.objects[key].depends_on):
+                if ("view", dependency) in wanted:
+                    visit(("view", dependency))
+            ordered.append(self.objects[key])
+
+        for key in sorted(wanted):
+            if key[0] == "view":
+                visit(key)
+        ordered.extend(
+            self.objects[key] for key in sorted(wanted) if key[0] == "trigger"
+        )
+        return ordered
+
+
+def dependent_objects(conn, table):
+    "SchemaGraph(conn).dependents(table)"
+    return SchemaGraph(conn).dependents(table)
+
+
+def drop_dependents(conn, dependents):
+    "Drops the views and triggers returned by dependents(), in reverse order"
+    for obj in reversed(dependents):
+        conn.execute('DROP {} IF EXISTS "{}"'.format(obj.type.upper(), obj.name))
+
+
+def recreate_dependents(conn, dependents):
+    for obj in dependents:
+        conn.execute(obj.sql)
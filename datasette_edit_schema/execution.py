@@ -0,0 +1,140 @@
+"""
+Every database call made by this plugin goes through one of these helpers:
+
+- execute_read() - read-only introspection and analysis, runs on one of
+  Datasette's read connections so it never waits in the write queue
+- execute_write() - anything that modifies the database, runs on the single
+  write connection
+- execute_isolated() - operations such as VACUUM that need their own
+  connection while blocking the write queue
+
+Writes and isolated calls record how long they waited in the write queue
+before they started running, see WriteQueueStats. None of the statements
+they run are recorded by the index advisor.
+"""
+
+from collections import deque
+import threading
+import time
+from .advisor import not_recorded
+
+# Number of recent queue waits to keep for each database
+RECENT_WAITS = 100
+
+
+class WriteQueueStats:
+    def __init__(self, recent=RECENT_WAITS):
+        self.recent = recent
+        self._lock = threading.Lock()
+        self._databases = {}
+
+    def record(self, database_name, kind, wait, duration):
+        with self._lock:
+            stats = self._databases.get(database_name)
+            if stats is None:
+                stats = {
+                    "count": 0,
+                    "total_wait": 0.0,
+                    "max_wait": 0.0,
+                    "total_duration": 0.0,
+                    "recent": deque(maxlen=self.recent),
+                }
+                self._databases[database_name] = stats
+            stats["count"] += 1
+            stats["total_wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"], wait)
+            stats["total_duration"] += duration
+            stats["recent"].append((kind, wait, duration))
+
+    def to_dict(self, database_names=None):
+        output = {}
+        with self._lock:
+            for name, stats in self._databases.items():
+                if database_names is not None and name not in database_names:
+                    continue
+                output[name] = {
+                    "count": stats["count"],
+                    "total_wait_ms": round(stats["total_wait"] * 1000, 3),
+                    "mean_wait_ms": round(
+                        stats["total_wait"] * 1000 / stats["count"], 3
+                    ),
+                    "max_wait_ms": round(stats["max_wait"] * 1000, 3),
+                    "total_duration_ms": round(stats["total_duration"] * 1000, 3),
+                    "recent": [
+                        {
+                            "kind": kind,
+                            "wait_ms": round(wait * 1000, 3),
+                            "duration_ms": round(duration * 1000, 3),
+                        }
+                        for kind, wait, duration in stats["recent"]
+                    ],
+                }
+        return output
+
+
+def get_write_queue_stats(datasette):
+    stats = getattr(datasette, "_edit_schema_write_queue_stats", None)
+    if stats is None:
+        stats = WriteQueueStats()
+        datasette._edit_schema_write_queue_stats = stats
+    return stats
+
+
+def _not_recorded(fn):
+    def inner(conn):
+        with not_recorded():
+            return fn(conn)
+
+    return inner
+
+
+def _timed(fn, timing):
+    def inner(conn):
+        timing["start"] = time.perf_counter()
+        try:
+            with not_recorded():
+                return fn(conn)
+        finally:
+            timing["end"] = time.perf_counter()
+
+    return inner
+
+
+async def _execute_queued(datasette, database, kind, fn, execute):
+    timing = {}
+    submitted = time.perf_counter()
+    try:
+        return await execute(_timed(fn, timing))
+    finally:
+        if "start" in timing:
+            get_write_queue_stats(datasette).record(
+                database.name,
+                kind,
+                timing["start"] - submitted,
+                timing["end"] - timing["start"],
+            )
+
+
+async def execute_read(database, fn):
+    return await database.execute_fn(_not_recorded(fn))
+
+
+async def execute_write(datasette, database, fn):
+    return await _execute_queued(
+        datasette,
+        database,
+        "write",
+        fn,
+        lambda timed_fn: database.execute_write_fn(timed_fn, block=True),
+    )
+
+
+async def execute_isolated(datasette, database, fn):
+    if not hasattr(database, "execute_isolated_fn"):
+        return await execute_write(datasette, database, fn)
+    result = await _execute_queued(
+        datasette, database, "isolated", fn, database.execute_isolated_fn
+    )
+    # For the tests
+    datasette._datasette_edit_schema_used_execute_isolated_fn = True
+    return result
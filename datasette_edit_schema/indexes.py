@@ -0,0 +1,232 @@
+"""
+Creating indexes on several columns, on expressions and partial indexes.
+
+An index is described by a list of terms, each a column name or an SQL
+expression such as lower(email) or json_extract(data, '$.id'), optionally
+followed by ASC or DESC, plus an optional WHERE clause for a partial index:
+
+    terms = parse_terms("city, created desc, lower(email)")
+    sql = create_index_sql(conn, "users", terms, where="deleted = 0")
+
+Everything is checked before the index is built: the expressions are
+checked on their own for anything that could break out of them, then
+SQLite prepares the CREATE INDEX statement with EXPLAIN, which reports
+syntax errors, unknown columns in expressions and non-deterministic
+functions without touching the database. Unique indexes are also checked
+for duplicate values by check_duplicates(), which needs a full scan of
+the table so is run by the job rather than the request.
+"""
+
+from dataclasses import dataclass
+import re
+from datasette.utils import sqlite3
+from .dependencies import TOKEN_RE
+
+ORDER_RE = re.compile(r"^(?P<term>.*?)\s+(?P<order>asc|desc)$", re.I | re.S)
+
+
+class IndexDefinitionError(Exception):
+    pass
+
+
+def quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+@dataclass
+class IndexTerm:
+    # A column name if expression is False, SQL otherwise
+    sql: str
+    expression: bool = False
+    desc: bool = False
+
+    def to_sql(self):
+        return self.expression_sql() + (" DESC" if self.desc else "")
+
+    def expression_sql(self):
+        if self.expression:
+            return "({})".format(self.sql)
+        return quote_identifier(self.sql)
+
+    def __str__(self):
+        return self.sql + (" desc" if self.desc else "")
+
+
+def _masked(sql):
+    """
+    sql with string literals and quoted identifiers replaced by the same
+    number of x characters, so punctuation inside them can be ignored.
+    Raises IndexDefinitionError for comments.
+    """
+
+    def replace(match):
+        skip = match.group("skip")
+        if skip is not None and not skip.startswith("'"):
+            raise IndexDefinitionError("Comments are not allowed in index definitions")
+        if match.group("bare") is not None:
+            return match.group(0)
+        return "x" * len(match.group(0))
+
+    return TOKEN_RE.sub(replace, sql)
+
+
+def _split_top_level(sql):
+    "Splits sql on commas that are not inside brackets, literals or quotes"
+    masked = _masked(sql)
+    parts = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(masked):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth < 0:
+                raise IndexDefinitionError("Unbalanced brackets in '{}'".format(sql))
+        elif char == ";":
+            raise IndexDefinitionError("Index definitions cannot contain ';'")
+        elif char == "," and depth == 0:
+            parts.append(sql[start:i])
+            start = i + 1
+    if depth:
+        raise IndexDefinitionError("Unbalanced brackets in '{}'".format(sql))
+    parts.append(sql[start:])
+    return parts
+
+
+def check_expression(sql):
+    "Raises IndexDefinitionError unless sql is a single self-contained expression"
+    if not sql.strip():
+        raise IndexDefinitionError("Expression is required")
+    if len(_split_top_level(sql)) != 1:
+        raise IndexDefinitionError(
+            "'{}' should be a single expression, without commas outside of "
+            "brackets".format(sql)
+        )
+
+
+def parse_terms(text, columns=()):
+    """
+    Splits "city, created desc, lower(email)" into IndexTerms. Terms that
+    match one of the columns - bare or in double quotes - are treated as
+    column names, anything else as an expression.
+    """
+    terms = []
+    by_lower = {column.lower(): column for column in columns}
+    for part in _split_top_level(text or ""):
+        part = part.strip()
+        if not part:
+            continue
+        desc = False
+        match = ORDER_RE.match(part)
+        if match:
+            part = match.group("term").strip()
+            desc = match.group("order").lower() == "desc"
+        name = part
+        if len(name) > 1 and name[0] == name[-1] == '"':
+            name = name[1:-1].replace('""', '"')
+        if name.lower() in by_lower:
+            terms.append(IndexTerm(by_lower[name.lower()], desc=desc))
+        else:
+            terms.append(IndexTerm(part, expression=True, desc=desc))
+    return terms
+
+
+def default_index_name(table, terms):
+    "idx_{table}_{columns}, the name sqlite-utils would use for the columns"
+    return "idx_{}_{}".format(
+        table.replace(" ", "_"),
+        "_".join(
+            (
+                re.sub(r"\W+", "_", term.sql).strip("_").lower()
+                if term.expression
+                else term.sql
+            )
+            for term in terms
+        ),
+    )
+
+
+def unique_index_name(conn, name):
+    existing = {
+        row[0].lower()
+        for row in conn.execute("select name from sqlite_master where type = 'index'")
+    }
+    suffix = None
+    while True:
+        candidate = "{}_{}".format(name, suffix) if suffix else name
+        if candidate.lower() not in existing:
+            return candidate
+        suffix = 2 if suffix is None else suffix + 1
+
+
+def create_index_sql(conn, table, terms, unique=False, where=None, name=None):
+    """
+    The CREATE INDEX statement for the terms, with a name that is not
+    already taken. Raises IndexDefinitionError if SQLite would reject it.
+    """
+    if not terms:
+        raise IndexDefinitionError("Column name is required")
+    table_columns = {
+        row[1] for row in conn.execute("select * from pragma_table_info(?)", [table])
+    }
+    for term in terms:
+        if term.expression:
+            check_expression(term.sql)
+        elif term.sql not in table_columns:
+            # SQLite would treat an unknown "column" as a string literal
+            raise IndexDefinitionError("no such column: {}".format(term.sql))
+    where = (where or "").strip()
+    if where:
+        check_expression(where)
+    name = unique_index_name(conn, name or default_index_name(table, terms))
+    sql = "CREATE {}INDEX {} ON {} ({}){}".format(
+        "UNIQUE " if unique else "",
+        quote_identifier(name),
+        quote_identifier(table),
+        ", ".join(term.to_sql() for term in terms),
+        " WHERE {}".format(where) if where else "",
+    )
+    try:
+        # Prepares the statement without running it, which works on a
+        # read-only connection too
+        conn.execute("EXPLAIN " + sql).fetchall()
+    except sqlite3.Error as e:
+        raise IndexDefinitionError(str(e))
+    return sql
+
+
+def check_duplicates(conn, table, terms, where=None):
+    """
+    Raises IndexDefinitionError with the message SQLite would give if a
+    unique index on the terms would fail because of duplicate values.
+    Rows with a null in any term are ignored, as they are by the index.
+    """
+    expressions = [term.expression_sql() for term in terms]
+    conditions = ["{} is not null".format(expression) for expression in expressions]
+    if where:
+        conditions.append("({})".format(where))
+    duplicate = conn.execute(
+        "select 1 from {} where {} group by {} having count(*) > 1 limit 1".format(
+            quote_identifier(table), " and ".join(conditions), ", ".join(expressions)
+        )
+    ).fetchone()
+    if duplicate:
+        if any(term.expression for term in terms):
+            raise IndexDefinitionError("UNIQUE constraint failed: index expression")
+        raise IndexDefinitionError(
+            "UNIQUE constraint failed: {}".format(
+                ", ".join("{}.{}".format(table, term.sql) for term in terms)
+            )
+        )
+
+
+def index_definitions(conn, table):
+    "{index_name: CREATE INDEX sql} for the table's explicitly created indexes"
+    return dict(
+        conn.execute(
+            "select name, sql from sqlite_master "
+            "where type = 'index' and tbl_name = ? and sql is not null",
+            [table],
+        ).fetchall()
+    )
@@ -0,0 +1,218 @@
+"""
+Long running schema changes - table rebuilds, new indexes and VACUUM - run
+as background jobs, so they can carry on after the request that started
+them has returned.
+
+Each job is an asyncio task that makes its database calls through
+job.wrap(), which keeps track of the connection in use so job.cancel() can
+interrupt whatever statement is running. The interrupted transaction is
+rolled back and the job finishes with a status of "cancelled".
+
+Datasette's read connections are shared with other requests, so calls made
+with execute_read() are wrapped with interrupt=False: they are never
+interrupted, a progress handler stops them instead.
+"""
+
+from contextlib import contextmanager
+from datasette.utils import sqlite3
+import asyncio
+import datetime
+import itertools
+import threading
+import time
+import traceback
+
+# How long a request waits for its job before redirecting to the job page
+JOB_WAIT_MS = 2_000
+# Finished jobs are forgotten after this many more have finished
+FINISHED_JOBS_TO_KEEP = 100
+# SQLite virtual machine instructions between checks for cancellation
+PROGRESS_HANDLER_INSTRUCTIONS = 10_000
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, id, database_name, table, description, actor=None):
+        self.id = id
+        self.database_name = database_name
+        self.table = table
+        self.description = description
+        self.actor = actor
+        # running, finished, failed or cancelled
+        self.status = "running"
+        self.started = time.monotonic()
+        self.started_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self.finished = None
+        self.rows_processed = 0
+        # None if not known
+        self.rows_total = None
+        # Set by jobs that can tell how far through they are better than
+        # rows_processed / rows_total can
+        self.fraction = None
+        self.error = None
+        # [(message, datasette.INFO / WARNING / ERROR)]
+        self.messages = []
+        # Where to go once the job has finished
+        self.redirect = None
+        self._cancelled = threading.Event()
+        # The connection cancel() can interrupt, guarded by _lock so it is
+        # never interrupted after it has been handed back
+        self._conn = None
+        self._lock = threading.Lock()
+        self._task = None
+
+    @property
+    def done(self):
+        return self.status != "running"
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def progress(self):
+        "Fraction of the work that has been done, or None if not known"
+        if self.status == "finished":
+            return 1.0
+        if self.fraction is not None:
+            return self.fraction
+        if self.rows_total:
+            return min(self.rows_processed / self.rows_total, 1.0)
+        return None
+
+    @property
+    def eta(self):
+        "Estimated seconds until the job finishes, or None if not known"
+        progress = self.progress
+        if self.done or not progress:
+            return None
+        return self.elapsed * (1 - progress) / progress
+
+    def add_message(self, message, type):
+        self.messages.append((message, type))
+
+    def cancel(self):
+        self._cancelled.set()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.interrupt()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    @contextmanager
+    def running(self, conn, interrupt=True):
+        """
+        Run database calls for this job on conn, so they can be cancelled.
+        Pass interrupt=False for connections the job does not own.
+        """
+        self.check_cancelled()
+        if interrupt:
+            with self._lock:
+                self._conn = conn
+        # Catches a cancel() that arrives between statements
+        conn.set_progress_handler(
+            lambda: 1 if self.cancelled else 0, PROGRESS_HANDLER_INSTRUCTIONS
+        )
+        try:
+            yield
+        except sqlite3.OperationalError as e:
+            if self.cancelled and "interrupted" in str(e):
+                raise JobCancelled() from e
+            raise
+        finally:
+            with self._lock:
+                self._conn = None
+            conn.set_progress_handler(None, 0)
+
+    def wrap(self, fn, interrupt=True):
+        """
+        Wraps a function to be passed to execute_write() and friends. Use
+        interrupt=False for execute_read(), which runs on shared connections
+        """
+
+        def inner(conn):
+            with self.running(conn, interrupt):
+                return fn(conn)
+
+        return inner
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "database": self.database_name,
+            "table": self.table,
+            "description": self.description,
+            "status": self.status,
+            "started": self.started_at,
+            "elapsed_ms": round(self.elapsed * 1000),
+            "rows_processed": self.rows_processed,
+            "rows_total": self.rows_total,
+            "progress": None if self.progress is None else round(self.progress, 4),
+            "eta_ms": None if self.eta is None else round(self.eta * 1000),
+            "error": self.error,
+            "messages": [message for message, _ in self.messages],
+        }
+
+
+class JobManager:
+    def __init__(self, finished_to_keep=FINISHED_JOBS_TO_KEEP):
+        self.finished_to_keep = finished_to_keep
+        self._ids = itertools.count(1)
+        # {id: Job}, oldest first
+        self.jobs = {}
+
+    def start(self, database_name, table, description, work, actor=None):
+        """
+        Starts running work(job) in the background, returns the Job.
+        work is an async function that makes its database calls with
+        job.wrap() and reports back using job.add_message()
+        """
+        job = Job(next(self._ids), database_name, table, description, actor)
+
+        async def run():
+            try:
+                await work(job)
+                job.status = "finished"
+            except JobCancelled:
+                job.status = "cancelled"
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+                traceback.print_exc()
+            finally:
+                job.finished = time.monotonic()
+                self._forget_finished()
+
+        job._task = asyncio.create_task(run())
+        self.jobs[job.id] = job
+        return job
+
+    async def wait(self, job, timeout):
+        "Waits up to timeout seconds for the job, returns True if it has finished"
+        done, _ = await asyncio.wait([job._task], timeout=timeout)
+        return bool(done)
+
+    def get(self, id):
+        return self.jobs.get(id)
+
+    def _forget_finished(self):
+        finished = [id for id, job in self.jobs.items() if job.done]
+        for id in finished[: -self.finished_to_keep or None]:
+            del self.jobs[id]
+
+
+def get_job_manager(datasette):
+    manager = getattr(datasette, "_edit_schema_job_manager", None)
+    if manager is None:
+        manager = JobManager()
+        datasette._edit_schema_job_manager = manager
+    return manager
@@ -0,0 +1,297 @@
+"""
+Rebuilding a large table without holding the write lock for the whole copy.
+
+sqlite-utils' transform() copies every row inside a single transaction,
+which blocks every other writer to the database until it finishes.
+OnlineRebuild splits that into steps, each of which is a short transaction:
+
+1. start() creates the new table, plus a change log table and triggers on
+   the old table that record the rowid of every row inserted, updated or
+   deleted from now on - by any connection
+2. copy_batch() copies the next range of rowids into the new table
+3. catch_up() copies the rows recorded in the change log again, deleting
+   them from the new table first so deletes are copied too
+4. swap() catches up with the last few changes, drops the old table and
+   renames the new one in its place, all in one transaction. If the old
+   table or its indexes were altered since start() the rebuild is
+   aborted instead, as those changes would be lost
+
+Only rowid tables can be rebuilt like this, WITHOUT ROWID tables are
+copied with transform() as usual.
+"""
+
+import sqlite_utils
+from .alter import foreign_keys_off, transaction
+from .dependencies import dependent_objects, drop_dependents, recreate_dependents
+from .execution import execute_write
+from .indexes import quote_identifier
+
+# Tables with at least this many rows are rebuilt online
+ONLINE_REBUILD_MIN_ROWS = 100_000
+# Rows copied in each transaction
+ONLINE_REBUILD_BATCH_SIZE = 10_000
+# Maximum number of rowids in a single "rowid in (...)" clause
+ROWIDS_PER_STATEMENT = 500
+PREFIX = "_edit_schema_online_"
+# Passed to transform_sql(), which names its new table {table}_new_{suffix}
+TMP_SUFFIX = "edit_schema_online"
+
+
+class TableChanged(Exception):
+    "The table was altered by something else while it was being rebuilt"
+
+
+class OnlineRebuild:
+    def __init__(
+        self,
+        table,
+        types=None,
+        rename=None,
+        drop=None,
+        column_order=None,
+        batch_size=ONLINE_REBUILD_BATCH_SIZE,
+    ):
+        self.table = table
+        self.types = types
+        self.rename = rename
+        self.drop = drop
+        self.column_order = column_order
+        self.batch_size = batch_size
+        self.new_table = "{}new_{}".format(PREFIX, table)
+        self.log_table = "{}log_{}".format(PREFIX, table)
+        self.triggers = [
+            "{}{}_{}".format(PREFIX, operation, table)
+            for operation in ("insert", "update", "delete")
+        ]
+        # Populated by start()
+        self.schema = None
+        self.copy_sql = None
+        self.index_sqls = []
+        self.min_rowid = None
+        self.max_rowid = None
+        # The last rowid copied by copy_batch()
+        self.copied_up_to = None
+        self.rows_copied = 0
+        self.changes_copied = 0
+
+    @property
+    def progress(self):
+        "Estimated fraction of the table that has been copied, from 0 to 1"
+        if self.max_rowid is None or self.copied_up_to is None:
+            return 0.0
+        if self.max_rowid <= self.min_rowid:
+            return 1.0
+        return min(
+            (self.copied_up_to - self.min_rowid) / (self.max_rowid - self.min_rowid),
+            1.0,
+        )
+
+    def schema_sql(self, conn):
+        "The CREATE statements for the table and its indexes"
+        return conn.execute(
+            "select type, name, sql from sqlite_master "
+            "where tbl_name = ? and type in ('table', 'index') order by name",
+            [self.table],
+        ).fetchall()
+
+    def _use_new_table(self, sql):
+        "sql from transform_sql(), using new_table in place of its temporary table"
+        temporary_name = "[{}_new_{}]".format(self.table, TMP_SUFFIX)
+        if temporary_name not in sql:
+            raise ValueError("Expected {} in {}".format(temporary_name, sql))
+        return sql.replace(temporary_name, quote_identifier(self.new_table), 1)
+
+    def start(self, conn):
+        "Creates the new table, the change log and the triggers that fill it"
+        sqls = sqlite_utils.Database(conn)[self.table].transform_sql(
+            types=self.types,
+            rename=self.rename,
+            drop=self.drop,
+            column_order=self.column_order,
+            tmp_suffix=TMP_SUFFIX,
+        )
+        # [create new table, copy rows, drop old table, rename, *indexes]
+        create_sql = self._use_new_table(sqls[0])
+        self.copy_sql = self._use_new_table(sqls[1].rstrip(";"))
+        self.index_sqls = sqls[4:]
+        with transaction(conn):
+            self.schema = self.schema_sql(conn)
+            conn.execute(create_sql)
+            conn.execute(
+                "create table {} (seq integer primary key, row_id integer)".format(
+                    quote_identifier(self.log_table)
+                )
+            )
+            for trigger, event, values in zip(
+                self.triggers,
+                ("insert", "update", "delete"),
+                ("(new.rowid)", "(old.rowid), (new.rowid)", "(old.rowid)"),
+            ):
+                conn.execute(
+                    "create trigger {} after {} on {} begin "
+                    "insert into {} (row_id) values {}; end".format(
+                        quote_identifier(trigger),
+                        event,
+                        quote_identifier(self.table),
+                        quote_identifier(self.log_table),
+                        values,
+                    )
+                )
+            # Rows added after this are copied by catch_up()
+            self.min_rowid, self.max_rowid = conn.execute(
+                "select min(rowid), max(rowid) from {}".format(
+                    quote_identifier(self.table)
+                )
+            ).fetchone()
+        if self.min_rowid is None:
+            self.min_rowid = self.max_rowid = 0
+        self.copied_up_to = self.min_rowid - 1
+
+    def copy_batch(self, conn):
+        "Copies the next batch of rows, returns False once every row is copied"
+        if self.copied_up_to >= self.max_rowid:
+            return False
+        with transaction(conn):
+            # The rowid that ends this batch, or the end of the table
+            row = conn.execute(
+                "select rowid from {} where rowid > ? and rowid <= ? "
+                "order by rowid limit 1 offset ?".format(quote_identifier(self.table)),
+                [self.copied_up_to, self.max_rowid, self.batch_size - 1],
+            ).fetchone()
+            up_to = row[0] if row else self.max_rowid
+            cursor = conn.execute(
+                self.copy_sql.replace("INSERT INTO", "INSERT OR REPLACE INTO", 1)
+                + " WHERE rowid > ? AND rowid <= ?",
+                [self.copied_up_to, up_to],
+            )
+            self.rows_copied += cursor.rowcount
+        self.copied_up_to = up_to
+        return self.copied_up_to < self.max_rowid
+
+    def _catch_up(self, conn, limit):
+        rows = conn.execute(
+            "select seq, row_id from {} order by seq limit ?".format(
+                quote_identifier(self.log_table)
+            ),
+            [limit],
+        ).fetchall()
+        if not rows:
+            return 0
+        rowids = sorted({row[1] for row in rows})
+        for i in range(0, len(rowids), ROWIDS_PER_STATEMENT):
+            chunk = rowids[i : i + ROWIDS_PER_STATEMENT]
+            placeholders = ", ".join("?" for _ in chunk)
+            conn.execute(
+                "delete from {} where rowid in ({})".format(
+                    quote_identifier(self.new_table), placeholders
+                ),
+                chunk,
+            )
+            conn.execute(
+                self.copy_sql + " WHERE rowid IN ({})".format(placeholders), chunk
+            )
+        conn.execute(
+            "delete from {} where seq <= ?".format(quote_identifier(self.log_table)),
+            [rows[-1][0]],
+        )
+        self.changes_copied += len(rows)
+        return len(rows)
+
+    def catch_up(self, conn):
+        """
+        Copies up to batch_size rows from the change log, returns the number
+        of changes that were copied
+        """
+        with transaction(conn):
+            return self._catch_up(conn, self.batch_size)
+
+    def pending_changes(self, conn):
+        return conn.execute(
+            "select count(*) from {}".format(quote_identifier(self.log_table))
+        ).fetchone()[0]
+
+    def swap(self, conn):
+        """
+        Copies the remaining changes and replaces the old table with the new
+        one. Aborts the rebuild and raises TableChanged if the old table or
+        its indexes have been altered since start().
+        """
+        with foreign_keys_off(conn) as foreign_keys_were_on:
+            try:
+                with transaction(conn):
+                    if self.schema_sql(conn) != self.schema:
+                        raise TableChanged(
+                            "Table {} was altered while it was being rebuilt, "
+                            "try again".format(self.table)
+                        )
+                    self._swap(conn)
+                    # Run the foreign_key_check before we commit
+                    if foreign_keys_were_on:
+                        conn.execute("PRAGMA foreign_key_check;")
+            except TableChanged:
+                self.abort(conn)
+                raise
+
+    def _swap(self, conn):
+        while self._catch_up(conn, self.batch_size):
+            pass
+        # Not including the triggers that record changes for the rebuild
+        dependents = [
+            obj
+            for obj in dependent_objects(conn, self.table)
+            if not obj.name.startswith(PREFIX)
+        ]
+        drop_dependents(conn, dependents)
+        # Dropping the table drops the change log triggers too
+        conn.execute("drop table {}".format(quote_identifier(self.table)))
+        conn.execute("drop table {}".format(quote_identifier(self.log_table)))
+        conn.execute(
+            "alter table {} rename to {}".format(
+                quote_identifier(self.new_table), quote_identifier(self.table)
+            )
+        )
+        for sql in self.index_sqls:
+            conn.execute(sql)
+        recreate_dependents(conn, dependents)
+
+    def abort(self, conn):
+        "Removes everything start() created, leaving the old table untouched"
+        if conn.in_transaction:
+            conn.execute("rollback")
+        with transaction(conn):
+            for trigger in self.triggers:
+                conn.execute(
+                    "drop trigger if exists {}".format(quote_identifier(trigger))
+                )
+            for table in (self.log_table, self.new_table):
+                conn.execute("drop table if exists {}".format(quote_identifier(table)))
+
+
+async def rebuild_table_online(datasette, database, rebuild, job=None):
+    """
+    Runs an OnlineRebuild with each step as a separate write, so other
+    writes queued for this database run in between batches. Progress is
+    reported to job, which can cancel the rebuild between or during steps.
+    """
+
+    async def step(fn):
+        result = await execute_write(
+            datasette, database, fn if job is None else job.wrap(fn)
+        )
+        if job is not None:
+            job.rows_processed = rebuild.rows_copied
+            job.fraction = rebuild.progress
+        return result
+
+    await step(rebuild.start)
+    try:
+        while await step(rebuild.copy_batch):
+            await step(rebuild.catch_up)
+        # Get the change log down to one batch before swapping, so swap()
+        # holds the write lock as briefly as possible
+        while await step(rebuild.pending_changes) > rebuild.batch_size:
+            await step(rebuild.catch_up)
+        await step(rebuild.swap)
+    except BaseException:
+        await execute_write(datasette, database, rebuild.abort)
+        raise
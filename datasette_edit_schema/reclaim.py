@@ -0,0 +1,220 @@
+"""
+Reclaiming the space left behind when a table is deleted.
+
+Dropping a table moves its pages to the database file's freelist, where
+they are reused by later writes but not returned to the operating system.
+A full VACUUM rewrites the whole file to get rid of them, which can take
+minutes for a large database and blocks every write while it runs. The
+reclaim_strategy plugin setting picks what happens instead:
+
+- "vacuum" - a full VACUUM straight after the drop, the default
+- "none" - leave the free pages where they are
+- "incremental" - PRAGMA incremental_vacuum, a limited number of pages at
+  a time with other writes running in between. This only works for
+  databases with auto_vacuum set to incremental
+- "deferred" - remember the database and VACUUM it later, during the
+  reclaim_window if one is configured, see ReclaimScheduler
+"""
+
+import asyncio
+import datetime
+import math
+import traceback
+from .execution import execute_isolated, execute_read, execute_write
+from .jobs import get_job_manager
+
+RECLAIM_STRATEGIES = ("vacuum", "none", "incremental", "deferred")
+# Pages freed by each PRAGMA incremental_vacuum
+INCREMENTAL_VACUUM_PAGES = 1_000
+# How often ReclaimScheduler checks for databases to VACUUM
+RECLAIM_CHECK_INTERVAL_SECONDS = 300
+AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+
+
+def freelist_stats(conn):
+    "How much of the database file is free pages"
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return {
+        "page_size": page_size,
+        "page_count": page_count,
+        "freelist_count": freelist_count,
+        "free_bytes": freelist_count * page_size,
+        "free_fraction": round(freelist_count / page_count, 4) if page_count else 0.0,
+        "auto_vacuum": AUTO_VACUUM_MODES.get(
+            conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        ),
+    }
+
+
+def format_bytes(size):
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    if unit == "bytes":
+        return "{:,} bytes".format(size)
+    return "{:,.1f} {}".format(size, unit)
+
+
+def vacuum(conn):
+    conn.execute("VACUUM")
+
+
+def incremental_vacuum_step(conn, pages=INCREMENTAL_VACUUM_PAGES):
+    "Frees up to pages free pages, returns the number still free afterwards"
+    # execute() only steps the pragma once, freeing a single page, whereas
+    # executescript() runs it to completion
+    conn.executescript("PRAGMA incremental_vacuum({})".format(int(pages)))
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+async def incremental_vacuum(
+    datasette, database, job=None, pages=INCREMENTAL_VACUUM_PAGES
+):
+    """
+    Frees the free pages, pages at a time with each step a separate write,
+    stopping once it has taken enough steps to free as many pages as there
+    were to begin with or a step frees nothing. Returns the number of bytes
+    there were to free, or None if the database does not have auto_vacuum
+    set to incremental.
+    """
+
+    def wrap(fn, interrupt=True):
+        return fn if job is None else job.wrap(fn, interrupt)
+
+    stats = await execute_read(database, wrap(freelist_stats, interrupt=False))
+    if stats["auto_vacuum"] != "incremental":
+        return None
+    start = remaining = stats["freelist_count"]
+    # Other writes can free more pages in between steps, so stop after
+    # enough steps to free the pages there were to begin with
+    for _ in range(math.ceil(start / pages)):
+        before = remaining
+        remaining = await execute_write(
+            datasette,
+            database,
+            wrap(lambda conn: incremental_vacuum_step(conn, pages)),
+        )
+        if job is not None:
+            job.fraction = min(max((start - remaining) / start, 0.0), 1.0)
+        if not remaining or remaining >= before:
+            break
+    return start * stats["page_size"]
+
+
+async def reclaim_space(datasette, database, strategy, job):
+    """
+    Reclaims free space after a table has been dropped, using any strategy
+    other than "vacuum" - which has to run in the same isolated call as the
+    drop itself. Reports what happened using job.add_message().
+    """
+    if strategy == "incremental":
+        freed = await incremental_vacuum(datasette, database, job)
+        if freed is None:
+            job.add_message(
+                "Free space was not reclaimed because this database does not "
+                "have auto_vacuum set to incremental",
+                datasette.WARNING,
+            )
+        elif freed:
+            job.add_message("Reclaimed {}".format(format_bytes(freed)), datasette.INFO)
+    else:
+        stats = await execute_read(database, freelist_stats)
+        if not stats["freelist_count"]:
+            return
+        if strategy == "deferred":
+            scheduler = getattr(datasette, "_edit_schema_reclaim_scheduler", None)
+            if scheduler is not None:
+                scheduler.add(database.name)
+                job.add_message(
+                    "{} of free space will be reclaimed later{}".format(
+                        format_bytes(stats["free_bytes"]),
+                        (
+                            ", between {:%H:%M} and {:%H:%M}".format(*scheduler.window)
+                            if scheduler.window
+                            else ""
+                        ),
+                    ),
+                    datasette.INFO,
+                )
+                return
+        job.add_message(
+            "The database file has {} of free space, which a VACUUM would "
+            "reclaim".format(format_bytes(stats["free_bytes"])),
+            datasette.INFO,
+        )
+
+
+def parse_window(window):
+    "'02:00-05:00' becomes (time(2, 0), time(5, 0))"
+    start, end = window.split("-")
+    return tuple(
+        datetime.datetime.strptime(value.strip(), "%H:%M").time()
+        for value in (start, end)
+    )
+
+
+class ReclaimScheduler:
+    """
+    VACUUMs databases that have had tables dropped using the "deferred"
+    strategy, checking every interval seconds. If window is set the VACUUM
+    only runs between those local times, which can span midnight.
+    """
+
+    def __init__(self, datasette, window=None, interval=RECLAIM_CHECK_INTERVAL_SECONDS):
+        self.datasette = datasette
+        self.window = parse_window(window) if window else None
+        self.interval = interval
+        # Names of databases waiting for a VACUUM
+        self.pending = set()
+        self._lock = asyncio.Lock()
+
+    def add(self, database_name):
+        self.pending.add(database_name)
+
+    def in_window(self, now):
+        if self.window is None:
+            return True
+        start, end = self.window
+        time = now.time()
+        if start <= end:
+            return start <= time < end
+        return time >= start or time < end
+
+    async def run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self, now=None):
+        "VACUUMs every pending database, if it is within the window"
+        if not self.in_window(now or datetime.datetime.now()):
+            return
+        async with self._lock:
+            for name in sorted(self.pending):
+                self.pending.discard(name)
+                database = self.datasette.databases.get(name)
+                if database is None:
+                    continue
+                stats = await execute_read(database, freelist_stats)
+                if not stats["freelist_count"]:
+                    continue
+
+                async def work(job):
+                    await execute_isolated(self.datasette, database, job.wrap(vacuum))
+                    job.add_message(
+                        "Reclaimed {}".format(format_bytes(stats["free_bytes"])),
+                        self.datasette.INFO,
+                    )
+
+                manager = get_job_manager(self.datasette)
+                job = manager.start(name, None, "Reclaiming free space", work)
+                await manager.wait(job, None)
+                if job.status != "finished":
+                    # Try again next time
+                    self.pending.add(name)
@@ -0,0 +1,244 @@
+"""
+Cheap per-column summaries ("sketches") used to rule out foreign key
+candidates before running an anti-join against every other table.
+"""
+
+import json
+
+# Aggregates are calculated for this many columns per query, to stay well
+# clear of SQLite's limit on the number of result columns
+COLUMNS_PER_QUERY = 100
+# Distinct values are counted in this many rows - a lower bound on the
+# number of distinct values in the whole column
+DISTINCT_SAMPLE_SIZE = 1_000
+
+NUMERIC_AFFINITIES = {"INTEGER", "REAL", "NUMERIC"}
+
+
+def sqlite_affinity(declared_type):
+    # https://www.sqlite.org/datatype3.html#determination_of_column_affinity
+    declared_type = (declared_type or "").upper()
+    if "INT" in declared_type:
+        return "INTEGER"
+    if "CHAR" in declared_type or "CLOB" in declared_type or "TEXT" in declared_type:
+        return "TEXT"
+    if "BLOB" in declared_type or not declared_type:
+        return "BLOB"
+    if "REAL" in declared_type or "FLOA" in declared_type or "DOUB" in declared_type:
+        return "REAL"
+    return "NUMERIC"
+
+
+class ColumnSketch:
+    def __init__(self, affinity, binary_collation=True):
+        self.affinity = affinity
+        # False if the column might use a non-default collating sequence
+        self.binary_collation = binary_collation
+        self.rows = 0
+        self.nulls = 0
+        self.integers = 0
+        self.reals = 0
+        self.texts = 0
+        self.blobs = 0
+        # Text values that SQLite would convert to numbers if numeric
+        # affinity was applied to them, e.g. '12' - a lower bound, as the
+        # check relies on CAST behaving the same way as affinity
+        self.numeric_texts = 0
+        # Text values made up of the characters of a number, e.g. '12',
+        # ' 1e-3' or '1e' - an upper bound on numeric_texts
+        self.maybe_numeric_texts = 0
+        self.numeric_min = None
+        self.numeric_max = None
+        self.text_min = None
+        self.text_max = None
+        self.length_min = None
+        self.length_max = None
+        self.distinct_lower_bound = 0
+
+    @property
+    def numerics(self):
+        return self.integers + self.reals
+
+    def __eq__(self, other):
+        return isinstance(other, ColumnSketch) and vars(self) == vars(other)
+
+    def __repr__(self):
+        return "<ColumnSketch {}>".format(
+            ", ".join("{}={!r}".format(key, value) for key, value in vars(self).items())
+        )
+
+
+def rowid_filter(rowids):
+    "Returns (where_clause, params) restricting a query to rowids, if provided"
+    if rowids is None:
+        return "", []
+    return "rowid in (select value from json_each(?))", [json.dumps(list(rowids))]
+
+
+def _declared_columns(conn, table):
+    "Returns ({column: affinity}, binary_collation) for a table"
+    affinities = {
+        name: sqlite_affinity(declared_type)
+        for name, declared_type in conn.execute(
+            "select name, type from pragma_table_info(?)", [table]
+        ).fetchall()
+    }
+    sql = conn.execute(
+        "select sql from sqlite_master where name = ?", [table]
+    ).fetchone()
+    binary_collation = not (sql and sql[0] and "collate" in sql[0].lower())
+    return affinities, binary_collation
+
+
+def column_sketches(conn, table, columns, rowids=None):
+    """
+    Returns {column: ColumnSketch} for the specified columns, optionally
+    only considering the rows with the specified rowids
+    """
+    where, params = rowid_filter(rowids)
+    where = " where {}".format(where) if where else ""
+    affinities, binary_collation = _declared_columns(conn, table)
+    sketches = {
+        column: ColumnSketch(affinities.get(column, "BLOB"), binary_collation)
+        for column in columns
+    }
+    fields = (
+        ("nulls", "sum({c} is null)"),
+        ("integers", "sum(typeof({c}) = 'integer')"),
+        ("reals", "sum(typeof({c}) = 'real')"),
+        ("texts", "sum(typeof({c}) = 'text')"),
+        ("blobs", "sum(typeof({c}) = 'blob')"),
+        ("numeric_texts", "sum(typeof({c}) = 'text' and {c} = cast({c} as numeric))"),
+        (
+            "maybe_numeric_texts",
+            "sum(typeof({c}) = 'text' and {c} glob '*[0-9]*' "
+            "and {c} not glob '*[^ +.0-9eE-]*' and {c} not glob '*[0-9.][+-]*')",
+        ),
+        (
+            "numeric_min",
+            "min(case when typeof({c}) in ('integer', 'real') then {c} end)",
+        ),
+        (
+            "numeric_max",
+            "max(case when typeof({c}) in ('integer', 'real') then {c} end)",
+        ),
+        ("text_min", "min(case when typeof({c}) = 'text' then {c} end)"),
+        ("text_max", "max(case when typeof({c}) = 'text' then {c} end)"),
+        ("length_min", "min(case when typeof({c}) = 'text' then length({c}) end)"),
+        ("length_max", "max(case when typeof({c}) = 'text' then length({c}) end)"),
+    )
+    columns = list(columns)
+    for i in range(0, len(columns), COLUMNS_PER_QUERY):
+        batch = columns[i : i + COLUMNS_PER_QUERY]
+        selects = ["count(*)"]
+        for column in batch:
+            quoted = '"{}"'.format(column)
+            selects.extend(template.format(c=quoted) for _, template in fields)
+        row = conn.execute(
+            'select {} from "{}"{}'.format(", ".join(selects), table, where), params
+        ).fetchone()
+        for j, column in enumerate(batch):
+            sketch = sketches[column]
+            sketch.rows = row[0]
+            values = row[1 + j * len(fields) : 1 + (j + 1) * len(fields)]
+            for (name, _), value in zip(fields, values):
+                if name in (
+                    "nulls",
+                    "integers",
+                    "reals",
+                    "texts",
+                    "blobs",
+                    "numeric_texts",
+                    "maybe_numeric_texts",
+                ):
+                    value = value or 0
+                setattr(sketch, name, value)
+        # Count distinct values in the first rows of the table
+        distinct_selects = ['count(distinct "{}")'.format(column) for column in batch]
+        row = conn.execute(
+            'select {} from (select {} from "{}"{} limit {})'.format(
+                ", ".join(distinct_selects),
+                ", ".join('"{}"'.format(column) for column in batch),
+                table,
+                where,
+                DISTINCT_SAMPLE_SIZE,
+            ),
+            params,
+        ).fetchone()
+        for column, distinct in zip(batch, row):
+            sketches[column].distinct_lower_bound = distinct
+    return sketches
+
+
+def primary_key_sketch(conn, table, column):
+    return column_sketches(conn, table, [column])[column]
+
+
+def could_match(column_sketch, pk_sketch):
+    """
+    False if the column definitely contains a value that is missing from the
+    primary key column, based on the two sketches alone
+    """
+    if column_sketch.rows == 0:
+        return True
+    # NULL is never equal to anything, so those rows could never match
+    if column_sketch.nulls:
+        return False
+    if pk_sketch.rows == 0:
+        return False
+    column_numeric = column_sketch.affinity in NUMERIC_AFFINITIES
+    pk_numeric = pk_sketch.affinity in NUMERIC_AFFINITIES
+    if column_numeric != pk_numeric:
+        # https://www.sqlite.org/datatype3.html#type_conversions_prior_to_comparison
+        # numeric affinity is applied to the non-numeric side, so text that
+        # looks like a number is compared as a number. Text that definitely
+        # converts needs a number to match, text that might convert is not
+        # assumed to stay text
+        if column_numeric:
+            if column_sketch.numerics and not (
+                pk_sketch.numerics or pk_sketch.maybe_numeric_texts
+            ):
+                return False
+        else:
+            if (
+                column_sketch.numerics or column_sketch.numeric_texts
+            ) and not pk_sketch.numerics:
+                return False
+            if (
+                column_sketch.texts - column_sketch.maybe_numeric_texts
+            ) and not pk_sketch.texts:
+                return False
+        return True
+    if not column_numeric and column_sketch.affinity != pk_sketch.affinity:
+        # TEXT against BLOB applies text affinity - don't risk it
+        return True
+    # Values are compared without conversions, so storage classes must line up
+    if column_sketch.numerics:
+        if not pk_sketch.numerics:
+            return False
+        if (
+            column_sketch.numeric_min < pk_sketch.numeric_min
+            or column_sketch.numeric_max > pk_sketch.numeric_max
+        ):
+            return False
+    # Text comparisons use the collation of the column on the left, but the
+    # other column's collation decides which values its primary key treats
+    # as duplicates - so only compare text values if both are binary
+    binary_collation = column_sketch.binary_collation and pk_sketch.binary_collation
+    if column_sketch.texts:
+        if not pk_sketch.texts:
+            return False
+        if binary_collation:
+            if (
+                column_sketch.text_min < pk_sketch.text_min
+                or column_sketch.text_max > pk_sketch.text_max
+                or column_sketch.length_min < pk_sketch.length_min
+                or column_sketch.length_max > pk_sketch.length_max
+            ):
+                return False
+    if column_sketch.blobs and not pk_sketch.blobs:
+        return False
+    # Every distinct value needs its own row in the other table
+    if binary_collation and column_sketch.distinct_lower_bound > pk_sketch.rows:
+        return False
+    return True
@@ -0,0 +1,311 @@
+"""
+Background precomputation of column examples and suggestions.
+
+SuggestionsWorker periodically checks each database for changes and stores
+the results of examples_for_columns() and analyze_columns() for every table
+in the edit_schema_suggestions table in Datasette's internal database, so
+the table page can read them without scanning the table.
+
+Each database gets its own long-lived connection: PRAGMA data_version on
+that connection only changes when another connection commits, so unchanged
+databases can be skipped without looking at any of their tables. Tables in
+a changed database are then compared against a stored fingerprint of their
+schema and maximum rowid, plus the row count of small tables, and only
+recomputed if it differs.
+"""
+
+import asyncio
+import datetime
+import hashlib
+import json
+import traceback
+from .catalog import get_catalog, get_sketch_cache
+from .sketches import primary_key_sketch
+from .utils import (
+    Deadline,
+    analyze_columns,
+    examples_for_columns,
+    limited_row_count,
+)
+
+SUGGESTIONS_TABLE = "edit_schema_suggestions"
+# How often to check every database for changes
+PRECOMPUTE_INTERVAL_SECONDS = 60
+# Time budget for analyzing each table in the background
+PRECOMPUTE_TIME_LIMIT_MS = 60_000
+# Tables with fewer rows than this have their row count in their fingerprint
+FINGERPRINT_COUNT_LIMIT = 10_000
+
+CREATE_SUGGESTIONS_TABLE = """
+create table if not exists {} (
+    database_name text,
+    table_name text,
+    fingerprint text,
+    schema text,
+    stale integer not null default 0,
+    computed_at text,
+    examples text,
+    foreign_keys text,
+    primary_keys text,
+    analysis text,
+    primary key (database_name, table_name)
+)
+""".format(
+    SUGGESTIONS_TABLE
+)
+
+
+def table_fingerprint(
+    conn, table, schema, primary_keys, count_limit=FINGERPRINT_COUNT_LIMIT
+):
+    """
+    Changes if the table's schema or maximum rowid change, or if the primary
+    keys of other tables (the foreign key candidates) change. Counting every
+    row would scan the table, so the row count is only included if it is
+    below count_limit - rows deleted from a larger table are not noticed
+    until its maximum rowid changes too.
+    """
+    count = limited_row_count(conn, table, count_limit)
+    if count >= count_limit:
+        count = None
+    try:
+        max_rowid = conn.execute(
+            'select max(rowid) from "{}"'.format(table)
+        ).fetchone()[0]
+    except Exception:
+        # WITHOUT ROWID tables
+        max_rowid = None
+    return hashlib.sha256(
+        json.dumps([schema, count, max_rowid, primary_keys], default=repr).encode(
+            "utf-8"
+        )
+    ).hexdigest()
+
+
+def compute_suggestions(
+    conn, table, table_info, primary_keys, deadline=None, pk_sketch=primary_key_sketch
+):
+    "Returns the values to store for one table"
+    columns = table_info.columns
+    examples = examples_for_columns(conn, table, [c["name"] for c in columns], deadline)
+    other_primary_keys = [pair for pair in primary_keys if pair[0] != table]
+    potential_fks, potential_pks, analysis = analyze_columns(
+        conn, table, columns, other_primary_keys, deadline, pk_sketch=pk_sketch
+    )
+    return {
+        "examples": json.dumps(examples),
+        "foreign_keys": json.dumps(potential_fks),
+        "primary_keys": json.dumps(potential_pks),
+        "analysis": json.dumps(analysis),
+    }
+
+
+def decode_suggestions(row):
+    "Turns a stored row back into (examples, potential_fks, potential_pks, analysis)"
+    return (
+        json.loads(row["examples"]),
+        {
+            column: [tuple(pair) for pair in pairs]
+            for column, pairs in json.loads(row["foreign_keys"]).items()
+        },
+        json.loads(row["primary_keys"]),
+        json.loads(row["analysis"]),
+    )
+
+
+async def get_stored_suggestions(datasette, database_name, table):
+    "The stored row for a table as a dictionary, or None"
+    internal = datasette.get_internal_database()
+    try:
+        rows = await internal.execute(
+            "select * from {} where database_name = ? and table_name = ?".format(
+                SUGGESTIONS_TABLE
+            ),
+            [database_name, table],
+        )
+    except Exception:
+        # The worker has not created the table yet
+        return None
+    row = rows.first()
+    return dict(row) if row else None
+
+
+class SuggestionsWorker:
+    def __init__(
+        self,
+        datasette,
+        interval=PRECOMPUTE_INTERVAL_SECONDS,
+        time_limit_ms=PRECOMPUTE_TIME_LIMIT_MS,
+    ):
+        self.datasette = datasette
+        self.interval = interval
+        self.time_limit_ms = time_limit_ms
+        # {database_name: connection}
+        self._connections = {}
+        # {database_name: data_version when last checked}
+        self._data_versions = {}
+        self._lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._created_table = False
+
+    def wake(self):
+        "Check for changes now rather than waiting for the next interval"
+        self._wake.set()
+
+    async def run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                # Try again next time rather than stopping altogether
+                traceback.print_exc()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def run_once(self):
+        "Recompute suggestions for every table that has changed since last time"
+        async with self._lock:
+            await self._create_table()
+            for name, database in list(self.datasette.databases.items()):
+                if name == "_internal" or (
+                    database.is_memory and not database.memory_name
+                ):
+                    continue
+                await self._update_database(database)
+
+    async def _create_table(self):
+        if self._created_table:
+            return
+        await self.datasette.get_internal_database().execute_write(
+            CREATE_SUGGESTIONS_TABLE
+        )
+        self._created_table = True
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.datasette.executor, fn, *args
+        )
+
+    def _connection(self, database):
+        conn = self._connections.get(database.name)
+        if conn is None:
+            conn = database.connect()
+            self._connections[database.name] = conn
+        return conn
+
+    def _changed_tables(self, database, conn, hidden, stored):
+        """
+        Returns (data_version, table_names, [(table, fingerprint)]) listing
+        every table and the ones that need recomputing, or None if nothing
+        has changed since the last complete check
+        """
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if self._data_versions.get(database.name) == data_version:
+            return None
+        catalog = get_catalog(self.datasette)
+        primary_keys = catalog.primary_keys(conn, database)
+        table_names = [
+            row[0]
+            for row in conn.execute(
+                "select name from sqlite_master where type = 'table'"
+            ).fetchall()
+            if row[0] not in hidden
+        ]
+        changed = []
+        for table in table_names:
+            table_info = catalog.table(conn, database, table)
+            if table_info is None:
+                continue
+            fingerprint = table_fingerprint(
+                conn, table, table_info.schema, primary_keys
+            )
+            if stored.get(table) != fingerprint:
+                changed.append((table, fingerprint))
+        return data_version, table_names, changed
+
+    def _compute(self, database, conn, table):
+        catalog = get_catalog(self.datasette)
+        table_info = catalog.table(conn, database, table)
+        if table_info is None:
+            return None
+        sketch_cache = get_sketch_cache(self.datasette)
+        values = compute_suggestions(
+            conn,
+            table,
+            table_info,
+            catalog.primary_keys(conn, database),
+            Deadline(self.time_limit_ms),
+            pk_sketch=lambda conn, other_table, column: sketch_cache.sketch(
+                conn, database, other_table, column
+            ),
+        )
+        values["schema"] = table_info.schema
+        return values
+
+    async def _update_database(self, database):
+        internal = self.datasette.get_internal_database()
+        conn = self._connection(database)
+        hidden = set(await database.hidden_table_names())
+        stored = {
+            row["table_name"]: row["fingerprint"]
+            for row in await internal.execute(
+                "select table_name, fingerprint from {} where database_name = ?".format(
+                    SUGGESTIONS_TABLE
+                ),
+                [database.name],
+            )
+        }
+        result = await self._run(self._changed_tables, database, conn, hidden, stored)
+        if result is None:
+            return
+        data_version, table_names, changed = result
+        # Forget tables that no longer exist
+        for table in set(stored) - set(table_names):
+            await internal.execute_write(
+                "delete from {} where database_name = ? and table_name = ?".format(
+                    SUGGESTIONS_TABLE
+                ),
+                [database.name, table],
+            )
+        # Mark everything that is about to be recomputed as stale first, so
+        # the table page knows not to trust the stored results
+        for table, _ in changed:
+            await internal.execute_write(
+                "update {} set stale = 1 where database_name = ? and table_name = ?".format(
+                    SUGGESTIONS_TABLE
+                ),
+                [database.name, table],
+            )
+        for table, fingerprint in changed:
+            values = await self._run(self._compute, database, conn, table)
+            if values is None:
+                continue
+            values.update(
+                {
+                    "database_name": database.name,
+                    "table_name": table,
+                    "fingerprint": fingerprint,
+                    "stale": 0,
+                    "computed_at": datetime.datetime.now(
+                        datetime.timezone.utc
+                    ).isoformat(),
+                }
+            )
+            await internal.execute_write(
+                "insert or replace into {} ({}) values ({})".format(
+                    SUGGESTIONS_TABLE,
+                    ", ".join(values),
+                    ", ".join(":{}".format(key) for key in values),
+                ),
+                values,
+            )
+        # Only now, so a pass that fails part way is tried again next time
+        self._data_versions[database.name] = data_version
+
+
+def get_suggestions_worker(datasette):
+    "The worker for this Datasette instance, or None if precomputing is disabled"
+    return getattr(datasette, "_edit_schema_suggestions_worker", None)
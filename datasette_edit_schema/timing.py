@@ -0,0 +1,84 @@
+"""
+Per-phase timings for a single request, reported in a Server-Timing header
+and optionally - with ?_debug=1 - alongside the SQL statements that ran.
+"""
+
+from contextlib import contextmanager
+import time
+
+
+class Timer:
+    def __init__(self, trace=False):
+        # {phase: seconds}, in the order phases first ran
+        self.phases = {}
+        # [{"phase": ..., "sql": ..., "duration_ms": ...}] if tracing
+        self.statements = [] if trace else None
+        self._current = None
+
+    @contextmanager
+    def phase(self, name):
+        "Adds the time spent inside this block to the named phase"
+        previous = self._current
+        self._current = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+            self._current = previous
+
+    def traced(self, fn):
+        """
+        Wraps a function to be passed to execute_fn() so the statements it
+        runs are recorded. A statement's duration is measured until the next
+        statement starts or the function returns, so it includes the time
+        spent fetching its rows.
+        """
+        if self.statements is None:
+            return fn
+
+        def inner(conn):
+            pending = []
+
+            def finish():
+                if pending:
+                    phase, sql, start = pending.pop()
+                    self.statements.append(
+                        {
+                            "phase": phase,
+                            "sql": sql,
+                            "duration_ms": round(
+                                (time.perf_counter() - start) * 1000, 3
+                            ),
+                        }
+                    )
+
+            def callback(sql):
+                finish()
+                pending.append((self._current, sql, time.perf_counter()))
+
+            conn.set_trace_callback(callback)
+            try:
+                return fn(conn)
+            finally:
+                conn.set_trace_callback(None)
+                finish()
+
+        return inner
+
+    def server_timing(self):
+        "Value for the Server-Timing header"
+        return ", ".join(
+            "{};dur={:.3f}".format(name, seconds * 1000)
+            for name, seconds in self.phases.items()
+        )
+
+
+@contextmanager
+def phase(timer, name):
+    "timer.phase(name), or nothing at all if timer is None"
+    if timer is None:
+        yield
+    else:
+        with timer.phase(name):
+            yield
@@ -1,39 +1,301 @@
+from contextlib import contextmanager
+from datasette.utils import sqlite3, sqlite_timelimit
+from sqlite_utils.utils import column_affinity
+from .timing import phase
+from .sketches import (
+    DISTINCT_SAMPLE_SIZE,
+    column_sketches,
+    could_match,
+    primary_key_sketch,
+    rowid_filter,
+)
 import sqlite_utils
 import json
+import random
+import time
+
+# Number of rows to sample from tables too large to scan in full
+SAMPLE_SIZE = 1_000
+# Tables with this many rows are analyzed using a sample of SAMPLE_SIZE rows
+FOREIGN_KEY_DETECTION_LIMIT = 10_000
+# Example values are the first few distinct values in the first rows
+EXAMPLE_ROWS = 1_000
+EXAMPLES_PER_COLUMN = 5
+EXAMPLE_MAX_LENGTH = 30
+EXAMPLE_FETCH_SIZE = 100
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """
+    A time budget shared by several analysis queries. Statements run inside
+    deadline.limit(conn) are interrupted once it has passed, raising
+    DeadlineExceeded and setting deadline.expired
+    """
+
+    def __init__(self, ms):
+        self.ms = ms
+        self.end = time.perf_counter() + ms / 1000
+        self.expired = False
+
+    def remaining_ms(self):
+        return (self.end - time.perf_counter()) * 1000
+
+    @contextmanager
+    def limit(self, conn):
+        remaining = self.remaining_ms()
+        if remaining <= 0:
+            self.expired = True
+            raise DeadlineExceeded()
+        try:
+            with sqlite_timelimit(conn, remaining):
+                yield
+        except sqlite3.OperationalError as e:
+            if "interrupted" in str(e):
+                self.expired = True
+                raise DeadlineExceeded()
+            raise
+
+
+@contextmanager
+def limit(deadline, conn):
+    "deadline.limit(conn), or no limit at all if deadline is None"
+    if deadline is None:
+        yield
+    else:
+        with deadline.limit(conn):
+            yield
+
+
+def get_table_columns(conn, table_names=None):
+    """
+    Returns {table_name: [{"name": ..., "type": ...}, ...]} for every table in
+    the database (or just table_names), using a single query against
+    pragma_table_info()
+    """
+    sql = """
+        select sqlite_master.name, pragma.name, pragma.type
+        from sqlite_master
+        join pragma_table_info(sqlite_master.name) as pragma
+        where sqlite_master.type = 'table'
+    """
+    params = []
+    if table_names is not None:
+        sql += " and sqlite_master.name in (select value from json_each(?))"
+        params.append(json.dumps(list(table_names)))
+    sql += " order by sqlite_master.rowid, pragma.cid"
+    tables = {}
+    for table_name, column, column_type in conn.execute(sql, params).fetchall():
+        tables.setdefault(table_name, []).append(
+            {"name": column, "type": column_affinity(column_type)}
+        )
+    return tables
 
 
 def get_primary_keys(conn):
-    db = sqlite_utils.Database(conn)
+    """
+    Returns [(table_name, pk_column, str or int)] for every table with a
+    single column text or integer primary key, using a single query
+    """
+    sql = """
+        select sqlite_master.name, pragma.name, pragma.type
+        from sqlite_master
+        join pragma_table_info(sqlite_master.name) as pragma
+        where sqlite_master.type = 'table' and pragma.pk > 0
+        group by sqlite_master.name
+        having count(*) = 1
+        order by sqlite_master.rowid
+    """
     primary_keys = []
-    for table in db.tables:
-        if "_fts_" in table.name:
-            continue
-        pks = table.pks
-        if pks == ["rowid"]:
+    for table_name, pk, column_type in conn.execute(sql).fetchall():
+        if "_fts_" in table_name:
             continue
-        if len(pks) != 1:
-            continue
-        pk = pks[0]
         # Is that a str or int?
-        pk_type = table.columns_dict[pk]
+        pk_type = column_affinity(column_type)
         if pk_type in (str, int):
-            primary_keys.append((table.name, pk, pk_type))
+            primary_keys.append((table_name, pk, pk_type))
     return primary_keys
 
 
-def potential_foreign_keys(conn, table_name, columns, other_table_pks):
-    potentials = {}
+def get_foreign_keys(conn, table_names=None):
+    """
+    Returns {table_name: {column: (other_table, other_column)}} for every
+    table in the database (or just table_names), using a single query
+    against pragma_foreign_key_list()
+    """
+    sql = """
+        select sqlite_master.name, fk."from", fk."table", fk."to"
+        from sqlite_master
+        join pragma_foreign_key_list(sqlite_master.name) as fk
+        where sqlite_master.type = 'table'
+    """
+    params = []
+    if table_names is not None:
+        sql += " and sqlite_master.name in (select value from json_each(?))"
+        params.append(json.dumps(list(table_names)))
+    sql += " order by sqlite_master.rowid, fk.id, fk.seq"
+    db = sqlite_utils.Database(conn)
+    tables = {}
+    for table_name, column, other_table, other_column in conn.execute(
+        sql, params
+    ).fetchall():
+        if other_column is None:
+            # REFERENCES other_table, without a column, means its primary key
+            other_column = db[other_table].pks[0]
+        tables.setdefault(table_name, {})[column] = (other_table, other_column)
+    return tables
+
+
+def sample_rowids(conn, table_name, sample_size=SAMPLE_SIZE):
+    """
+    Returns up to sample_size rowids, picking one at random from each of
+    sample_size equal sized ranges between the lowest and highest rowid.
+
+    Returns None for tables without a rowid.
+    """
+    try:
+        min_rowid = conn.execute(
+            'select min(rowid) from "{}"'.format(table_name)
+        ).fetchone()[0]
+        max_rowid = conn.execute(
+            'select max(rowid) from "{}"'.format(table_name)
+        ).fetchone()[0]
+    except sqlite3.OperationalError:
+        # WITHOUT ROWID table
+        return None
+    if min_rowid is None:
+        return []
+    span = max_rowid - min_rowid + 1
+    stratum = max(span / sample_size, 1)
+    starts = sorted(
+        {
+            min(int(min_rowid + i * stratum + random.random() * stratum), max_rowid)
+            for i in range(min(sample_size, span))
+        }
+    )
+    # First rowid at or after each random starting point
+    sql = """
+        select distinct (
+            select rowid from "{table}" where rowid >= starts.value
+            order by rowid limit 1
+        )
+        from json_each(?) as starts
+    """.format(
+        table=table_name
+    )
+    return [
+        row[0]
+        for row in conn.execute(sql, [json.dumps(starts)]).fetchall()
+        if row[0] is not None
+    ]
+
+
+def sample_confidence(sample_size):
+    """
+    If every one of sample_size randomly sampled rows matched, the fraction
+    of rows in the whole table that do not match is below max_missing with
+    95% confidence (the "rule of three")
+    """
+    return {
+        "sample_size": sample_size,
+        "confidence": 0.95,
+        "max_missing": min(round(3 / sample_size, 4), 1.0),
+    }
+
+
+def missing_foreign_key_values(conn, table_name, column, other_table, other_column):
+    "Count rows where column has no matching value in other_table.other_column"
+    sql = """
+        select count(*)
+        from "{table}"
+        where not exists (
+            select 1
+            from "{other_table}"
+            where "{table}"."{column}" = "{other_table}"."{other_column}"
+        )
+    """.format(
+        table=table_name,
+        column=column,
+        other_table=other_table,
+        other_column=other_column,
+    )
+    return conn.execute(sql).fetchone()[0]
+
+
+def potential_foreign_keys(
+    conn,
+    table_name,
+    columns,
+    other_table_pks,
+    rowids=None,
+    deadline=None,
+    pk_sketch=primary_key_sketch,
+):
+    """
+    If rowids is provided only those rows are checked, so suggestions are
+    not guaranteed to hold for the rest of the table.
+
+    pk_sketch(conn, table, column) returns the ColumnSketch of a primary
+    key, see SketchCache for a cached version.
+
+    If the deadline passes the suggestions found so far are returned.
+    """
+    potentials = {column: [] for column in columns}
+    if not columns:
+        return potentials
+    try:
+        _potential_foreign_keys(
+            conn,
+            table_name,
+            columns,
+            other_table_pks,
+            rowids,
+            deadline,
+            pk_sketch,
+            potentials,
+        )
+    except DeadlineExceeded:
+        pass
+    return potentials
+
+
+def _potential_foreign_keys(
+    conn, table_name, columns, other_table_pks, rowids, deadline, pk_sketch, potentials
+):
+    where, params = rowid_filter(rowids)
+    # Sketches of each column are used to skip pairs that cannot match
+    with limit(deadline, conn):
+        sketches = column_sketches(conn, table_name, columns, rowids)
+    pk_sketches = {}
     cursor = conn.cursor()
     for column in columns:
-        potentials[column] = []
+        sketch = sketches[column]
+        if sketch.rows == 0:
+            # No rows, so there are no values missing from any other table
+            potentials[column] = [
+                (other_table, other_column)
+                for other_table, other_column, _ in other_table_pks
+            ]
+            continue
+        if sketch.nulls:
+            continue
         for other_table, other_column, _ in other_table_pks:
+            pk_key = (other_table, other_column)
+            if pk_key not in pk_sketches:
+                with limit(deadline, conn):
+                    pk_sketches[pk_key] = pk_sketch(conn, other_table, other_column)
+            if not could_match(sketch, pk_sketches[pk_key]):
+                continue
             # Search for a value in this column that does not exist in the other table,
             # terminate early as soon as we find one since that shows this is not a
             # good foreign key candidate.
             query = """
                 select "{table}"."{column}"
                 from "{table}"
-                where not exists (
+                where {where} not exists (
                     select 1
                     from "{other_table}"
                     where "{table}"."{column}" = "{other_table}"."{other_column}"
@@ -44,86 +306,251 @@ def potential_foreign_keys(conn, table_name, columns, other_table_pks):
                 column=column,
                 other_table=other_table,
                 other_column=other_column,
+                where="{} and".format(where) if where else "",
             )
-            cursor.execute(query)
-            if cursor.fetchone() is None:
+            with limit(deadline, conn):
+                cursor.execute(query, params)
+                missing = cursor.fetchone()
+            if missing is None:
                 potentials[column].append((other_table, other_column))
-    return potentials
 
 
-def potential_primary_keys(conn, table_name, columns, max_string_len=128):
-    # First we run a query to check the max length of each column + if it has any nulls
+def unique_index_columns(conn, table_name):
+    "Columns that have their own UNIQUE index, so cannot contain duplicates"
+    columns = set()
+    for index_name, unique, partial in conn.execute(
+        'select name, "unique", partial from pragma_index_list(?)', [table_name]
+    ).fetchall():
+        if not unique or partial:
+            continue
+        index_columns = conn.execute(
+            "select name from pragma_index_info(?)", [index_name]
+        ).fetchall()
+        # Expression indexes have a NULL name
+        if len(index_columns) == 1 and index_columns[0][0] is not None:
+            columns.add(index_columns[0][0])
+    return columns
+
+
+def potential_primary_keys(
+    conn, table_name, columns, max_string_len=128, rowids=None, deadline=None
+):
+    """
+    If rowids is provided only those rows are checked - this can rule out
+    columns but cannot confirm that the rest of the table is unique.
+
+    If the deadline passes, columns that have not yet been ruled out are
+    returned unverified.
+    """
     if not columns:
         return []
-    selects = []
+    columns = list(columns)
+    where, params = rowid_filter(rowids)
+    where = " where {}".format(where) if where else ""
+    # A single scan finds the max length and number of nulls in each column,
+    # and a second query against just the first few rows looks for duplicates
+    # to rule out most non-unique columns straight away
+    selects = ["count(*)"]
     for column in columns:
-        selects.append('max(length("{}")) as "maxlen.{}"'.format(column, column))
-        selects.append(
-            'sum(case when "{}" is null then 1 else 0 end) as "nulls.{}"'.format(
-                column, column
-            )
-        )
-    sql = 'select {} from "{}"'.format(", ".join(selects), table_name)
+        selects.append('max(length("{}"))'.format(column))
+        selects.append('sum("{}" is null)'.format(column))
+    prefix_selects = ["count(*)"] + [
+        'count(distinct "{}")'.format(column) for column in columns
+    ]
+    sql = (
+        'select * from (select {} from "{}"{}) '
+        'join (select {} from (select {} from "{}"{} limit {}))'
+    ).format(
+        ", ".join(selects),
+        table_name,
+        where,
+        ", ".join(prefix_selects),
+        ", ".join('"{}"'.format(column) for column in columns),
+        table_name,
+        where,
+        DISTINCT_SAMPLE_SIZE,
+    )
     cursor = conn.cursor()
-    cursor.execute(sql)
-    row = cursor.fetchone()
+    try:
+        with limit(deadline, conn):
+            row = cursor.execute(sql, params + params).fetchone()
+    except DeadlineExceeded:
+        return columns
+    prefix = row[1 + len(columns) * 2 :]
     potential_columns = []
     for i, column in enumerate(columns):
-        maxlen = row[i * 2] or 0
-        nulls = row[i * 2 + 1] or 0
-        if maxlen < max_string_len and nulls == 0:
+        maxlen = row[1 + i * 2] or 0
+        nulls = row[2 + i * 2] or 0
+        if maxlen < max_string_len and nulls == 0 and prefix[i + 1] == prefix[0]:
             potential_columns.append(column)
     if not potential_columns:
         return []
-    # Count distinct values in each of our candidate columns
-    selects = ["count(*) as _count"]
-    for column in potential_columns:
-        selects.append('count(distinct "{}") as "distinct.{}"'.format(column, column))
-    sql = 'select {} from "{}"'.format(", ".join(selects), table_name)
-    cursor.execute(sql)
-    row = cursor.fetchone()
-    count = row[0]
-    potential_pks = []
-    for i, column in enumerate(potential_columns):
-        distinct = row[i + 1]
-        if distinct == count:
-            potential_pks.append(column)
-    return potential_pks
-
-
-def examples_for_columns(conn, table_name):
-    columns = sqlite_utils.Database(conn)[table_name].columns_dict.keys()
-    ctes = [f'rows as (select * from "{table_name}" limit 1000)']
-    unions = []
-    params = []
-    for i, column in enumerate(columns):
-        ctes.append(
-            f'col{i} as (select distinct "{column}" from rows '
-            f'where ("{column}" is not null and "{column}" != "") limit 5)'
+    # Columns with a UNIQUE index are known to be unique already
+    unique = unique_index_columns(conn, table_name)
+    to_verify = [column for column in potential_columns if column not in unique]
+    if to_verify:
+        # Count distinct values in the remaining candidate columns
+        selects = ['count(distinct "{}")'.format(column) for column in to_verify]
+        sql = 'select {} from "{}"{}'.format(", ".join(selects), table_name, where)
+        try:
+            with limit(deadline, conn):
+                distinct_counts = cursor.execute(sql, params).fetchone()
+        except DeadlineExceeded:
+            return potential_columns
+        count = row[0]
+        duplicated = {
+            column
+            for column, distinct in zip(to_verify, distinct_counts)
+            if distinct != count
+        }
+        potential_columns = [
+            column for column in potential_columns if column not in duplicated
+        ]
+    return potential_columns
+
+
+def limited_row_count(conn, table_name, limit=FOREIGN_KEY_DETECTION_LIMIT):
+    "Number of rows in the table, counting no higher than limit"
+    return conn.execute(
+        'select count(*) from (select 1 from "{}" limit {})'.format(table_name, limit)
+    ).fetchone()[0]
+
+
+def analyze_columns(
+    conn,
+    table_name,
+    columns,
+    other_table_pks,
+    deadline=None,
+    timer=None,
+    pk_sketch=primary_key_sketch,
+):
+    """
+    Returns (potential_fks, potential_pks, analysis) for columns, a list of
+    {"name": ..., "type": ..., "is_pk": ...} dictionaries
+
+    analysis is None if suggestions could not be calculated. Tables with
+    FOREIGN_KEY_DETECTION_LIMIT or more rows are checked against a random
+    sample of rows, in which case analysis["sample_size"] is set.
+
+    analysis["complete"] is False if the deadline passed before every
+    check had finished. The count, sample, foreign_keys and primary_keys
+    phases are recorded against timer, if provided. pk_sketch is passed
+    to potential_foreign_keys().
+    """
+    # Anything not a float or an existing PK could be the next PK, but
+    # for smaller tables we cut those down to just unique columns
+    non_float_columns = [
+        c["name"] for c in columns if c["type"] is not float and not c["is_pk"]
+    ]
+    try:
+        with phase(timer, "count"), limit(deadline, conn):
+            count = limited_row_count(conn, table_name)
+    except DeadlineExceeded:
+        return {}, non_float_columns, {"sample_size": None, "complete": False}
+    if not count:
+        return {}, non_float_columns, None
+    rowids = None
+    analysis = {"sample_size": None}
+    if count >= FOREIGN_KEY_DETECTION_LIMIT:
+        # Too large to scan in full, so check a random sample instead
+        with phase(timer, "sample"):
+            rowids = sample_rowids(conn, table_name)
+        if not rowids:
+            return {}, non_float_columns, None
+        analysis = sample_confidence(len(rowids))
+    with phase(timer, "foreign_keys"):
+        potential_fks = potential_foreign_keys(
+            conn,
+            table_name,
+            [c["name"] for c in columns if not c["is_pk"]],
+            other_table_pks,
+            rowids=rowids,
+            deadline=deadline,
+            pk_sketch=pk_sketch,
         )
-        unions.append(f'select ? as label, "{column}" as value from col{i}')
-        params.append(column)
-    ctes.append("strings as ({})".format("\nunion all\n".join(unions)))
-    ctes.append(
-        """
-    truncated_strings as (
-    select 
-        label,
-        case 
-        when length(value) > 30 then substr(value, 1, 30) || '...'
-        else value
-        end as value
-    from strings
-    where typeof(value) != 'blob'
-    )
+    # Now do potential primary keys against non-float columns
+    with phase(timer, "primary_keys"):
+        potential_pks = potential_primary_keys(
+            conn, table_name, non_float_columns, rowids=rowids, deadline=deadline
+        )
+    analysis["complete"] = deadline is None or not deadline.expired
+    return potential_fks, potential_pks, analysis
+
+
+def examples_for_columns(conn, table_name, columns=None, deadline=None):
     """
-    )
-    sql = (
-        "with {ctes} ".format(ctes=",\n".join(ctes))
-        + "select label, json_group_array(value) as examples "
-        "from truncated_strings group by label"
-    )
+    Returns {column: [examples]} with up to EXAMPLES_PER_COLUMN distinct
+    non-blank values for each column, found in the first EXAMPLE_ROWS rows.
+    Columns without any examples are left out.
+
+    Rows are streamed and reading stops as soon as every column has enough
+    examples. Long text values are truncated by SQLite and blobs are
+    skipped, so large values are never copied out of the database.
+
+    If the deadline passes the examples found so far are returned.
+    """
+    if columns is None:
+        columns = sqlite_utils.Database(conn)[table_name].columns_dict.keys()
+    columns = list(columns)
     output = {}
-    for column, examples in conn.execute(sql, params).fetchall():
-        output[column] = list(map(str, json.loads(examples)))
+    if not columns:
+        return output
+    projections = [
+        (
+            "case when typeof({c}) in ('integer', 'real') then {c} "
+            "when typeof({c}) = 'text' and {c} != '' then "
+            "case when length({c}) > {max} then substr({c}, 1, {max}) || '...' "
+            "else {c} end end"
+        ).format(c='"{}"'.format(column), max=EXAMPLE_MAX_LENGTH)
+        for column in columns
+    ]
+    examples = [[] for _ in columns]
+    seen = [set() for _ in columns]
+    # Indexes of the columns that still need more examples
+    remaining = list(range(len(columns)))
+    rows_read = 0
+    try:
+        with limit(deadline, conn):
+            while remaining and rows_read < EXAMPLE_ROWS:
+                # Once most columns have their examples, start again from
+                # the same row selecting just the columns that are left
+                selected = remaining
+                cursor = conn.execute(
+                    'select {} from "{}" limit {} offset {}'.format(
+                        ", ".join(projections[i] for i in selected),
+                        table_name,
+                        EXAMPLE_ROWS - rows_read,
+                        rows_read,
+                    )
+                )
+                while len(remaining) * 2 > len(selected):
+                    rows = cursor.fetchmany(EXAMPLE_FETCH_SIZE)
+                    if not rows:
+                        rows_read = EXAMPLE_ROWS
+                        break
+                    rows_read += len(rows)
+                    for position, i in enumerate(selected):
+                        if len(examples[i]) == EXAMPLES_PER_COLUMN:
+                            continue
+                        for row in rows:
+                            value = row[position]
+                            if value is None:
+                                continue
+                            value = str(value)
+                            if value in seen[i]:
+                                continue
+                            seen[i].add(value)
+                            examples[i].append(value)
+                            if len(examples[i]) == EXAMPLES_PER_COLUMN:
+                                break
+                    remaining = [
+                        i for i in remaining if len(examples[i]) < EXAMPLES_PER_COLUMN
+                    ]
+                cursor.close()
+    except DeadlineExceeded:
+        pass
+    for column, column_examples in zip(columns, examples):
+        if column_examples:
+            output[column] = column_examples
     return output
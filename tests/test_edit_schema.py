@@ -1,15 +1,39 @@
 from datasette.app import Datasette
 from datasette.utils import tilde_encode
+from datasette_edit_schema.catalog import ExamplesCache, SchemaCatalog, SketchCache
+from datasette_edit_schema.advisor import get_workload, normalize_sql
+from datasette_edit_schema.alter import transform_table
+from datasette_edit_schema.bulk import set_foreign_keys
+from datasette_edit_schema.dependencies import dependent_objects
+from datasette_edit_schema.execution import get_write_queue_stats
+from datasette_edit_schema.jobs import Job, JobCancelled, get_job_manager
+from datasette_edit_schema.online import OnlineRebuild, TableChanged
+from datasette_edit_schema.suggestions import (
+    SuggestionsWorker,
+    get_stored_suggestions,
+    get_suggestions_worker,
+    table_fingerprint,
+)
 from datasette_edit_schema.utils import (
+    Deadline,
+    DeadlineExceeded,
     potential_foreign_keys,
     get_primary_keys,
+    get_table_columns,
     examples_for_columns,
+    sample_rowids,
     potential_primary_keys,
 )
+import asyncio
+import datetime
+import json
+import os
+import sqlite3
 import sqlite_utils
 import pytest
 import re
 from bs4 import BeautifulSoup
+from markupsafe import escape
 from .conftest import Rule
 
 whitespace = re.compile(r"\s+")
@@ -357,6 +381,8 @@ async def test_transform_table(
     post_data["csrftoken"] = csrftoken
     if action:
         post_data["action"] = action
+    if action == "update_columns":
+        post_data["confirm"] = "1"
     response = await ds.client.post(
         "/-/edit-schema/data/creatures",
         data=post_data,
@@ -391,6 +417,7 @@ async def test_drop_column_from_table_that_is_part_of_a_view(db_path):
         "delete.description": "1",
         "csrftoken": csrftoken,
         "action": "update_columns",
+        "confirm": "1",
     }
     response = await ds.client.post(
         "/-/edit-schema/data/creatures",
@@ -405,6 +432,578 @@ async def test_drop_column_from_table_that_is_part_of_a_view(db_path):
     assert messages[0][0] == "Changes to table have been saved"
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "setup_sql,post_data,expected_columns,expected_in_place",
+    (
+        ([], {"name.name": "name2"}, ["name2", "description"], True),
+        ([], {"delete.description": "1"}, ["name"], True),
+        (
+            [],
+            {"name.name": "name2", "delete.description": "1"},
+            ["name2"],
+            True,
+        ),
+        # Swapping names, changing types and reordering need a copy
+        (
+            [],
+            {"name.name": "description", "name.description": "name"},
+            ["description", "name"],
+            False,
+        ),
+        ([], {"type.description": "INTEGER"}, ["name", "description"], False),
+        (
+            [],
+            {"sort.name": "2", "sort.description": "1"},
+            ["description", "name"],
+            False,
+        ),
+        # SQLite refuses to drop a column used by a view, so that falls
+        # back to a copy
+        (
+            ["create view names as select name, description from creatures"],
+            {"delete.description": "1"},
+            ["name"],
+            False,
+        ),
+    ),
+)
+async def test_update_columns_in_place(
+    db_path, setup_sql, post_data, expected_columns, expected_in_place
+):
+    db = sqlite_utils.Database(db_path)
+    for sql in setup_sql:
+        db.execute(sql)
+    rowids_before = [r[0] for r in db.execute("select rowid from creatures")]
+    rootpage_before = db.execute(
+        "select rootpage from sqlite_master where name = 'creatures'"
+    ).fetchone()[0]
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    csrftoken = (
+        await ds.client.get("/-/edit-schema/data/creatures", cookies=cookies)
+    ).cookies["ds_csrftoken"]
+    response = await ds.client.post(
+        "/-/edit-schema/data/creatures",
+        data=dict(post_data, action="update_columns", confirm="1", csrftoken=csrftoken),
+        cookies=dict(cookies, ds_csrftoken=csrftoken),
+    )
+    assert response.status_code == 302
+    messages = ds.unsign(response.cookies["ds_messages"], "messages")
+    assert messages[0][0] == "Changes to table have been saved"
+    assert [c.name for c in db["creatures"].columns] == expected_columns
+    assert [r[0] for r in db.execute("select rowid from creatures")] == rowids_before
+    rootpage_after = db.execute(
+        "select rootpage from sqlite_master where name = 'creatures'"
+    ).fetchone()[0]
+    assert (rootpage_after == rootpage_before) == expected_in_place
+
+
+@pytest.mark.asyncio
+async def test_update_columns_shows_plan_first(db_path):
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    db = sqlite_utils.Database(db_path)
+    before_schema = db["creatures"].schema
+    csrftoken = (
+        await ds.client.get("/-/edit-schema/data/creatures", cookies=cookies)
+    ).cookies["ds_csrftoken"]
+    cookies["ds_csrftoken"] = csrftoken
+    # Submitting the form unchanged does nothing at all
+    unchanged = {
+        "action": "update_columns",
+        "csrftoken": csrftoken,
+        "name.name": "name",
+        "type.name": "TEXT",
+        "sort.name": "1",
+        "name.description": "description",
+        "type.description": "TEXT",
+        "sort.description": "2",
+    }
+    response = await ds.client.post(
+        "/-/edit-schema/data/creatures", data=unchanged, cookies=cookies
+    )
+    assert response.status_code == 302
+    messages = ds.unsign(response.cookies["ds_messages"], "messages")
+    assert messages == [["No changes to save", ds.INFO]]
+    assert get_last_event(ds) is None
+    # Changes are shown, with whether they need a rebuild, before being made
+    for post_data, expected_steps, expected_rebuild in (
+        (
+            {"name.name": "name2", "delete.description": "1"},
+            ["Delete column description", "Rename column name to name2"],
+            False,
+        ),
+        (
+            {"type.description": "INTEGER", "sort.name": "3"},
+            [
+                "Change type of column description from Text to Integer",
+                "Change the column order to description, name",
+            ],
+            True,
+        ),
+    ):
+        response = await ds.client.post(
+            "/-/edit-schema/data/creatures",
+            data=dict(unchanged, **post_data),
+            cookies=cookies,
+        )
+        assert response.status_code == 200
+        soup = BeautifulSoup(response.text, "html.parser")
+        assert [li.text for li in soup.select("ul.change-plan li")] == expected_steps
+        assert ("copied into a new table" in response.text) == expected_rebuild
+        assert db["creatures"].schema == before_schema
+        # The confirmation form repeats the submitted changes
+        fields = {
+            i["name"]: i["value"] for i in soup.select("form.core input[type=hidden]")
+        }
+        assert fields["confirm"] == "1"
+        for key, value in post_data.items():
+            assert fields[key] == value
+    assert get_last_event(ds) is None
+
+
+def test_online_rebuild_copies_concurrent_changes(tmpdir):
+    path = str(tmpdir / "online.db")
+    db = sqlite_utils.Database(path)
+    db["items"].insert_all(
+        ({"id": i, "name": "item {}".format(i), "size": str(i)} for i in range(1, 21)),
+        pk="id",
+    )
+    db["items"].create_index(["name"])
+    db.create_view("item_names", "select name from items")
+    conn = sqlite3.connect(path)
+    other = sqlite3.connect(path, isolation_level=None)
+    rebuild = OnlineRebuild(
+        "items", types={"size": int}, column_order=["size", "id"], batch_size=3
+    )
+    rebuild.start(conn)
+    assert rebuild.copy_batch(conn)
+    # Changes made by another connection between batches, both to rows
+    # that have already been copied and to ones that have not
+    other.execute("update items set name = 'changed' where id in (1, 15)")
+    other.execute("delete from items where id in (2, 16)")
+    other.execute("insert into items (id, name, size) values (21, 'new', '21')")
+    while rebuild.copy_batch(conn):
+        assert rebuild.catch_up(conn) >= 0
+    assert rebuild.progress == 1.0
+    other.execute("update items set size = '100' where id = 3")
+    rebuild.swap(conn)
+    assert db["items"].columns_dict == {"id": int, "name": str, "size": int}
+    assert [c.name for c in db["items"].columns] == ["size", "id", "name"]
+    rows = {row["id"]: row for row in db["items"].rows}
+    assert set(rows) == set(range(1, 22)) - {2, 16}
+    assert rows[1]["name"] == rows[15]["name"] == "changed"
+    assert rows[3]["size"] == 100
+    assert rows[21]["name"] == "new"
+    # Indexes and views are recreated, the log table and triggers are gone
+    assert [i.columns for i in db["items"].indexes] == [["name"]]
+    assert db["item_names"].exists()
+    assert db.triggers == []
+    assert db.table_names() == ["items"]
+
+
+def test_online_rebuild_abort(tmpdir):
+    path = str(tmpdir / "online.db")
+    db = sqlite_utils.Database(path)
+    db["items"].insert_all(({"id": i} for i in range(10)), pk="id")
+    schema = db["items"].schema
+    conn = sqlite3.connect(path)
+    rebuild = OnlineRebuild("items", rename={"id": "item_id"}, batch_size=4)
+    rebuild.start(conn)
+    rebuild.copy_batch(conn)
+    rebuild.abort(conn)
+    assert db.table_names() == ["items"]
+    assert db.triggers == []
+    assert db["items"].schema == schema
+    assert db["items"].count == 10
+
+
+def test_online_rebuild_aborts_if_table_altered(tmpdir):
+    path = str(tmpdir / "online.db")
+    db = sqlite_utils.Database(path)
+    db["items"].insert_all(({"id": i} for i in range(10)), pk="id")
+    conn = sqlite3.connect(path, isolation_level=None)
+    other = sqlite3.connect(path, isolation_level=None)
+    rebuild = OnlineRebuild("items", rename={"id": "item_id"}, batch_size=4)
+    rebuild.start(conn)
+    while rebuild.copy_batch(conn):
+        pass
+    other.execute("alter table items add column c text")
+    other.execute("update items set c = 'kept' where id = 1")
+    with pytest.raises(TableChanged):
+        rebuild.swap(conn)
+    # The old table is left as it is, with the new column and its value
+    assert db.table_names() == ["items"]
+    assert db.triggers == []
+    assert db.execute("select c from items where id = 1").fetchone()[0] == "kept"
+
+
+def test_online_rebuild_keeps_cascading_foreign_keys(tmpdir):
+    path = str(tmpdir / "online.db")
+    db = sqlite_utils.Database(path)
+    db["items"].insert_all(({"id": i} for i in range(1, 6)), pk="id")
+    db.execute(
+        "create table parts (id integer primary key, "
+        "item_id integer references items(id) on delete cascade)"
+    )
+    db["parts"].insert_all({"id": i, "item_id": i % 5 + 1} for i in range(20))
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA foreign_keys=1")
+    rebuild = OnlineRebuild("items", types={"id": int}, column_order=["id"])
+    rebuild.start(conn)
+    while rebuild.copy_batch(conn):
+        pass
+    rebuild.swap(conn)
+    assert db["parts"].count == 20
+    assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+
+
+def test_online_rebuild_checks_temporary_table_name(tmpdir, monkeypatch):
+    path = str(tmpdir / "online.db")
+    db = sqlite_utils.Database(path)
+    db["items"].insert_all(({"id": i} for i in range(10)), pk="id")
+    transform_sql = sqlite_utils.db.Table.transform_sql
+
+    def renamed_transform_sql(self, **kwargs):
+        # As if sqlite-utils changed how it names the temporary table
+        return [sql.replace("_new_", "_tmp_") for sql in transform_sql(self, **kwargs)]
+
+    monkeypatch.setattr(sqlite_utils.db.Table, "transform_sql", renamed_transform_sql)
+    conn = sqlite3.connect(path, isolation_level=None)
+    with pytest.raises(ValueError):
+        OnlineRebuild("items", rename={"id": "item_id"}).start(conn)
+    assert db.table_names() == ["items"]
+    assert db.triggers == []
+
+
+@pytest.mark.asyncio
+async def test_update_columns_online_rebuild(db_path):
+    ds = Datasette(
+        [db_path],
+        config={
+            "plugins": {
+                "datasette-edit-schema": {
+                    "online_rebuild_min_rows": 1,
+                    "online_rebuild_batch_size": 1,
+                }
+            }
+        },
+    )
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    db = sqlite_utils.Database(db_path)
+    csrftoken = (
+        await ds.client.get("/-/edit-schema/data/creatures", cookies=cookies)
+    ).cookies["ds_csrftoken"]
+    write_stats = get_write_queue_stats(ds)
+    writes_before = write_stats.to_dict().get("data", {"count": 0})["count"]
+    response = await ds.client.post(
+        "/-/edit-schema/data/creatures",
+        data={
+            "action": "update_columns",
+            "confirm": "1",
+            "csrftoken": csrftoken,
+            "sort.name": "2",
+            "sort.description": "1",
+        },
+        cookies=dict(cookies, ds_csrftoken=csrftoken),
+    )
+    assert response.status_code == 302
+    assert [c.name for c in db["creatures"].columns] == ["description", "name"]
+    assert list(db["creatures"].rows) == [
+        {"description": "A medium sized dog", "name": "Cleo"},
+        {"description": "A troublesome Kakapo", "name": "Siroco"},
+    ]
+    assert db.triggers == []
+    # Each batch was a separate write
+    assert write_stats.to_dict()["data"]["count"] - writes_before > 3
+
+
+@pytest.mark.asyncio
+async def test_background_job(db_path):
+    ds = Datasette(
+        [db_path],
+        config={"plugins": {"datasette-edit-schema": {"job_wait_ms": 0}}},
+    )
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    csrftoken = (
+        await ds.client.get("/-/edit-schema/data/creatures", cookies=cookies)
+    ).cookies["ds_csrftoken"]
+    cookies["ds_csrftoken"] = csrftoken
+    response = await ds.client.post(
+        "/-/edit-schema/data/creatures",
+        data={"add_index": "1", "add_index_column": "name", "csrftoken": csrftoken},
+        cookies=cookies,
+    )
+    # The request did not wait for the job
+    assert response.status_code == 302
+    assert response.headers["location"] == "/-/edit-schema/-/jobs/1"
+    messages = ds.unsign(response.cookies["ds_messages"], "messages")
+    assert messages == [["Adding an index is running in the background", ds.INFO]]
+    job = get_job_manager(ds).get(1)
+    await get_job_manager(ds).wait(job, 5)
+    data = (await ds.client.get("/-/edit-schema/-/jobs/1.json", cookies=cookies)).json()
+    assert data["status"] == "finished"
+    assert data["messages"] == ["Index added on name"]
+    assert data["progress"] == 1.0
+    assert data["eta_ms"] is None
+    assert data["redirect"] == "/-/edit-schema/data/creatures"
+    html = (await ds.client.get("/-/edit-schema/-/jobs/1", cookies=cookies)).text
+    assert "Index added on name" in html
+    assert '<a href="/-/edit-schema/data/creatures">Continue</a>' in html
+    stats = (await ds.client.get("/-/edit-schema/-/stats", cookies=cookies)).json()
+    assert [job["id"] for job in stats["jobs"]] == [1]
+    # Jobs need the edit-schema permission on their database
+    assert (await ds.client.get("/-/edit-schema/-/jobs/1.json")).status_code == 403
+    assert (
+        await ds.client.get("/-/edit-schema/-/jobs/2.json", cookies=cookies)
+    ).status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_job_page_message_types(db_path):
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+
+    async def work(job):
+        job.add_message("Saved", ds.INFO)
+        job.add_message("Missing values", ds.WARNING)
+        job.add_message("Broken", ds.ERROR)
+
+    manager = get_job_manager(ds)
+    job = manager.start("data", "creatures", "Messages", work)
+    await manager.wait(job, 5)
+    html = (await ds.client.get("/-/edit-schema/-/jobs/1", cookies=cookies)).text
+    soup = BeautifulSoup(html, "html.parser")
+    assert [(p["class"][0], p.text) for p in soup.select("p[class^=message-]")] == [
+        ("message-info", "Saved"),
+        ("message-warning", "Missing values"),
+        ("message-error", "Broken"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_cancel_job(db_path):
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    database = ds.get_database("data")
+    started = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def slow_write(conn):
+        with conn:
+            conn.execute("insert into creatures (name) values ('Pancakes')")
+            loop.call_soon_threadsafe(started.set)
+            conn.execute(
+                "with recursive n(i) as (select 1 union all select i + 1 from n) "
+                "select count(*) from n"
+            ).fetchall()
+
+    async def work(job):
+        await database.execute_write_fn(job.wrap(slow_write), block=True)
+
+    job = get_job_manager(ds).start("data", "creatures", "Slow write", work)
+    await started.wait()
+    assert job.to_dict()["status"] == "running"
+    csrftoken = (
+        await ds.client.get("/-/edit-schema/-/jobs/1", cookies=cookies)
+    ).cookies["ds_csrftoken"]
+    response = await ds.client.post(
+        "/-/edit-schema/-/jobs/1",
+        data={"cancel": "1", "csrftoken": csrftoken},
+        cookies=dict(cookies, ds_csrftoken=csrftoken),
+    )
+    assert response.status_code == 302
+    await get_job_manager(ds).wait(job, 5)
+    assert job.status == "cancelled"
+    # The insert was rolled back
+    assert sqlite_utils.Database(db_path)["creatures"].count == 2
+
+
+@pytest.mark.asyncio
+async def test_job_permissions(db_path):
+    ds = Datasette(
+        [db_path],
+        config={
+            "databases": {
+                "data": {
+                    "tables": {
+                        "museums": {"permissions": {"alter-table": {"id": "pelican"}}}
+                    }
+                }
+            }
+        },
+    )
+    manager = get_job_manager(ds)
+    release = asyncio.Event()
+
+    async def work(job):
+        await release.wait()
+
+    museums_job = manager.start("data", "museums", "Adding an index", work)
+    cities_job = manager.start(
+        "data", "cities", "Adding an index", work, actor={"id": "walrus"}
+    )
+    database_job = manager.start("data", None, "Updating foreign keys", work)
+
+    async def status(actor_id, job):
+        cookies = {"ds_actor": ds.sign({"a": {"id": actor_id}}, "actor")}
+        response = await ds.client.get(
+            "/-/edit-schema/-/jobs/{}".format(job.id), cookies=cookies
+        )
+        return response.status_code
+
+    # alter-table on the job's table is enough
+    assert await status("pelican", museums_job) == 200
+    assert await status("pelican", cities_job) == 403
+    assert await status("pelican", database_job) == 403
+    # As is having started the job
+    assert await status("walrus", cities_job) == 200
+    assert await status("walrus", museums_job) == 403
+    # edit-schema covers everything
+    for job in (museums_job, cities_job, database_job):
+        assert await status("root", job) == 200
+    # Which includes cancelling it
+    cookies = {"ds_actor": ds.sign({"a": {"id": "pelican"}}, "actor")}
+    csrftoken = (
+        await ds.client.get("/-/edit-schema/-/jobs/1", cookies=cookies)
+    ).cookies["ds_csrftoken"]
+    response = await ds.client.post(
+        "/-/edit-schema/-/jobs/1",
+        data={"cancel": "1", "csrftoken": csrftoken},
+        cookies=dict(cookies, ds_csrftoken=csrftoken),
+    )
+    assert response.status_code == 302
+    assert museums_job.cancelled
+    release.set()
+    for job in (museums_job, cities_job, database_job):
+        await manager.wait(job, 5)
+
+
+@pytest.mark.asyncio
+async def test_cancel_job_during_transform(tmpdir):
+    path = str(tmpdir / "cancel.db")
+    db = sqlite_utils.Database(path)
+    db["items"].insert_all(({"id": i, "size": str(i)} for i in range(5_000)), pk="id")
+    conn = sqlite3.connect(path, check_same_thread=False)
+
+    def authorizer(action, arg1, arg2, database, source):
+        # Cancels the job as soon as the rows start being copied, so the
+        # progress handler interrupts the copy part way through
+        if action == sqlite3.SQLITE_INSERT and arg1.startswith("items_new"):
+            job._cancelled.set()
+        return sqlite3.SQLITE_OK
+
+    def run(conn):
+        conn.set_authorizer(authorizer)
+        transform_table(conn, "items", job=job, types={"size": int})
+
+    async def work(job):
+        await asyncio.get_running_loop().run_in_executor(None, job.wrap(run), conn)
+
+    job = get_job_manager(Datasette()).start(
+        "cancel", "items", "Changing columns", work
+    )
+    await job._task
+    conn.close()
+    assert job.status == "cancelled"
+    assert job.error is None
+    # The interrupted transform was rolled back
+    assert db["items"].columns_dict == {"id": int, "size": str}
+    assert db["items"].count == 5_000
+    assert db.table_names() == ["items"]
+
+
+class RecordingConnection(sqlite3.Connection):
+    interrupts = 0
+
+    def interrupt(self):
+        self.interrupts += 1
+        super().interrupt()
+
+
+@pytest.mark.parametrize("interrupt", (True, False))
+def test_job_only_interrupts_its_own_connections(interrupt):
+    conn = sqlite3.connect(":memory:", factory=RecordingConnection)
+    job = Job(1, "data", None, "Slow read")
+
+    def slow_read(conn):
+        job.cancel()
+        conn.execute(
+            "with recursive n(i) as (select 1 union all select i + 1 from n) "
+            "select count(*) from n"
+        ).fetchall()
+
+    # Cancelled either way, by the progress handler if not interrupted
+    with pytest.raises(JobCancelled):
+        job.wrap(slow_read, interrupt=interrupt)(conn)
+    assert conn.interrupts == (1 if interrupt else 0)
+    # Once the call has finished the connection is left alone
+    job.cancel()
+    assert conn.interrupts == (1 if interrupt else 0)
+
+
+def test_transform_table_reports_progress(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "progress.db"))
+    db["items"].insert_all(({"id": i, "size": str(i)} for i in range(25)), pk="id")
+    job = Job(1, "progress", "items", "Changing columns")
+    transform_table(db.conn, "items", job=job, batch_size=10, types={"size": int})
+    assert job.rows_total == job.rows_processed == 25
+    assert db["items"].columns_dict == {"id": int, "size": int}
+    assert db["items"].count == 25
+
+
+def test_dependent_objects(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "deps.db"))
+    db.executescript(
+        """
+        create table creatures (id integer primary key, name text);
+        create table creatures_extra (id integer primary key, creatures text);
+        create table log (message text);
+        create view b_names as select name from [a_creatures] where name != 'x';
+        create view a_creatures as select * from "Creatures";
+        create view creature_count as select count(*) from creatures;
+        -- Only mentions creatures in a string, a comment or as a column
+        create view extras as
+            select creatures, 'creatures' as s from creatures_extra /* creatures */;
+        create trigger creatures_log after insert on creatures
+            begin insert into log values ('added'); end;
+        create trigger extras_log after insert on creatures_extra
+            begin insert into creatures (name) values (new.creatures); end;
+        create trigger a_creatures_insert instead of insert on a_creatures
+            begin insert into log values ('view'); end;
+        create trigger log_insert after insert on log
+            begin select 1; end;
+        """
+    )
+    dependents = dependent_objects(db.conn, "creatures")
+    assert [(obj.type, obj.name) for obj in dependents] == [
+        ("view", "a_creatures"),
+        ("view", "b_names"),
+        ("view", "creature_count"),
+        ("trigger", "a_creatures_insert"),
+        ("trigger", "creatures_log"),
+        ("trigger", "extras_log"),
+    ]
+    # Rebuilding the table keeps every one of them
+    schema_before = {
+        row[0]: row[1]
+        for row in db.execute(
+            "select name, sql from sqlite_master where name != 'creatures'"
+        )
+    }
+    transform_table(db.conn, "creatures", types={"name": int})
+    assert db["creatures"].columns_dict == {"id": int, "name": int}
+    assert {
+        row[0]: row[1]
+        for row in db.execute(
+            "select name, sql from sqlite_master where name != 'creatures'"
+        )
+    } == schema_before
+    db["creatures"].insert({"name": 1})
+    assert [row["message"] for row in db["log"].rows] == ["added"]
+
+
 @pytest.mark.asyncio
 async def test_static_assets(db_path):
     ds = Datasette([db_path])
@@ -683,6 +1282,242 @@ async def test_breadcrumbs(db_path, path, expected_breadcrumbs):
         assert crumb in breadcrumbs
 
 
+@pytest.mark.asyncio
+async def test_update_primary_key_checks_use_read_connection(db_path):
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    csrftoken = (
+        await ds.client.get("/-/edit-schema/data/museums", cookies=cookies)
+    ).cookies["ds_csrftoken"]
+    cookies["ds_csrftoken"] = csrftoken
+    response = await ds.client.post(
+        "/-/edit-schema/data/museums",
+        data={
+            "action": "update_primary_key",
+            "primary_key": "city_id",
+            "csrftoken": csrftoken,
+        },
+        cookies=cookies,
+    )
+    assert response.status_code == 302
+    messages = ds.unsign(response.cookies["ds_messages"], "messages")
+    assert messages[0][0] == "Column 'city_id' is not unique"
+    # Failed checks should not have touched the write queue
+    stats = (await ds.client.get("/-/edit-schema/-/stats", cookies=cookies)).json()
+    assert stats["write_queue"] == {}
+    # Loading the page calculated the examples once
+    assert stats["examples_cache"]["databases"]["data"]["misses"] == 1
+    # A successful change is recorded against the write queue
+    await ds.client.post(
+        "/-/edit-schema/data/museums",
+        data={
+            "action": "update_primary_key",
+            "primary_key": "name",
+            "csrftoken": csrftoken,
+        },
+        cookies=cookies,
+    )
+    stats = (await ds.client.get("/-/edit-schema/-/stats", cookies=cookies)).json()
+    write_stats = stats["write_queue"]["data"]
+    assert write_stats["count"] == 1
+    assert write_stats["recent"][0]["kind"] == "write"
+    assert write_stats["max_wait_ms"] >= 0
+
+
+def test_examples_cache(db, db_path):
+    class FakeDatabase:
+        name = "data"
+        path = db_path
+
+    cache = ExamplesCache(max_size=2)
+    reader = sqlite_utils.Database(db_path)
+    examples = cache.examples(reader.conn, FakeDatabase, "cities", ["id", "name"])
+    assert examples["id"] == ["nyc", "london", "sf"]
+    assert cache.examples(reader.conn, FakeDatabase, "cities", ["id", "name"]) == (
+        examples
+    )
+    assert cache.to_dict()["databases"]["data"] == {
+        "hits": 1,
+        "misses": 1,
+        "entries": 1,
+    }
+    # A write from a different connection invalidates it
+    db["cities"].insert({"id": "paris", "name": "Paris"})
+    examples2 = cache.examples(reader.conn, FakeDatabase, "cities", ["id", "name"])
+    assert examples2["id"] == ["nyc", "london", "sf", "paris"]
+    # As does a schema change
+    db["cities"].add_column("country", str)
+    cache.examples(reader.conn, FakeDatabase, "cities", ["id", "name"])
+    assert cache.to_dict()["databases"]["data"]["misses"] == 3
+    # Other connections cannot trust a data_version they have not seen
+    other = sqlite_utils.Database(db_path)
+    cache.examples(other.conn, FakeDatabase, "cities", ["id", "name"])
+    assert cache.to_dict()["databases"]["data"]["misses"] == 4
+    # But once they have calculated the same result they can use it
+    cache.examples(other.conn, FakeDatabase, "cities", ["id", "name"])
+    cache.examples(reader.conn, FakeDatabase, "cities", ["id", "name"])
+    assert cache.to_dict()["databases"]["data"]["hits"] == 3
+    # Least recently used entries are evicted
+    cache.examples(reader.conn, FakeDatabase, "museums", ["id"])
+    cache.examples(reader.conn, FakeDatabase, "creatures", ["name"])
+    cache.examples(reader.conn, FakeDatabase, "cities", ["id", "name"])
+    assert cache.to_dict() == {
+        "max_size": 2,
+        "databases": {"data": {"hits": 3, "misses": 7, "entries": 2}},
+    }
+
+
+def test_examples_cache_new_connection(db, db_path):
+    class FakeDatabase:
+        name = "data"
+        path = db_path
+
+    cache = ExamplesCache()
+    db["cities"].delete_where()
+    for i in range(3):
+        conn = sqlite3.connect(db_path)
+        examples = cache.examples(conn, FakeDatabase, "cities", ["id"])
+        assert examples.get("id", []) == ["city{}".format(j) for j in range(i)]
+        conn.close()
+        del conn
+        # CPython usually gives the next connection the same id(), but it
+        # has not seen this write so must not use the cached examples
+        db["cities"].insert({"id": "city{}".format(i)})
+
+
+def test_sketch_cache(db, db_path):
+    class FakeDatabase:
+        name = "data"
+        path = db_path
+
+    cache = SketchCache()
+    reader = sqlite_utils.Database(db_path)
+    calls = []
+
+    def pk_sketch(conn, table, column):
+        calls.append((table, column))
+        return cache.sketch(conn, FakeDatabase, table, column)
+
+    db["events"].insert_all([{"id": 1, "city_id": "london"}], pk="id")
+    db["venues"].insert_all([{"id": 1, "city_id": "sf"}], pk="id")
+    pks = [("cities", "id", str), ("distractions", "id", str)]
+    for table in ("events", "venues"):
+        assert potential_foreign_keys(
+            reader.conn, table, ["city_id"], pks, pk_sketch=pk_sketch
+        ) == {"city_id": [("cities", "id")]}
+    # Each primary key is only sketched once, for the first table
+    assert len(calls) == 4
+    assert cache.to_dict()["databases"]["data"] == {
+        "hits": 2,
+        "misses": 2,
+        "entries": 2,
+    }
+    # Until the other table is written to
+    db["cities"].insert({"id": "paris", "name": "Paris"})
+    cache.sketch(reader.conn, FakeDatabase, "cities", "id")
+    assert cache.to_dict()["databases"]["data"]["misses"] == 3
+
+
+@pytest.mark.asyncio
+async def test_stats_requires_permission(db_path):
+    ds = Datasette([db_path])
+    response = await ds.client.get("/-/edit-schema/-/stats")
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_edit_schema_database_json(db_path):
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    response = await ds.client.get(
+        "/-/edit-schema/data.json?table=museums&table=has_indexes&_size=1",
+        cookies=cookies,
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["database"] == "data"
+    assert [t["name"] for t in data["tables"]] == ["has_indexes"]
+    assert data["tables"][0]["columns"] == [
+        {"name": "id", "type": "INTEGER", "is_pk": True},
+        {"name": "name", "type": "TEXT", "is_pk": False},
+        {"name": "description", "type": "TEXT", "is_pk": False},
+    ]
+    assert data["next"] == "has_indexes"
+    assert data["next_url"].startswith("http://localhost/-/edit-schema/data.json?")
+    response2 = await ds.client.get(
+        data["next_url"].replace("http://localhost", ""), cookies=cookies
+    )
+    data2 = response2.json()
+    assert [t["name"] for t in data2["tables"]] == ["museums"]
+    assert data2["next"] is None
+    # Permission check
+    assert (await ds.client.get("/-/edit-schema/data.json")).status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_edit_schema_table_json(db_path):
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    response = await ds.client.get(
+        "/-/edit-schema/data/has_foreign_keys.json", cookies=cookies
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["table"] == "has_foreign_keys"
+    assert data["primary_keys"] == ["id"]
+    assert data["foreign_keys"] == [
+        {
+            "column": "distraction_id",
+            "other_table": "distractions",
+            "other_column": "id",
+        }
+    ]
+    assert data["indexes"] == []
+    assert "examples" not in data
+    assert "suggestions" not in data
+    # Expensive sections are opt-in
+    response2 = await ds.client.get(
+        "/-/edit-schema/data/museums.json?_extra=examples,suggestions",
+        cookies=cookies,
+    )
+    data2 = response2.json()
+    assert data2["examples"]["city_id"] == ["nyc", "london", "sf"]
+    assert data2["suggestions"] == {
+        "foreign_keys": {"city_id": [{"other_table": "cities", "other_column": "id"}]},
+        "primary_keys": ["name"],
+        "analyzed": True,
+        "complete": True,
+        "computing": False,
+        "sample": None,
+    }
+    assert data2["examples_complete"]
+    # Table names with dots and slashes are tilde-encoded
+    response3 = await ds.client.get(
+        "/-/edit-schema/data/{}.json".format(tilde_encode("animal.name/with/slashes")),
+        cookies=cookies,
+    )
+    assert response3.json()["table"] == "animal.name/with/slashes"
+    assert (
+        await ds.client.get("/-/edit-schema/data/has_foreign_keys.json")
+    ).status_code == 403
+
+
+def test_get_primary_keys(db):
+    db["compound"].insert({"a": 1, "b": 2}, pk=("a", "b"))
+    db["float_pk"].insert({"id": 1.5}, pk="id")
+    db["cities"].enable_fts(["name"])
+    assert get_primary_keys(db.conn) == [
+        ("empty_table", "id", int),
+        ("museums", "id", str),
+        ("cities", "id", str),
+        ("distractions", "id", str),
+        ("has_foreign_keys", "id", int),
+        ("has_indexes", "id", int),
+        ("animal.name/with/slashes", "id", int),
+        ("table.name/with/slashes.categories", "id", int),
+    ]
+
+
 def test_potential_foreign_keys(db):
     potentials = potential_foreign_keys(
         db.conn,
@@ -693,6 +1528,104 @@ def test_potential_foreign_keys(db):
     assert potentials == {"name": [], "city_id": [("cities", "id")]}
 
 
+def test_potential_foreign_keys_prunes_with_sketches():
+    db = sqlite_utils.Database(memory=True)
+    # 40 tables with integer keys in separate ranges, 40 with text keys
+    for i in range(40):
+        db["ints_{}".format(i)].insert_all(
+            [{"id": i * 100 + j} for j in range(100)], pk="id"
+        )
+        db["texts_{}".format(i)].insert_all(
+            [{"code": "{}-{}".format(i, j)} for j in range(10)], pk="code"
+        )
+    db["things"].insert_all(
+        [
+            {"int_ref": 1205 + j, "text_ref": "7-{}".format(j % 10), "nullable": None}
+            for j in range(50)
+        ]
+    )
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    potentials = potential_foreign_keys(
+        db.conn,
+        "things",
+        ["int_ref", "text_ref", "nullable"],
+        get_primary_keys(db.conn),
+    )
+    db.conn.set_trace_callback(None)
+    assert potentials == {
+        "int_ref": [("ints_12", "id")],
+        "text_ref": [("texts_7", "code")],
+        "nullable": [],
+    }
+    anti_joins = [sql for sql in statements if "not exists" in sql]
+    # Without sketches this would be 3 columns x 80 tables = 240 queries
+    assert len(anti_joins) < 10
+
+
+def test_could_match_type_conversion():
+    from datasette_edit_schema.sketches import column_sketches, could_match
+
+    db = sqlite_utils.Database(memory=True)
+    db["ints"].insert_all([{"id": 1}, {"id": 2}], pk="id")
+    db["texts"].insert_all([{"ref": "1"}, {"ref": "2"}], columns={"ref": str})
+    db.execute("create table untyped (ref)")
+    db["untyped"].insert_all([{"ref": "1"}, {"ref": "2"}])
+    db["words"].insert_all([{"ref": "one"}, {"ref": "two"}])
+    pk_sketch = column_sketches(db.conn, "ints", ["id"])["id"]
+    # TEXT compared against INTEGER is converted, so it could match
+    assert could_match(column_sketches(db.conn, "texts", ["ref"])["ref"], pk_sketch)
+    # Anti-join confirms that it does
+    assert potential_foreign_keys(db.conn, "texts", ["ref"], [("ints", "id", int)]) == {
+        "ref": [("ints", "id")]
+    }
+    assert could_match(column_sketches(db.conn, "untyped", ["ref"])["ref"], pk_sketch)
+
+
+def test_could_match_collation_and_affinity():
+    from datasette_edit_schema.sketches import (
+        ColumnSketch,
+        column_sketches,
+        could_match,
+    )
+
+    db = sqlite_utils.Database(memory=True)
+    db.executescript(
+        """
+        create table codes (code text collate nocase primary key);
+        insert into codes values ('a'), ('b');
+        create table refs (code text);
+        insert into refs values ('A'), ('B');
+        create table words (word text primary key);
+        insert into words values ('apple'), ('banana');
+        """
+    )
+    # Ordered as binary text 'A' and 'B' come before 'a', but with a NOCASE
+    # primary key the sketches cannot rule that out
+    pk_sketch = column_sketches(db.conn, "codes", ["code"])["code"]
+    assert not pk_sketch.binary_collation
+    assert could_match(column_sketches(db.conn, "refs", ["code"])["code"], pk_sketch)
+    # Whereas a binary primary key can be ruled out
+    assert not could_match(
+        column_sketches(db.conn, "refs", ["code"])["code"],
+        column_sketches(db.conn, "words", ["word"])["word"],
+    )
+
+    def sketch(affinity, **counts):
+        sketch = ColumnSketch(affinity)
+        for key, value in counts.items():
+            setattr(sketch, key, value)
+        return sketch
+
+    numbers = sketch("INTEGER", rows=1, integers=1, numeric_min=12, numeric_max=12)
+    # Text that numeric affinity might convert, such as '12.0', is not
+    # assumed to stay text even if it was not counted in numeric_texts
+    assert could_match(numbers, sketch("TEXT", rows=1, texts=1, maybe_numeric_texts=1))
+    assert not could_match(numbers, sketch("TEXT", rows=1, texts=1))
+    assert could_match(sketch("TEXT", rows=1, texts=1, maybe_numeric_texts=1), numbers)
+    assert not could_match(sketch("TEXT", rows=1, texts=1), numbers)
+
+
 @pytest.mark.asyncio
 async def test_edit_form_shows_suggestions(db_path):
     # Test for suggested foreign keys and primary keys
@@ -764,7 +1697,76 @@ async def test_edit_form_shows_suggestions(db_path):
     ]
 
 
-@pytest.mark.asyncio
+def test_sample_rowids():
+    db = sqlite_utils.Database(memory=True)
+    db["big"].insert_all({"id": i * 3} for i in range(1, 20_001))
+    rowids = sample_rowids(db.conn, "big", sample_size=100)
+    assert 90 <= len(rowids) <= 100
+    assert len(set(rowids)) == len(rowids)
+    # One from each stratum of the rowid range
+    assert all(i * 200 < rowid <= (i + 1) * 200 + 1 for i, rowid in enumerate(rowids))
+    db["empty"].create({"id": int})
+    assert sample_rowids(db.conn, "empty") == []
+    db.execute("create table no_rowid (id text primary key) without rowid")
+    assert sample_rowids(db.conn, "no_rowid") is None
+
+
+@pytest.mark.asyncio
+async def test_edit_form_samples_large_tables(db, db_path):
+    city_ids = ["nyc", "london", "sf"]
+    db["big"].insert_all(
+        {
+            "city_id": city_ids[i % 3],
+            "name": "Name {}".format(i),
+            "mostly_city": city_ids[i % 3] if i != 5_000 else "paris",
+            "dupe": i % 500,
+        }
+        for i in range(12_000)
+    )
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    response = await ds.client.get("/-/edit-schema/data/big", cookies=cookies)
+    assert response.status_code == 200
+    assert "suggestions are based on a random sample of" in response.text
+    soup = BeautifulSoup(response.text, "html5lib")
+    assert {
+        "value": "cities.id",
+        "text": "cities.id (suggested)",
+        "selected": False,
+    } in get_options(soup, "fk.city_id")
+    # Columns with duplicates in the sample are not suggested as primary keys
+    pk_values = [o["value"] for o in get_options(soup, "primary_key")]
+    assert "name" in pk_values
+    assert "dupe" not in pk_values
+    data = (
+        await ds.client.get(
+            "/-/edit-schema/data/big.json?_extra=suggestions", cookies=cookies
+        )
+    ).json()
+    assert data["suggestions"]["sample"]["sample_size"] > 900
+    assert data["suggestions"]["foreign_keys"]["city_id"] == [
+        {"other_table": "cities", "other_column": "id"}
+    ]
+    # Accepting a foreign key checks every row
+    csrftoken = response.cookies["ds_csrftoken"]
+    cookies["ds_csrftoken"] = csrftoken
+    response2 = await ds.client.post(
+        "/-/edit-schema/data/big",
+        data={
+            "action": "update_foreign_keys",
+            "fk.mostly_city": "cities.id",
+            "csrftoken": csrftoken,
+        },
+        cookies=cookies,
+    )
+    messages = ds.unsign(response2.cookies["ds_messages"], "messages")
+    assert messages == [
+        ["Foreign keys updated to mostly_city → cities.id", Datasette.INFO],
+        ["1 row in mostly_city has no matching value in cities.id", Datasette.WARNING],
+    ]
+
+
+@pytest.mark.asyncio
 async def test_edit_form_for_empty_table(db_path):
     # https://github.com/simonw/datasette-edit-schema/issues/38
     ds = Datasette([db_path])
@@ -1006,6 +2008,31 @@ def test_examples_for_columns():
     }
 
 
+def test_examples_for_columns_wide_table():
+    db = sqlite_utils.Database(memory=True)
+    db["wide"].insert_all(
+        {
+            **{"c{}".format(i): "row {} col {}".format(row, i) for i in range(600)},
+            "long": "x" * 100_000,
+            "blob": b"b" * 100_000,
+            "duplicates": row % 2,
+        }
+        for row in range(20)
+    )
+    examples = examples_for_columns(db.conn, "wide")
+    assert len(examples) == 602
+    assert examples["c0"] == [
+        "row 0 col 0",
+        "row 1 col 0",
+        "row 2 col 0",
+        "row 3 col 0",
+        "row 4 col 0",
+    ]
+    assert examples["long"] == ["x" * 30 + "..."]
+    assert examples["duplicates"] == ["0", "1"]
+    assert "blob" not in examples
+
+
 def test_potential_primary_keys():
     db = sqlite_utils.Database(memory=True)
     db["examples"].insert_all(
@@ -1019,6 +2046,31 @@ def test_potential_primary_keys():
     assert potentials == ["id", "photo's"]
 
 
+def test_potential_primary_keys_avoids_counting_distinct():
+    db = sqlite_utils.Database(memory=True)
+    db["examples"].insert_all(
+        {"code": "c{}".format(i), "name": "n{}".format(i), "group": i // 10}
+        for i in range(2_000)
+    )
+    db["examples"].create_index(["code"], unique=True)
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    potentials = potential_primary_keys(db.conn, "examples", ["code", "name", "group"])
+    db.conn.set_trace_callback(None)
+    assert potentials == ["code", "name"]
+    # "group" has duplicates in the first rows and "code" has a UNIQUE index,
+    # so only "name" needs its distinct values counted
+    distinct_statements = [
+        statement
+        for statement in statements
+        if "count(distinct" in statement and "limit" not in statement
+    ]
+    assert len(distinct_statements) == 1
+    assert 'count(distinct "name")' in distinct_statements[0]
+    assert '"code"' not in distinct_statements[0]
+    assert '"group"' not in distinct_statements[0]
+
+
 def test_potential_primary_keys_primary_key_only_table():
     # https://github.com/simonw/datasette-edit-schema/issues/51
     db = sqlite_utils.Database(memory=True)
@@ -1033,6 +2085,131 @@ def test_potential_primary_keys_primary_key_only_table():
     assert potentials == []
 
 
+def test_get_table_columns(db):
+    db.create_view("creature_names", "select name from creatures")
+    table_columns = get_table_columns(db.conn)
+    assert set(table_columns.keys()) == set(db.table_names())
+    assert table_columns["creatures"] == [
+        {"name": "name", "type": str},
+        {"name": "description", "type": str},
+    ]
+    assert table_columns["empty_table"] == [
+        {"name": "id", "type": int},
+        {"name": "name", "type": str},
+    ]
+
+
+def test_schema_catalog_cache(db):
+    class FakeDatabase:
+        name = "data"
+        path = None
+
+    database = FakeDatabase()
+    catalog = SchemaCatalog(max_size=2)
+    calls = []
+
+    def get(key):
+        def compute(conn):
+            calls.append(key)
+            return conn.execute("select count(*) from sqlite_master").fetchone()[0]
+
+        return catalog.get(db.conn, database, key, compute)
+
+    first = get("a")
+    assert get("a") == first
+    assert calls == ["a"]
+    # Changing the schema invalidates the cache
+    db["new_table"].insert({"id": 1})
+    assert get("a") == first + 1
+    assert calls == ["a", "a"]
+    # Least recently used entries are evicted
+    get("b")
+    get("a")
+    get("c")
+    assert calls == ["a", "a", "b", "c"]
+    get("a")
+    get("b")
+    assert calls == ["a", "a", "b", "c", "b"]
+    # The table() helper returns a snapshot of the table
+    table_info = catalog.table(db.conn, database, "museums")
+    assert table_info.pks == ["id"]
+    assert table_info.columns_dict == {"id": str, "name": str, "city_id": str}
+    assert catalog.table(db.conn, database, "museums") is table_info
+    assert catalog.table(db.conn, database, "does_not_exist") is None
+
+
+@pytest.mark.asyncio
+async def test_edit_schema_database_lists_tables(db_path):
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    response = await ds.client.get("/-/edit-schema/data", cookies=cookies)
+    assert response.status_code == 200
+    soup = BeautifulSoup(response.text, "html5lib")
+    tables = {h2.text: h2.find_next_sibling("p").text for h2 in soup.select("h2")}
+    assert tables["creatures"] == "name, description"
+    assert tables["empty_table"] == "id, name"
+    # ?table= filters the list
+    response2 = await ds.client.get(
+        "/-/edit-schema/data?table=museums&table=cities", cookies=cookies
+    )
+    soup2 = BeautifulSoup(response2.text, "html5lib")
+    assert [h2.text for h2 in soup2.select("h2")] == ["cities", "museums"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("extra", ("", "&table=cities&table=museums&table=creatures"))
+async def test_edit_schema_database_pagination(db_path, extra):
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    path = "/-/edit-schema/data?_size=2" + extra
+    seen = []
+    while path:
+        response = await ds.client.get(path, cookies=cookies)
+        assert response.status_code == 200
+        soup = BeautifulSoup(response.text, "html5lib")
+        page = [h2.text for h2 in soup.select("h2")]
+        assert 1 <= len(page) <= 2
+        seen.extend(page)
+        next_link = soup.find("a", string="Next page")
+        path = next_link["href"] if next_link else None
+    if extra:
+        assert seen == ["cities", "creatures", "museums"]
+    else:
+        assert seen == sorted(seen)
+        assert "has_foreign_keys" in seen
+
+
+@pytest.mark.asyncio
+async def test_edit_schema_database_streaming(db_path):
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    streamed = await ds.client.get(
+        "/-/edit-schema/data?_stream=1&_size=3", cookies=cookies
+    )
+    assert streamed.status_code == 200
+    assert streamed.headers["content-type"] == "text/html; charset=utf-8"
+    assert "<!-- edit-schema-tables -->" not in streamed.text
+    assert "</html>" in streamed.text
+    soup = BeautifulSoup(streamed.text, "html5lib")
+    streamed_tables = [h2.text for h2 in soup.select("h2")]
+    everything = await ds.client.get("/-/edit-schema/data?_size=1000", cookies=cookies)
+    soup2 = BeautifulSoup(everything.text, "html5lib")
+    assert streamed_tables == [h2.text for h2 in soup2.select("h2")]
+    # Streaming also respects ?table=
+    filtered = await ds.client.get(
+        "/-/edit-schema/data?_stream=1&table=creatures", cookies=cookies
+    )
+    soup3 = BeautifulSoup(filtered.text, "html5lib")
+    assert [h2.text for h2 in soup3.select("h2")] == ["creatures"]
+    # Messages are left for the next page, which can clear them
+    cookies["ds_messages"] = ds.sign([["Table has been deleted", ds.INFO]], "messages")
+    streamed = await ds.client.get("/-/edit-schema/data?_stream=1", cookies=cookies)
+    assert "Table has been deleted" not in streamed.text
+    assert "ds_messages" not in streamed.cookies
+    everything = await ds.client.get("/-/edit-schema/data", cookies=cookies)
+    assert "Table has been deleted" in everything.text
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
     "table,post_data,expected_message,expected_indexes",
@@ -1134,6 +2311,119 @@ async def test_add_remove_index(
     ] == expected_indexes
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "post_data,expected_message,expected_sql",
+    (
+        (
+            {"add_index_terms": "city_id, name desc"},
+            "Index added on city_id, name desc",
+            'CREATE INDEX "idx_museums_city_id_name" ON "museums" ("city_id", "name" DESC)',
+        ),
+        (
+            {"add_index_terms": "lower(name)", "add_index_unique": "1"},
+            "Unique index added on lower(name)",
+            'CREATE UNIQUE INDEX "idx_museums_lower_name" ON "museums" ((lower(name)))',
+        ),
+        (
+            {
+                "add_index_terms": "substr(name, 1, 4) DESC",
+                "add_index_where": "city_id = 'nyc'",
+            },
+            "Index added on substr(name, 1, 4) desc where city_id = 'nyc'",
+            'CREATE INDEX "idx_museums_substr_name_1_4" ON "museums" '
+            "((substr(name, 1, 4)) DESC) WHERE city_id = 'nyc'",
+        ),
+        (
+            # Only the row in london is indexed, so there are no duplicates
+            {
+                "add_index_column": "city_id",
+                "add_index_where": "city_id = 'london'",
+                "add_index_unique": "1",
+            },
+            "Unique index added on city_id where city_id = 'london'",
+            'CREATE UNIQUE INDEX "idx_museums_city_id" ON "museums" ("city_id") '
+            "WHERE city_id = 'london'",
+        ),
+        # Validation errors, reported before the job starts
+        ({"add_index_terms": "lower(city)"}, "no such column: city", None),
+        (
+            {"add_index_terms": "random()"},
+            "non-deterministic functions prohibited in index expressions",
+            None,
+        ),
+        (
+            {"add_index_terms": "name", "add_index_where": "(select 1)"},
+            "subqueries prohibited in partial index WHERE clauses",
+            None,
+        ),
+        (
+            {"add_index_terms": "name); drop table museums; --"},
+            "Comments are not allowed in index definitions",
+            None,
+        ),
+        (
+            {"add_index_terms": "name", "add_index_where": "1); drop table museums"},
+            "Unbalanced brackets in '1); drop table museums'",
+            None,
+        ),
+        (
+            {"add_index_terms": "lower(name", "add_index_where": ""},
+            "Unbalanced brackets in 'lower(name'",
+            None,
+        ),
+        (
+            {"add_index_terms": "name", "add_index_where": "1 = 1, 2"},
+            "'1 = 1, 2' should be a single expression, without commas outside of "
+            "brackets",
+            None,
+        ),
+        # Checked by the job before the index is built
+        (
+            {"add_index_terms": "city_id", "add_index_unique": "1"},
+            "UNIQUE constraint failed: museums.city_id",
+            None,
+        ),
+        (
+            {"add_index_terms": "upper(city_id)", "add_index_unique": "1"},
+            "UNIQUE constraint failed: index expression",
+            None,
+        ),
+    ),
+)
+async def test_add_index_terms(db_path, post_data, expected_message, expected_sql):
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    get_response = await ds.client.get("/-/edit-schema/data/museums", cookies=cookies)
+    assert 'name="add_index_terms"' in get_response.text
+    cookies["ds_csrftoken"] = get_response.cookies["ds_csrftoken"]
+    post_data = dict(
+        {"add_index": "1", "add_index_column": "name"},
+        csrftoken=cookies["ds_csrftoken"],
+        **post_data,
+    )
+    response = await ds.client.post(
+        "/-/edit-schema/data/museums", cookies=cookies, data=post_data
+    )
+    assert response.status_code == 302
+    messages = ds.unsign(response.cookies["ds_messages"], "messages")
+    assert [message[0] for message in messages] == [expected_message]
+    db = sqlite_utils.Database(db_path)
+    assert db["museums"].exists()
+    index_sql = [
+        sql
+        for (sql,) in db.execute(
+            "select sql from sqlite_master where type = 'index' "
+            "and tbl_name = 'museums' and sql is not null"
+        ).fetchall()
+    ]
+    assert index_sql == ([expected_sql] if expected_sql else [])
+    if expected_sql:
+        # The definition is shown in the list of existing indexes
+        page = await ds.client.get("/-/edit-schema/data/museums", cookies=cookies)
+        assert str(escape(expected_sql)) in page.text
+
+
 @pytest.mark.asyncio
 async def test_database_and_table_level_permissions(tmp_path):
     marketing_path = str(tmp_path / "marketing.db")
@@ -1194,3 +2484,950 @@ async def test_database_and_table_level_permissions(tmp_path):
     assert response2
     assert 'value="Drop this table">' in response2.text
     assert ' <input type="submit" value="Rename">' in response2.text
+
+
+def test_deadline_interrupts_queries(db):
+    deadline = Deadline(10)
+    with pytest.raises(DeadlineExceeded):
+        with deadline.limit(db.conn):
+            db.execute(
+                "with recursive n(i) as (select 1 union all select i + 1 from n) "
+                "select count(*) from n"
+            ).fetchall()
+    assert deadline.expired
+    # Queries that finish in time are unaffected
+    deadline2 = Deadline(10_000)
+    with deadline2.limit(db.conn):
+        assert db.execute("select 1").fetchone()[0] == 1
+    assert not deadline2.expired
+
+
+def test_analysis_functions_respect_deadline(db):
+    expired = Deadline(0)
+    other_pks = [("cities", "id", str)]
+    assert potential_foreign_keys(
+        db.conn, "museums", ["name", "city_id"], other_pks, deadline=expired
+    ) == {"name": [], "city_id": []}
+    # Columns that have not been ruled out are returned unverified
+    assert potential_primary_keys(
+        db.conn, "museums", ["name", "city_id"], deadline=expired
+    ) == ["name", "city_id"]
+    assert examples_for_columns(db.conn, "museums", deadline=expired) == {}
+    assert expired.expired
+    # With plenty of time the results are the same as with no deadline
+    assert potential_foreign_keys(
+        db.conn, "museums", ["city_id"], other_pks, deadline=Deadline(10_000)
+    ) == {"city_id": [("cities", "id")]}
+
+
+@pytest.mark.asyncio
+async def test_analysis_time_limit(db_path):
+    ds = Datasette(
+        [db_path],
+        config={"plugins": {"datasette-edit-schema": {"analysis_time_limit_ms": 0}}},
+    )
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    response = await ds.client.get("/-/edit-schema/data/museums", cookies=cookies)
+    assert response.status_code == 200
+    assert "Analysis of this table was stopped after 0ms" in response.text
+    data = (
+        await ds.client.get(
+            "/-/edit-schema/data/museums.json?_extra=examples,suggestions",
+            cookies=cookies,
+        )
+    ).json()
+    assert data["examples"] == {}
+    assert not data["examples_complete"]
+    assert data["suggestions"]["foreign_keys"] == {}
+    assert not data["suggestions"]["complete"]
+
+
+@pytest.mark.asyncio
+async def test_precompute_suggestions(db, db_path):
+    ds = Datasette(
+        [db_path],
+        config={"plugins": {"datasette-edit-schema": {"precompute_suggestions": True}}},
+    )
+    await ds.invoke_startup()
+    worker = get_suggestions_worker(ds)
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    # Nothing has been computed yet - but every column could be the PK
+    await worker._lock.acquire()
+    response = await ds.client.get("/-/edit-schema/data/museums", cookies=cookies)
+    worker._lock.release()
+    assert "Suggestions for this table are being calculated" in response.text
+    soup = BeautifulSoup(response.text, "html5lib")
+    assert [o["value"] for o in get_options(soup, "primary_key")] == [
+        "id",
+        "name",
+        "city_id",
+    ]
+    await worker.run_once()
+    stored = await get_stored_suggestions(ds, "data", "museums")
+    assert not stored["stale"]
+    data = (
+        await ds.client.get(
+            "/-/edit-schema/data/museums.json?_extra=examples,suggestions",
+            cookies=cookies,
+        )
+    ).json()
+    assert data["examples"]["city_id"] == ["nyc", "london", "sf"]
+    assert data["suggestions"]["foreign_keys"] == {
+        "city_id": [{"other_table": "cities", "other_column": "id"}]
+    }
+    assert data["suggestions"]["primary_keys"] == ["name"]
+    assert not data["suggestions"]["computing"]
+    # Unchanged databases are skipped entirely
+    computed_at = stored["computed_at"]
+    await worker.run_once()
+    assert (await get_stored_suggestions(ds, "data", "museums"))[
+        "computed_at"
+    ] == computed_at
+    # Only tables that have changed are recomputed
+    cities_computed_at = (await get_stored_suggestions(ds, "data", "cities"))[
+        "computed_at"
+    ]
+    db["museums"].insert({"id": "louvre", "name": "Louvre", "city_id": "paris"})
+    await worker.run_once()
+    assert (await get_stored_suggestions(ds, "data", "museums"))[
+        "computed_at"
+    ] != computed_at
+    assert (await get_stored_suggestions(ds, "data", "cities"))[
+        "computed_at"
+    ] == cities_computed_at
+    data2 = (
+        await ds.client.get(
+            "/-/edit-schema/data/museums.json?_extra=suggestions", cookies=cookies
+        )
+    ).json()
+    assert data2["suggestions"]["foreign_keys"] == {}
+    # Dropped tables are forgotten
+    db["museums"].drop()
+    await worker.run_once()
+    assert await get_stored_suggestions(ds, "data", "museums") is None
+
+
+def test_table_fingerprint_only_counts_small_tables():
+    db = sqlite_utils.Database(memory=True)
+    db["items"].insert_all(({"id": i} for i in range(1, 11)), pk="id")
+
+    def fingerprint(count_limit):
+        return table_fingerprint(
+            db.conn, "items", db["items"].schema, [], count_limit=count_limit
+        )
+
+    small, large = fingerprint(100), fingerprint(5)
+    db["items"].delete(3)
+    # Deleting a row only shows up in the count
+    assert fingerprint(100) != small
+    assert fingerprint(5) == large
+    # Adding one moves the maximum rowid
+    db["items"].insert({"id": 11})
+    assert fingerprint(5) != large
+
+
+@pytest.mark.asyncio
+async def test_precompute_suggestions_retries_failed_pass(db, db_path):
+    ds = Datasette([db_path])
+    # Not started in the background, so only the test runs it
+    worker = SuggestionsWorker(ds)
+    await worker.run_once()
+    db["museums"].insert({"id": "louvre", "name": "Louvre", "city_id": "paris"})
+    compute = worker._compute
+
+    def failing_compute(database, conn, table):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    worker._compute = failing_compute
+    with pytest.raises(sqlite3.OperationalError):
+        await worker.run_once()
+    assert (await get_stored_suggestions(ds, "data", "museums"))["stale"]
+    # The next pass tries again, even though nothing has been written since
+    worker._compute = compute
+    await worker.run_once()
+    stored = await get_stored_suggestions(ds, "data", "museums")
+    assert not stored["stale"]
+    assert json.loads(stored["foreign_keys"]) == {"name": [], "city_id": []}
+
+
+@pytest.mark.asyncio
+async def test_server_timing(db_path):
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    response = await ds.client.get("/-/edit-schema/data/museums", cookies=cookies)
+    phases = [
+        item.strip().split(";")[0]
+        for item in response.headers["server-timing"].split(",")
+    ]
+    assert phases == [
+        "permissions",
+        "introspection",
+        "examples",
+        "count",
+        "foreign_keys",
+        "primary_keys",
+        "rendering",
+    ]
+    assert all(
+        re.match(r"^[a-z_]+;dur=\d+\.\d{3}$", item.strip())
+        for item in response.headers["server-timing"].split(",")
+    )
+    # The debug panel is only shown if requested
+    assert "SQL statements" not in response.text
+    response2 = await ds.client.get(
+        "/-/edit-schema/data/museums?_debug=1", cookies=cookies
+    )
+    soup = BeautifulSoup(response2.text, "html5lib")
+    rows = soup.select("table.debug-statements tr")[1:]
+    statements = [(row.select("td")[0].text, row.select("pre")[0].text) for row in rows]
+    assert any(
+        phase == "foreign_keys" and "not exists" in sql for phase, sql in statements
+    )
+    assert any(phase == "examples" for phase, _ in statements)
+    json_response = await ds.client.get(
+        "/-/edit-schema/data/museums.json?_extra=suggestions", cookies=cookies
+    )
+    assert "foreign_keys;dur=" in json_response.headers["server-timing"]
+
+
+@pytest.mark.asyncio
+async def test_batch_json(db_path):
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    db = sqlite_utils.Database(db_path)
+    rootpage_before = db.execute(
+        "select rootpage from sqlite_master where name = 'museums'"
+    ).fetchone()[0]
+    operations = [
+        {"op": "rename", "column": "name", "to": "title"},
+        {"op": "add_column", "name": "opened", "type": "INTEGER"},
+        {"op": "type", "column": "opened", "type": "TEXT"},
+        {
+            "op": "set_foreign_key",
+            "column": "city_id",
+            "other_table": "cities",
+            "other_column": "id",
+        },
+        {"op": "reorder", "columns": ["id", "city_id", "title", "opened"]},
+        {"op": "add_index", "columns": ["title"]},
+    ]
+    expected_plan = {
+        "steps": [
+            "Rename column name to title",
+            "Add INTEGER column opened",
+            "Change type of column opened to TEXT",
+            "Set foreign key city_id → cities.id",
+            "Change the column order to id, city_id, title, opened",
+            "Add index on title",
+        ],
+        "rebuild": True,
+        "rebuild_reasons": ["columns have been reordered", "foreign keys have changed"],
+    }
+    response = await ds.client.post(
+        "/-/edit-schema/data/museums/-/batch",
+        content=json.dumps({"operations": operations, "dry_run": True}),
+        headers={"content-type": "application/json"},
+        cookies=cookies,
+    )
+    assert response.status_code == 200
+    assert response.json() == {"ok": True, "plan": expected_plan}
+    assert [c.name for c in db["museums"].columns] == ["id", "name", "city_id"]
+    # Now apply it for real
+    response = await ds.client.post(
+        "/-/edit-schema/data/museums/-/batch",
+        content=json.dumps({"operations": operations}),
+        headers={"content-type": "application/json"},
+        cookies=cookies,
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["ok"]
+    assert data["plan"] == expected_plan
+    assert data["job"]["status"] == "finished"
+    assert data["job_url"].endswith(
+        "/-/edit-schema/-/jobs/{}.json".format(data["job"]["id"])
+    )
+    assert db["museums"].columns_dict == {
+        "id": str,
+        "city_id": str,
+        "title": str,
+        "opened": str,
+    }
+    assert db["museums"].pks == ["id"]
+    assert [(fk.column, fk.other_table) for fk in db["museums"].foreign_keys] == [
+        ("city_id", "cities")
+    ]
+    assert [
+        index.columns for index in db["museums"].indexes if index.origin != "pk"
+    ] == [["title"]]
+    assert db.execute("select id, title from museums order by id").fetchall()[0] == (
+        "cablecars",
+        "Cable Car Museum",
+    )
+    assert (
+        db.execute(
+            "select rootpage from sqlite_master where name = 'museums'"
+        ).fetchone()[0]
+        != rootpage_before
+    )
+    event = get_last_event(ds)
+    if event is not None:
+        assert event.name == "alter-table"
+
+
+@pytest.mark.asyncio
+async def test_batch_json_in_place(db_path):
+    # Renames, swaps, new columns and drops do not need the table copied
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    db = sqlite_utils.Database(db_path)
+    db["museums"].add_column("notes", str)
+    rootpage_before = db.execute(
+        "select rootpage from sqlite_master where name = 'museums'"
+    ).fetchone()[0]
+    response = await ds.client.post(
+        "/-/edit-schema/data/museums/-/batch",
+        content=json.dumps(
+            {
+                "operations": [
+                    {"op": "rename", "columns": {"name": "city_id", "city_id": "name"}},
+                    {"op": "drop", "column": "notes"},
+                    {"op": "add_column", "name": "opened", "type": "INTEGER"},
+                ]
+            }
+        ),
+        headers={"content-type": "application/json"},
+        cookies=cookies,
+    )
+    assert response.status_code == 200
+    assert response.json()["plan"]["rebuild"] is False
+    assert db["museums"].columns_dict == {
+        "id": str,
+        "city_id": str,
+        "name": str,
+        "opened": int,
+    }
+    assert db.execute(
+        "select city_id, name from museums where id = 'tate'"
+    ).fetchone() == (
+        "Tate Modern",
+        "london",
+    )
+    assert (
+        db.execute(
+            "select rootpage from sqlite_master where name = 'museums'"
+        ).fetchone()[0]
+        == rootpage_before
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "operations,expected_error",
+    (
+        ([{"op": "explode"}], "Unknown operation: explode"),
+        ([{"op": "drop", "column": "missing"}], "Column 'missing' does not exist"),
+        (
+            [{"op": "drop", "column": "id"}],
+            "Column 'id' is part of the primary key and cannot be deleted",
+        ),
+        (
+            [{"op": "rename", "column": "name", "to": "city_id"}],
+            "A column called 'city_id' already exists",
+        ),
+        ([{"op": "type", "column": "name", "type": "DATE"}], "Invalid type: DATE"),
+        (
+            [
+                {"op": "drop", "column": "name"},
+                {"op": "add_column", "name": "name", "type": "INTEGER"},
+            ],
+            "Column 'name' is being renamed or deleted, add a new column with "
+            "that name in a separate change",
+        ),
+        (
+            [
+                {"op": "rename", "column": "name", "to": "title"},
+                {"op": "add_column", "name": "name", "type": "TEXT"},
+            ],
+            "Column 'name' is being renamed or deleted, add a new column with "
+            "that name in a separate change",
+        ),
+        ([{"op": "drop", "to": "x"}], "Invalid arguments for drop operation"),
+        ("drop", "operations must be a list"),
+    ),
+)
+async def test_batch_json_errors(db_path, operations, expected_error):
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    response = await ds.client.post(
+        "/-/edit-schema/data/museums/-/batch",
+        content=json.dumps({"operations": operations}),
+        headers={"content-type": "application/json"},
+        cookies=cookies,
+    )
+    assert response.status_code == 400
+    assert response.json() == {"ok": False, "errors": [expected_error]}
+    db = sqlite_utils.Database(db_path)
+    assert [c.name for c in db["museums"].columns] == ["id", "name", "city_id"]
+
+
+@pytest.mark.asyncio
+async def test_batch_form(db_path):
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    response = await ds.client.get("/-/edit-schema/data/museums", cookies=cookies)
+    assert '/-/edit-schema/data/museums/-/batch"' in response.text
+    response = await ds.client.get(
+        "/-/edit-schema/data/museums/-/batch", cookies=cookies
+    )
+    assert response.status_code == 200
+    csrftoken = response.cookies["ds_csrftoken"]
+    cookies["ds_csrftoken"] = csrftoken
+    soup = BeautifulSoup(response.text, "html.parser")
+    form_data = {}
+    for input in soup.select("form.core input, form.core select"):
+        if input.name == "select":
+            selected = input.find("option", selected=True) or input.find("option")
+            form_data[input["name"]] = selected["value"]
+        elif input.get("type") != "checkbox" and input.get("type") != "submit":
+            form_data[input["name"]] = input.get("value", "")
+    # Submitting the form unchanged does nothing
+    response = await ds.client.post(
+        "/-/edit-schema/data/museums/-/batch", data=form_data, cookies=cookies
+    )
+    assert response.status_code == 302
+    assert ds.unsign(response.cookies["ds_messages"], "messages") == [
+        ["No changes to save", ds.INFO]
+    ]
+    form_data.update(
+        {
+            "name.name": "title",
+            "fk.city_id": "cities.id",
+            "add_column_name.0": "opened",
+            "add_column_type.0": "INTEGER",
+            "add_index_columns": "title, opened",
+        }
+    )
+    response = await ds.client.post(
+        "/-/edit-schema/data/museums/-/batch", data=form_data, cookies=cookies
+    )
+    assert response.status_code == 200
+    soup = BeautifulSoup(response.text, "html.parser")
+    assert [li.text for li in soup.select("ul.change-plan li")] == [
+        "Set foreign key city_id → cities.id",
+        "Rename column name to title",
+        "Add INTEGER column opened",
+        "Add index on title, opened",
+    ]
+    assert "foreign keys have changed" in response.text
+    db = sqlite_utils.Database(db_path)
+    assert db["museums"].foreign_keys == []
+    # Confirming applies the changes
+    response = await ds.client.post(
+        "/-/edit-schema/data/museums/-/batch",
+        data=dict(form_data, confirm="1"),
+        cookies=cookies,
+    )
+    assert response.status_code == 302
+    assert response.headers["location"] == "/-/edit-schema/data/museums"
+    assert ds.unsign(response.cookies["ds_messages"], "messages") == [
+        ["Changes to table have been saved", ds.INFO]
+    ]
+    assert [c.name for c in db["museums"].columns] == [
+        "id",
+        "title",
+        "city_id",
+        "opened",
+    ]
+    assert [fk.other_table for fk in db["museums"].foreign_keys] == ["cities"]
+    assert [
+        index.columns for index in db["museums"].indexes if index.origin != "pk"
+    ] == [["title", "opened"]]
+
+
+def test_set_foreign_keys_copies_each_table_once(db_path):
+    db = sqlite_utils.Database(db_path)
+    db["events"].insert_all(
+        [{"id": 1, "city_id": "sf"}, {"id": 2, "city_id": "paris"}], pk="id"
+    )
+    db.create_view(
+        "museum_events",
+        "select museums.name, events.id from museums "
+        "join events on events.city_id = museums.city_id",
+    )
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA foreign_keys=1")
+    statements = []
+    conn.set_trace_callback(statements.append)
+    violations = set_foreign_keys(
+        conn,
+        {
+            "museums": [("city_id", "cities", "id")],
+            "events": [("city_id", "cities", "id")],
+            # Unchanged, so it is not copied
+            "has_foreign_keys": [("distraction_id", "distractions", "id")],
+        },
+    )
+    conn.set_trace_callback(None)
+    assert violations == {("events", "city_id", "cities", "id"): 1}
+    creates = [
+        re.sub(r"_new_\w+", "_new", sql.split("(")[0].split(" AS ")[0])
+        for sql in statements
+        if sql.startswith("CREATE")
+    ]
+    assert creates == [
+        "CREATE TABLE [museums_new] ",
+        "CREATE TABLE [events_new] ",
+        "CREATE VIEW museum_events",
+    ]
+    assert sum(sql == "PRAGMA foreign_key_check" for sql in statements) == 1
+    assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+    db = sqlite_utils.Database(db_path)
+    for table in ("museums", "events"):
+        assert [(fk.column, fk.other_table) for fk in db[table].foreign_keys] == [
+            ("city_id", "cities")
+        ]
+    assert len(db.execute("select * from museum_events").fetchall()) == 2
+
+
+@pytest.mark.asyncio
+async def test_database_foreign_keys_form(db_path):
+    db = sqlite_utils.Database(db_path)
+    db["events"].insert_all(
+        [{"id": 1, "city_id": "sf"}, {"id": 2, "city_id": "paris"}], pk="id"
+    )
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    response = await ds.client.get("/-/edit-schema/data", cookies=cookies)
+    assert '/-/edit-schema/data/-/foreign-keys"' in response.text
+    response = await ds.client.get(
+        "/-/edit-schema/data/-/foreign-keys?table=events&table=has_foreign_keys",
+        cookies=cookies,
+    )
+    assert response.status_code == 200
+    cookies["ds_csrftoken"] = response.cookies["ds_csrftoken"]
+    soup = BeautifulSoup(response.text, "html.parser")
+    form_data = {"csrftoken": cookies["ds_csrftoken"]}
+    for select in soup.select("form.core select"):
+        selected = select.find("option", selected=True)
+        form_data[select["name"]] = selected["value"] if selected else ""
+    assert form_data == {
+        "csrftoken": cookies["ds_csrftoken"],
+        "fk.events.id": "",
+        "fk.events.city_id": "",
+        "fk.has_foreign_keys.id": "",
+        "fk.has_foreign_keys.distraction_id": "distractions.id",
+    }
+    # Only text primary keys are offered for text columns
+    assert [
+        option["value"]
+        for option in soup.select("select[name='fk.events.city_id'] option")
+    ] == ["", "museums.id", "cities.id", "distractions.id"]
+    form_data["fk.events.city_id"] = "cities.id"
+    form_data["fk.has_foreign_keys.distraction_id"] = ""
+    response = await ds.client.post(
+        "/-/edit-schema/data/-/foreign-keys", data=form_data, cookies=cookies
+    )
+    assert response.status_code == 302
+    assert ds.unsign(response.cookies["ds_messages"], "messages") == [
+        ["Foreign keys updated for 2 tables: events, has_foreign_keys", ds.INFO],
+        ["1 row in events.city_id has no matching value in cities.id", ds.WARNING],
+    ]
+    assert [fk.other_table for fk in db["events"].foreign_keys] == ["cities"]
+    assert db["has_foreign_keys"].foreign_keys == []
+
+
+@pytest.mark.asyncio
+async def test_database_foreign_keys_form_keeps_non_primary_key_references(tmp_path):
+    path = str(tmp_path / "pets.db")
+    db = sqlite_utils.Database(path)
+    db.executescript(
+        """
+        create table owners (id integer primary key, code text unique);
+        create table pets (
+            id integer primary key,
+            owner_code text references owners(code),
+            parent_id integer references pets(id)
+        );
+        insert into owners values (1, 'a');
+        insert into pets values (1, 'a', null);
+        """
+    )
+    schema = db["pets"].schema
+    ds = Datasette([path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    response = await ds.client.get(
+        "/-/edit-schema/pets/-/foreign-keys", cookies=cookies
+    )
+    cookies["ds_csrftoken"] = response.cookies["ds_csrftoken"]
+    soup = BeautifulSoup(response.text, "html.parser")
+    form_data = {"csrftoken": cookies["ds_csrftoken"]}
+    for select in soup.select("form.core select"):
+        selected = select.find("option", selected=True)
+        form_data[select["name"]] = selected["value"] if selected else ""
+    assert form_data["fk.pets.owner_code"] == "owners.code"
+    assert form_data["fk.pets.parent_id"] == "pets.id"
+    assert (
+        soup.select_one("select[name='fk.pets.owner_code'] option[selected]").text
+        == "owners.code (current)"
+    )
+    # Submitting the form unchanged leaves the table alone
+    response = await ds.client.post(
+        "/-/edit-schema/pets/-/foreign-keys", data=form_data, cookies=cookies
+    )
+    assert response.status_code == 302
+    assert ds.unsign(response.cookies["ds_messages"], "messages") == [
+        ["No changes to foreign keys", ds.WARNING]
+    ]
+    assert db["pets"].schema == schema
+    assert {
+        (fk.column, fk.other_table, fk.other_column) for fk in db["pets"].foreign_keys
+    } == {
+        ("owner_code", "owners", "code"),
+        ("parent_id", "pets", "id"),
+    }
+
+
+@pytest.mark.asyncio
+async def test_database_foreign_keys_json(db_path):
+    ds = Datasette([db_path])
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+
+    async def post(data):
+        return await ds.client.post(
+            "/-/edit-schema/data/-/foreign-keys",
+            content=json.dumps(data),
+            headers={"content-type": "application/json"},
+            cookies=cookies,
+        )
+
+    foreign_keys = {
+        "museums": [
+            {"column": "city_id", "other_table": "cities", "other_column": "id"}
+        ]
+    }
+    response = await post({"foreign_keys": foreign_keys, "dry_run": True})
+    assert response.json() == {"ok": True, "tables": ["museums"]}
+    db = sqlite_utils.Database(db_path)
+    assert db["museums"].foreign_keys == []
+    response = await post({"foreign_keys": foreign_keys})
+    data = response.json()
+    assert data["ok"]
+    assert data["job"]["status"] == "finished"
+    assert [fk.other_table for fk in db["museums"].foreign_keys] == ["cities"]
+    # Errors
+    response = await post(
+        {
+            "foreign_keys": {
+                "museums": [
+                    {"column": "nope", "other_table": "cities", "other_column": "id"}
+                ],
+                "missing": [],
+            }
+        }
+    )
+    assert response.status_code == 400
+    assert response.json() == {
+        "ok": False,
+        "errors": [
+            "Column 'nope' does not exist in 'museums'",
+            "Table 'missing' does not exist",
+        ],
+    }
+    response = await post({"foreign_keys": {"museums": [{"column": "city_id"}]}})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "strategy,auto_vacuum,expected_free,expected_message",
+    (
+        (None, False, False, None),
+        ("none", False, True, "which a VACUUM would reclaim"),
+        ("incremental", True, False, "Reclaimed 2.0 MB"),
+        (
+            "incremental",
+            False,
+            True,
+            "does not have auto_vacuum set to incremental",
+        ),
+    ),
+)
+async def test_drop_table_reclaim_strategy(
+    db_path, strategy, auto_vacuum, expected_free, expected_message
+):
+    db = sqlite_utils.Database(db_path)
+    if auto_vacuum:
+        db.execute("PRAGMA auto_vacuum=incremental")
+        db.vacuum()
+    db["blobs"].insert_all({"blob": bytes(1000)} for _ in range(2000))
+    size_before = os.path.getsize(db_path)
+    config = {"reclaim_strategy": strategy} if strategy else {}
+    ds = Datasette([db_path], config={"plugins": {"datasette-edit-schema": config}})
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    csrftoken = (
+        await ds.client.get("/-/edit-schema/data/blobs", cookies=cookies)
+    ).cookies["ds_csrftoken"]
+    response = await ds.client.post(
+        "/-/edit-schema/data/blobs",
+        data={"drop_table": "1", "csrftoken": csrftoken},
+        cookies=dict(cookies, ds_csrftoken=csrftoken),
+    )
+    assert response.status_code == 302
+    assert "blobs" not in db.table_names()
+    messages = [m[0] for m in ds.unsign(response.cookies["ds_messages"], "messages")]
+    assert messages[0] == "Table has been deleted"
+    if expected_message:
+        assert expected_message in messages[1]
+    else:
+        assert len(messages) == 1
+    free_pages = db.execute("PRAGMA freelist_count").fetchone()[0]
+    assert bool(free_pages) == expected_free
+    assert (os.path.getsize(db_path) == size_before) == expected_free
+    # The stats page reports the free space
+    stats = (await ds.client.get("/-/edit-schema/-/stats", cookies=cookies)).json()
+    assert stats["freelist"]["data"]["freelist_count"] == free_pages
+    assert stats["freelist"]["data"]["reclaim_pending"] is False
+
+
+@pytest.mark.asyncio
+async def test_drop_table_deferred_reclaim(db_path):
+    db = sqlite_utils.Database(db_path)
+    db["blobs"].insert_all({"blob": bytes(1000)} for _ in range(2000))
+    ds = Datasette(
+        [db_path],
+        config={
+            "plugins": {
+                "datasette-edit-schema": {
+                    "reclaim_strategy": "deferred",
+                    "reclaim_window": "23:00-02:00",
+                    "reclaim_check_interval_seconds": 3600,
+                }
+            }
+        },
+    )
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    csrftoken = (
+        await ds.client.get("/-/edit-schema/data/blobs", cookies=cookies)
+    ).cookies["ds_csrftoken"]
+    response = await ds.client.post(
+        "/-/edit-schema/data/blobs",
+        data={"drop_table": "1", "csrftoken": csrftoken},
+        cookies=dict(cookies, ds_csrftoken=csrftoken),
+    )
+    assert ds.unsign(response.cookies["ds_messages"], "messages")[1] == [
+        "2.0 MB of free space will be reclaimed later, between 23:00 and 02:00",
+        ds.INFO,
+    ]
+    stats = (await ds.client.get("/-/edit-schema/-/stats", cookies=cookies)).json()
+    assert stats["freelist"]["data"]["reclaim_pending"] is True
+    assert stats["freelist"]["data"]["free_bytes"] > 1_900_000
+    scheduler = ds._edit_schema_reclaim_scheduler
+    # Nothing happens outside of the window
+    await scheduler.run_once(now=datetime.datetime(2024, 1, 1, 12, 0))
+    assert db.execute("PRAGMA freelist_count").fetchone()[0] > 0
+    await scheduler.run_once(now=datetime.datetime(2024, 1, 1, 1, 0))
+    assert db.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    assert scheduler.pending == set()
+    job = list(get_job_manager(ds).jobs.values())[-1]
+    assert job.description == "Reclaiming free space"
+    assert job.status == "finished"
+
+
+@pytest.mark.asyncio
+async def test_incremental_vacuum_stops(db_path, monkeypatch):
+    from datasette_edit_schema import reclaim
+
+    db = sqlite_utils.Database(db_path)
+    db.execute("PRAGMA auto_vacuum=incremental")
+    db.vacuum()
+    db["blobs"].insert_all({"blob": bytes(1000)} for _ in range(2000))
+    db["blobs"].drop()
+    start = db.execute("PRAGMA freelist_count").fetchone()[0]
+    steps = []
+
+    def step(conn, pages):
+        # As if other writes kept freeing more pages than each step
+        steps.append(pages)
+        return start + len(steps)
+
+    monkeypatch.setattr(reclaim, "incremental_vacuum_step", step)
+    ds = Datasette([db_path])
+    job = Job(1, "data", None, "Reclaiming free space")
+    await reclaim.incremental_vacuum(ds, ds.get_database("data"), job, pages=100)
+    assert len(steps) == 1
+    assert job.fraction == 0.0
+
+    def slow_step(conn, pages):
+        # As if other writes freed almost as many pages as each step
+        steps.append(pages)
+        return start - len(steps)
+
+    steps.clear()
+    monkeypatch.setattr(reclaim, "incremental_vacuum_step", slow_step)
+    await reclaim.incremental_vacuum(ds, ds.get_database("data"), job, pages=100)
+    assert len(steps) == -(-start // 100)
+    assert 0 < job.fraction < 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "config,expected_error",
+    (
+        ({"reclaim_strategy": "vacuum_into"}, "Invalid reclaim_strategy 'vacuum_into'"),
+        (
+            {"reclaim_strategy": "deferred", "reclaim_window": "2am"},
+            "Invalid reclaim_window '2am'",
+        ),
+    ),
+)
+async def test_invalid_reclaim_settings(db_path, capsys, config, expected_error):
+    ds = Datasette([db_path], config={"plugins": {"datasette-edit-schema": config}})
+    await ds.invoke_startup()
+    assert expected_error in capsys.readouterr().err
+    assert not hasattr(ds, "_edit_schema_reclaim_scheduler")
+    # Dropping a table falls back to a VACUUM
+    db = sqlite_utils.Database(db_path)
+    db["blobs"].insert_all({"blob": bytes(1000)} for _ in range(2000))
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    csrftoken = (
+        await ds.client.get("/-/edit-schema/data/blobs", cookies=cookies)
+    ).cookies["ds_csrftoken"]
+    response = await ds.client.post(
+        "/-/edit-schema/data/blobs",
+        data={"drop_table": "1", "csrftoken": csrftoken},
+        cookies=dict(cookies, ds_csrftoken=csrftoken),
+    )
+    assert response.status_code == 302
+    assert db.execute("PRAGMA freelist_count").fetchone()[0] == 0
+
+
+@pytest.mark.asyncio
+async def test_index_advisor(db_path):
+    db = sqlite_utils.Database(db_path)
+    db["museums"].insert_all(
+        {"id": "m{}".format(i), "name": "Museum {}".format(i), "city_id": "sf"}
+        for i in range(100)
+    )
+    ds = Datasette(
+        [db_path],
+        config={"plugins": {"datasette-edit-schema": {"index_advisor": True}}},
+    )
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    # Nothing has been run yet
+    data = (
+        await ds.client.get(
+            "/-/edit-schema/data/museums.json?_extra=indexes", cookies=cookies
+        )
+    ).json()
+    assert data["suggested_indexes"] == []
+    # Filter the table a few times, and run a query that an index can't help
+    for city in ("sf", "nyc", "london"):
+        response = await ds.client.get("/data/museums?city_id={}".format(city))
+        assert response.status_code == 200
+    await ds.client.get("/data/museums?name__contains=Tate&city_id=sf")
+    await ds.client.get("/data/-/query?sql=select+count(*)+from+museums")
+    stats = (await ds.client.get("/-/edit-schema/-/stats", cookies=cookies)).json()
+    assert stats["workload"]["data"]["executions"] > 0
+    # Values are not kept, and neither are this plugin's own queries
+    statements = [sql for sql, _ in get_workload(ds).statements("data")]
+    assert not [sql for sql in statements if "nyc" in sql or "Tate" in sql]
+    assert "select count(*) from museums" in statements
+    data = (
+        await ds.client.get(
+            "/-/edit-schema/data/museums.json?_extra=indexes", cookies=cookies
+        )
+    ).json()
+    suggestions = data["suggested_indexes"]
+    assert suggestions[0]["columns"] == ["city_id"]
+    assert suggestions[0]["scans_removed"] >= 4
+    assert all(
+        "city_id" in sql.lower() for sql in suggestions[0]["examples"]
+    ), suggestions[0]["examples"]
+    # name__contains uses LIKE, which an index on name does not help
+    assert ["name"] not in [s["columns"] for s in suggestions]
+    # Apply it from the table page
+    response = await ds.client.get("/-/edit-schema/data/museums", cookies=cookies)
+    soup = BeautifulSoup(response.text, "html.parser")
+    button = soup.select(".index-suggestion button")[0]
+    assert button["value"] == "city_id"
+    csrftoken = response.cookies["ds_csrftoken"]
+    response = await ds.client.post(
+        "/-/edit-schema/data/museums",
+        data={"add_index_columns": button["value"], "csrftoken": csrftoken},
+        cookies=dict(cookies, ds_csrftoken=csrftoken),
+    )
+    assert response.status_code == 302
+    assert ds.unsign(response.cookies["ds_messages"], "messages") == [
+        ["Index added on city_id", ds.INFO]
+    ]
+    assert [
+        index.columns for index in db["museums"].indexes if index.origin != "pk"
+    ] == [["city_id"]]
+    # Once the index exists it is no longer suggested
+    data = (
+        await ds.client.get(
+            "/-/edit-schema/data/museums.json?_extra=indexes", cookies=cookies
+        )
+    ).json()
+    assert ["city_id"] not in [s["columns"] for s in data["suggested_indexes"]]
+    # The table page's own analysis queries were not recorded
+    assert not [
+        sql for sql, _ in get_workload(ds).statements("data") if "typeof(" in sql
+    ]
+
+
+@pytest.mark.asyncio
+async def test_index_advisor_caches_suggestions(db_path, monkeypatch):
+    import datasette_edit_schema
+
+    calls = []
+    recommend_indexes = datasette_edit_schema.recommend_indexes
+
+    def counting_recommend_indexes(conn, table, statements):
+        calls.append(table)
+        return recommend_indexes(conn, table, statements)
+
+    monkeypatch.setattr(
+        datasette_edit_schema, "recommend_indexes", counting_recommend_indexes
+    )
+    ds = Datasette(
+        [db_path],
+        config={"plugins": {"datasette-edit-schema": {"index_advisor": True}}},
+    )
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    url = "/-/edit-schema/data/museums.json?_extra=indexes"
+    await ds.client.get("/data/museums?city_id=sf")
+    first = (await ds.client.get(url, cookies=cookies)).json()["suggested_indexes"]
+    # The same query with a different value is not a new statement
+    await ds.client.get("/data/museums?city_id=nyc")
+    second = (await ds.client.get(url, cookies=cookies)).json()["suggested_indexes"]
+    assert second == first
+    assert calls == ["museums"]
+    # A new statement, or a schema change, means working them out again
+    await ds.client.get("/data/museums?name=Tate")
+    await ds.client.get(url, cookies=cookies)
+    assert calls == ["museums"] * 2
+    sqlite_utils.Database(db_path)["museums"].create_index(["name"])
+    await ds.client.get(url, cookies=cookies)
+    assert calls == ["museums"] * 3
+
+
+def test_normalize_sql():
+    assert normalize_sql(
+        'select "it\'s", [a b] from t -- comment\n'
+        "where a = 'it''s'  and b = -1.5e3 and c = x'0aff' and d = :p0 limit 101"
+    ) == (
+        'select "it\'s", [a b] from t where a = ? and b = -? and c = ? '
+        "and d = ? limit ?"
+    )
+
+
+@pytest.mark.asyncio
+async def test_index_advisor_off_by_default(db_path):
+    ds = Datasette([db_path])
+    await ds.client.get("/data/museums?city_id=sf")
+    assert get_workload(ds).statements("data") == []
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    response = await ds.client.get("/-/edit-schema/data/museums", cookies=cookies)
+    assert "Suggested indexes" not in response.text